@@ -1,17 +1,135 @@
-from PIL import Image, ImageFilter, ImageDraw
-import random
-import os
+"""Generate the reader background textures (paper, linen, grain) as WebP drawables.
+
+Usage:
+  python generate_textures.py --seed 42                         # drawable-nodpi, 256 px
+  python generate_textures.py --seed 42 --densities mdpi,xhdpi,xxhdpi --size 128 --kinds paper,linen,grain
+  python generate_textures.py --seed 42 --quality 70 --compare-encodings
+  python generate_textures.py --seed 42 --tileable --optimize --kinds paper,linen
+  python generate_textures.py --benchmark --size 1024
+
+Variants are generated in parallel. With a fixed seed, each output is keyed by a hash of its
+parameters in build/cache/textures/manifest.json; unchanged variants are skipped and files whose
+bytes would not change are never rewritten, so res/ only churns when a texture really changes.
+
+--tileable wraps the 2 px line spill, the grain upscaling and every blur around the edges, so the
+texture repeats without seams. --optimize searches the smallest tile size whose texture statistics
+(alpha mean/std and radial power spectrum) match the reference size, and the smallest WebP encoding
+whose SSIM against the lossless image, composited over light and dark reader backgrounds, stays
+within --max-dssim.
+"""
+
+import argparse
 import base64
+import hashlib
+import io
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+RES_DIR = 'app/src/main/res'
+CACHE_MANIFEST = 'build/cache/textures/manifest.json'
+# Bump when a generator changes its output for the same parameters.
+GENERATOR_VERSION = 2
+DENSITY_SCALES = {'nodpi': 1.0, 'mdpi': 1.0, 'hdpi': 1.5, 'xhdpi': 2.0, 'xxhdpi': 3.0, 'xxxhdpi': 4.0}
+PAPER_BLUR = 0.6
+LINEN_BLUR = 0.4
+# Alpha of paper noise pixels and of linen lines (inclusive ranges).
+PAPER_MAX_ALPHA = 25
+LINEN_ALPHA = (8, 18)
+# Light and dark reader backgrounds the textures are composited over when comparing them.
+PREVIEW_BACKGROUNDS = ((245, 240, 230), (30, 30, 30))
+SPECTRUM_BINS = 16
+
+
+def paper_array(size, rng):
+    """RGBA noise: each pixel is black or white with alpha growing from 0 to 25 away from 0.5."""
+    noise = rng.random((size, size))
+    dark = noise < 0.5
+    out = np.empty((size, size, 4), dtype=np.uint8)
+    out[..., :3] = np.where(dark, 0, 255)[..., None]
+    out[..., 3] = (np.abs(noise - 0.5) * 2 * PAPER_MAX_ALPHA).astype(np.uint8)
+    return out
+
+
+def blur(image, radius, tileable):
+    """GaussianBlur; in tileable mode the image is wrap-padded first so the blur crosses the edges."""
+    if not tileable:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+    size = image.size[0]
+    pad = int(radius * 3) + 2
+    wrapped = np.pad(np.asarray(image), ((pad, pad), (pad, pad), (0, 0)), mode='wrap')
+    blurred = Image.fromarray(wrapped, 'RGBA').filter(ImageFilter.GaussianBlur(radius))
+    return blurred.crop((pad, pad, pad + size, pad + size))
+
+
+def line_layer(count, rng, tileable=False):
+    """Colour and alpha per row (or column) for one pass of full-length lines.
+
+    About 80% of positions get a line, half of them dark, with width 1 or 2. Lines are drawn in
+    order and replace what is below them, so a 2 px line at i also owns i + 1 unless line i + 1
+    is drawn itself. In tileable mode the last line spills onto the first.
+    """
+    drawn = rng.random(count) > 0.2
+    dark = rng.random(count) > 0.5
+    alpha = rng.integers(LINEN_ALPHA[0], LINEN_ALPHA[1] + 1, count)
+    wide = rng.random(count) < 0.5
+    index = np.arange(count)
+    spill = np.zeros(count, dtype=bool)
+    spill[1:] = drawn[:-1] & wide[:-1]
+    if tileable:
+        spill[0] = drawn[-1] & wide[-1]
+    owner = np.where(drawn, index, np.where(spill, (index - 1) % count, -1))
+    owned = owner >= 0
+    safe = np.maximum(owner, 0)
+    return owned, np.where(dark[safe], 0, 255), np.where(owned, alpha[safe], 0)
+
+
+def linen_array(size, rng, tileable=False):
+    """Horizontal lines, then vertical lines drawn over them."""
+    _, row_rgb, row_alpha = line_layer(size, rng, tileable)
+    col_owned, col_rgb, col_alpha = line_layer(size, rng, tileable)
+    out = np.empty((size, size, 4), dtype=np.uint8)
+    rgb = np.where(col_owned[None, :], col_rgb[None, :], row_rgb[:, None])
+    out[..., :3] = rgb[..., None]
+    out[..., 3] = np.where(col_owned[None, :], col_alpha[None, :], row_alpha[:, None])
+    return out
+
+
+def generate_paper(size, rng, tileable=False):
+    # Per-pixel noise is independent, so only the blur has to wrap.
+    return blur(Image.fromarray(paper_array(size, rng), 'RGBA'), PAPER_BLUR, tileable)
+
 
-os.makedirs('app/src/main/res/drawable-nodpi', exist_ok=True)
+def generate_linen(size, rng, tileable=False):
+    return blur(Image.fromarray(linen_array(size, rng, tileable), 'RGBA'), LINEN_BLUR, tileable)
 
-def generate_paper():
-    size = 256
+
+def generate_grain(size, rng, tileable=False):
+    """Coarser paper fibre: quarter-resolution noise scaled up bilinearly and softened."""
+    small = paper_array(max(2, size // 4), rng)
+    if not tileable:
+        noise = Image.fromarray(small, 'RGBA').resize((size, size), Image.BILINEAR)
+        return blur(noise, 1.0, False)
+    # Upscale a 3x3 tiling and keep the centre so interpolation sees the wrapped neighbours.
+    tiled = Image.fromarray(np.tile(small, (3, 3, 1)), 'RGBA').resize((size * 3, size * 3), Image.BILINEAR)
+    return blur(tiled.crop((size, size, size * 2, size * 2)), 1.0, True)
+
+
+GENERATORS = {'paper': generate_paper, 'linen': generate_linen, 'grain': generate_grain}
+
+
+def generate_paper_legacy(size, rnd):
+    """Per-pixel loop the textures were first generated with; kept for --benchmark."""
     out = Image.new('RGBA', (size, size))
     out_pixels = out.load()
     for y in range(size):
         for x in range(size):
-            noise = random.random()
+            noise = rnd.random()
             if noise < 0.5:
                 # Black pixel, slight alpha
                 alpha = int((0.5 - noise) * 2 * 25)
@@ -20,45 +138,305 @@ def generate_paper():
                 # White pixel, slight alpha
                 alpha = int((noise - 0.5) * 2 * 25)
                 out_pixels[x, y] = (255, 255, 255, alpha)
-                
-    out = out.filter(ImageFilter.GaussianBlur(0.6))
-    path = 'app/src/main/res/drawable-nodpi/texture_paper.webp'
-    out.save(path, 'WEBP')
-    
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode('utf-8')
-
-def generate_linen():
-    size = 256
+    return out.filter(ImageFilter.GaussianBlur(PAPER_BLUR))
+
+
+def generate_linen_legacy(size, rnd):
+    """Per-line draw calls the textures were first generated with; kept for --benchmark."""
     out = Image.new('RGBA', (size, size), (0, 0, 0, 0))
     draw = ImageDraw.Draw(out, 'RGBA')
-    
+
     # Horizontal lines
     for y in range(size):
-        if random.random() > 0.2:
-            is_dark = random.random() > 0.5
-            color = (0,0,0, random.randint(8, 18)) if is_dark else (255,255,255, random.randint(8, 18))
-            draw.line([(0, y), (size, y)], fill=color, width=random.choice([1, 2]))
-            
+        if rnd.random() > 0.2:
+            is_dark = rnd.random() > 0.5
+            color = (0,0,0, rnd.randint(8, 18)) if is_dark else (255,255,255, rnd.randint(8, 18))
+            draw.line([(0, y), (size, y)], fill=color, width=rnd.choice([1, 2]))
+
     # Vertical lines
     for x in range(size):
-        if random.random() > 0.2:
-            is_dark = random.random() > 0.5
-            color = (0,0,0, random.randint(8, 18)) if is_dark else (255,255,255, random.randint(8, 18))
-            draw.line([(x, 0), (x, size)], fill=color, width=random.choice([1, 2]))
-            
-    out = out.filter(ImageFilter.GaussianBlur(0.4))
-    path = 'app/src/main/res/drawable-nodpi/texture_linen.webp'
-    out.save(path, 'WEBP')
-    
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode('utf-8')
-
-b64_paper = generate_paper()
-b64_linen = generate_linen()
-
-print("PAPER_B64:")
-print(b64_paper)
-print("")
-print("LINEN_B64:")
-print(b64_linen)
+        if rnd.random() > 0.2:
+            is_dark = rnd.random() > 0.5
+            color = (0,0,0, rnd.randint(8, 18)) if is_dark else (255,255,255, rnd.randint(8, 18))
+            draw.line([(x, 0), (x, size)], fill=color, width=rnd.choice([1, 2]))
+
+    return out.filter(ImageFilter.GaussianBlur(LINEN_BLUR))
+
+
+def alpha_stats(image):
+    alpha = np.asarray(image)[..., 3]
+    return f'alpha mean={alpha.mean():.2f} std={alpha.std():.2f} max={alpha.max()}'
+
+
+def run_benchmark(size, seed):
+    print(f'size={size}')
+    for name, fast, legacy in (
+        ('paper', generate_paper, generate_paper_legacy),
+        ('linen', generate_linen, generate_linen_legacy),
+    ):
+        started = time.perf_counter()
+        legacy_image = legacy(size, random.Random(seed))
+        legacy_sec = time.perf_counter() - started
+        started = time.perf_counter()
+        fast_image = fast(size, np.random.default_rng(seed))
+        fast_sec = time.perf_counter() - started
+        print(f'{name}: legacy={legacy_sec:.3f}s numpy={fast_sec:.3f}s speedup={legacy_sec / max(fast_sec, 1e-9):.1f}x')
+        print(f'  legacy {alpha_stats(legacy_image)}')
+        print(f'  numpy  {alpha_stats(fast_image)}')
+
+
+def encode_webp(image, quality, lossless, method):
+    buffer = io.BytesIO()
+    image.save(buffer, 'WEBP', quality=quality, lossless=lossless, method=method)
+    return buffer.getvalue()
+
+
+def variant_params(kind, density, base_size, seed, args):
+    size = max(1, round(base_size * DENSITY_SCALES[density]))
+    return {
+        'kind': kind,
+        'density': density,
+        'size': size,
+        'seed': seed,
+        'quality': args.quality,
+        'lossless': args.lossless,
+        'method': args.method,
+        'tileable': args.tileable,
+        'version': GENERATOR_VERSION,
+    }
+
+
+def params_key(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def variant_image(params):
+    kind_index = sorted(GENERATORS).index(params['kind'])
+    seed = params['seed']
+    # Independent, reproducible stream per kind and size; unseeded runs stay random.
+    rng = np.random.default_rng(None if seed is None else [seed, kind_index, params['size']])
+    return GENERATORS[params['kind']](params['size'], rng, params.get('tileable', False))
+
+
+def render_variant(params):
+    """Worker: generate one variant and return its WebP bytes."""
+    return encode_webp(variant_image(params), params['quality'], params['lossless'], params['method'])
+
+
+def compare_encodings(params):
+    """Byte size of one variant under a few lossy qualities and lossless."""
+    image = variant_image(params)
+    sizes = {f'q{quality}': len(encode_webp(image, quality, False, params['method'])) for quality in (50, 70, 80, 90)}
+    sizes['lossless'] = len(encode_webp(image, 100, True, params['method']))
+    return sizes
+
+
+def composite(image, background):
+    """Luminance of the RGBA texture drawn over an opaque background colour."""
+    rgba = np.asarray(image.convert('RGBA'), dtype=np.float64)
+    alpha = rgba[..., 3:] / 255.0
+    rgb = rgba[..., :3] * alpha + np.asarray(background, dtype=np.float64) * (1 - alpha)
+    return rgb @ np.array([0.299, 0.587, 0.114])
+
+
+def box_mean(values, window):
+    """Mean over a window x window neighbourhood, wrapping at the edges like a tiled texture."""
+    pad = window // 2
+    padded = np.pad(values, pad, mode='wrap')
+    summed = padded.cumsum(0).cumsum(1)
+    summed = np.pad(summed, ((1, 0), (1, 0)))
+    total = summed[window:, window:] - summed[:-window, window:] - summed[window:, :-window] + summed[:-window, :-window]
+    return total / (window * window)
+
+
+def ssim(first, second, window=7):
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_x, mu_y = box_mean(first, window), box_mean(second, window)
+    var_x = box_mean(first * first, window) - mu_x ** 2
+    var_y = box_mean(second * second, window) - mu_y ** 2
+    cov = box_mean(first * second, window) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+
+def dssim(reference, candidate):
+    """Perceptual difference (1 - SSIM), worst case over the reader backgrounds."""
+    return max(1 - ssim(composite(reference, bg), composite(candidate, bg)) for bg in PREVIEW_BACKGROUNDS)
+
+
+def texture_signature(image):
+    """Size-independent look of a texture: alpha mean/std and a normalised radial power spectrum."""
+    alpha = np.asarray(image.convert('RGBA'))[..., 3].astype(np.float64)
+    lum = composite(image, (128, 128, 128))
+    power = np.abs(np.fft.rfft2(lum - lum.mean())) ** 2
+    fy = np.fft.fftfreq(lum.shape[0])[:, None]
+    fx = np.fft.rfftfreq(lum.shape[1])[None, :]
+    bins = np.minimum((np.hypot(fx, fy) / 0.5 * SPECTRUM_BINS).astype(int), SPECTRUM_BINS - 1).ravel()
+    radial = np.bincount(bins, power.ravel(), SPECTRUM_BINS) / np.maximum(np.bincount(bins, minlength=SPECTRUM_BINS), 1)
+    return alpha.mean(), alpha.std(), radial / max(radial.sum(), 1e-12)
+
+
+def signature_distance(first, second):
+    mean_a, std_a, spectrum_a = first
+    mean_b, std_b, spectrum_b = second
+    return max(
+        abs(mean_a - mean_b) / max(mean_b, 1e-9),
+        abs(std_a - std_b) / max(std_b, 1e-9),
+        float(np.abs(spectrum_a - spectrum_b).sum()) / 2,
+    )
+
+
+def seam_ratio(image):
+    """Mean step across the wrap edges divided by the mean step between interior neighbours (~1 = seamless)."""
+    lum = composite(image, (128, 128, 128))
+    edge = np.concatenate([np.abs(lum[0] - lum[-1]), np.abs(lum[:, 0] - lum[:, -1])]).mean()
+    interior = np.concatenate([np.abs(np.diff(lum, axis=0)).ravel(), np.abs(np.diff(lum, axis=1)).ravel()]).mean()
+    return float(edge / max(interior, 1e-9))
+
+
+def optimize_kind(task):
+    """Smallest tile size with matching statistics, then the smallest encoding within the DSSIM budget."""
+    kind, args = task
+    reference_params = variant_params(kind, 'nodpi', args.size, args.seed, args)
+    reference_signature = texture_signature(variant_image(reference_params))
+    # Two seeds of the reference already differ (a lot for sparse line patterns); a smaller size
+    # only has to stay within that natural variation, or --max-stat-diff if larger.
+    other_seed = texture_signature(variant_image(dict(reference_params, seed=reference_params['seed'] + 1)))
+    tolerance = max(args.max_stat_diff, 1.25 * signature_distance(other_seed, reference_signature))
+    lines = [f'  tolerance={tolerance:.3f}']
+    sizes = sorted({size for size in (args.size // 8, args.size // 4, args.size // 2, args.size * 3 // 4) if size >= args.min_size})
+    sizes.append(args.size)
+    for size in sizes:
+        params = dict(reference_params, size=size)
+        image = variant_image(params)
+        distance = signature_distance(texture_signature(image), reference_signature)
+        seams = seam_ratio(image)
+        if distance > tolerance:
+            lines.append(f'  {size}px stat_diff={distance:.3f} seam={seams:.2f} rejected')
+            continue
+        encodings = [('lossless', True, 100)] + [(f'q{quality}', False, quality) for quality in (30, 40, 50, 60, 70, 80, 90)]
+        accepted = []
+        for name, lossless, quality in encodings:
+            data = encode_webp(image, quality, lossless, args.method)
+            difference = 0.0 if lossless else dssim(image, Image.open(io.BytesIO(data)))
+            if difference <= args.max_dssim:
+                accepted.append((len(data), name, difference))
+        smallest = min(accepted)
+        lines.append(f'  {size}px stat_diff={distance:.3f} seam={seams:.2f} best={smallest[1]} {smallest[0]} B dssim={smallest[2]:.4f}')
+        encoding = '--lossless' if smallest[1] == 'lossless' else f'--quality {smallest[1][1:]}'
+        tiling = ' --tileable' if args.tileable else ''
+        lines.append(f'  recommended: --kinds {kind} --size {size} {encoding}{tiling}')
+        break
+    return kind, lines
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def output_path(res_dir, params):
+    return os.path.join(res_dir, f"drawable-{params['density']}", f"texture_{params['kind']}.webp")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate reader background textures')
+    parser.add_argument('--kinds', default='paper,linen', help=f"comma-separated, from {','.join(sorted(GENERATORS))}")
+    parser.add_argument('--densities', default='nodpi', help=f"comma-separated, from {','.join(DENSITY_SCALES)}")
+    parser.add_argument('--size', type=int, default=256, help='edge in px at nodpi/mdpi; scaled for other densities')
+    parser.add_argument('--seed', type=int, default=None, help='fixed seed for reproducible (and cacheable) textures')
+    parser.add_argument('--res-dir', default=RES_DIR)
+    parser.add_argument('--quality', type=int, default=80, help='WebP quality (lossy) or effort (lossless)')
+    parser.add_argument('--lossless', action='store_true')
+    parser.add_argument('--method', type=int, default=6, choices=range(7), help='WebP encoder effort, 6 = smallest')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--force', action='store_true', help='ignore the cache manifest')
+    parser.add_argument('--tileable', action='store_true', help='wrap lines and blurs so the texture tiles without seams')
+    parser.add_argument('--optimize', action='store_true', help='search the smallest size and WebP encoding that look the same')
+    parser.add_argument('--min-size', type=int, default=32, help='smallest tile size tried by --optimize')
+    parser.add_argument('--max-stat-diff', type=float, default=0.1, help='minimum texture statistics tolerance for --optimize')
+    parser.add_argument('--max-dssim', type=float, default=0.01, help='perceptual difference budget (1 - SSIM) for --optimize')
+    parser.add_argument('--compare-encodings', action='store_true', help='report byte sizes for several WebP settings')
+    parser.add_argument('--print-base64', action='store_true', help='print each written texture as base64')
+    parser.add_argument('--benchmark', action='store_true', help='time the NumPy generators against the per-pixel loops')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.size, args.seed if args.seed is not None else 0)
+        return
+
+    kinds = [kind.strip() for kind in args.kinds.split(',') if kind.strip()]
+    densities = [density.strip() for density in args.densities.split(',') if density.strip()]
+    unknown = [kind for kind in kinds if kind not in GENERATORS] + [d for d in densities if d not in DENSITY_SCALES]
+    if unknown:
+        parser.error(f"unknown kind or density: {', '.join(unknown)}")
+
+    variants = [variant_params(kind, density, args.size, args.seed, args) for density in densities for kind in kinds]
+
+    if args.optimize:
+        if args.seed is None:
+            args.seed = 0
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            for kind, lines in pool.map(optimize_kind, [(kind, args) for kind in kinds]):
+                print(f'{kind}:')
+                print('\n'.join(lines))
+        return
+
+    if args.compare_encodings:
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            for params, sizes in zip(variants, pool.map(compare_encodings, variants)):
+                cells = ' '.join(f'{name}={size}' for name, size in sizes.items())
+                print(f"{params['kind']}@{params['density']} {params['size']}px {cells}")
+        return
+
+    manifest = load_manifest(CACHE_MANIFEST)
+    todo = []
+    for params in variants:
+        path = output_path(args.res_dir, params)
+        entry = manifest.get(path)
+        cacheable = params['seed'] is not None and not args.force
+        if cacheable and entry and entry['key'] == params_key(params) and entry['sha256'] == file_digest(path):
+            print(f"cached     {path} {params['size']}px {entry['bytes']} B")
+            continue
+        todo.append((path, params))
+
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        rendered = list(pool.map(render_variant, [params for _, params in todo]))
+
+    for (path, params), data in zip(todo, rendered):
+        digest = hashlib.sha256(data).hexdigest()
+        if file_digest(path) == digest:
+            status = 'unchanged'
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            status = 'written'
+        print(f"{status:<10} {path} {params['size']}px {len(data)} B")
+        if params['seed'] is not None:
+            manifest[path] = {'key': params_key(params), 'sha256': digest, 'bytes': len(data)}
+        if args.print_base64 and status == 'written':
+            print(base64.b64encode(data).decode('utf-8'))
+
+    save_manifest(CACHE_MANIFEST, manifest)
+
+
+if __name__ == '__main__':
+    main()
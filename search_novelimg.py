@@ -1,9 +1,471 @@
+"""Search a hexnovels live log for image-loading references.
+
+Usage:
+  python search_novelimg.py                                  # novelimg in hexnovels_live.log
+  python search_novelimg.py big.log -e novelimg -e 'cdn\\.[a-z]+\\.ru' --context 120
+  python search_novelimg.py hexnovels_live.log --follow --max-hits 50
+  python search_novelimg.py hexnovels_live.log --structured --db hexnovels_live.sqlite
+
+The log is memory-mapped and searched once for all patterns, decoded in runs of whole lines of
+about 1 MiB with universal newlines (so a match cannot span two runs). Line numbers come from a
+sparse line-break index (cumulative count per 1 MiB block) stored next to the log, so repeated
+searches over the same multi-GB log only count line breaks inside one block per run.
+
+--structured parses logcat lines (OkHttp request/response/failure lines and image-load errors)
+into an SQLite table and prints per-host latency percentiles and error counts.
+"""
+
+import argparse
+import hashlib
+import mmap
 import pathlib
 import re
-path = pathlib.Path('hexnovels_live.log')
-data = path.read_text(errors='ignore')
-for match in re.finditer('novelimg', data, flags=re.I):
-    start = max(0, match.start()-60)
-    end = min(len(data), match.end()+60)
-    snippet = data[start:end].replace('\n', ' ')
-    print('line', data.count('\n',0, match.start())+1, snippet)
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from urllib.parse import urlparse
+
+# v2: "\r\n" and a bare "\r" count as one line break each, like universal newlines.
+INDEX_MAGIC = b'NLIDX2\0\0'
+INDEX_HEADER = struct.Struct('<8sQQQ16s')
+INDEX_BLOCK = 1 << 20
+HEAD_BYTES = 1 << 16
+
+# adb logcat -v threadtime (optionally with a year), and the older -v brief "I/Tag(  123): msg".
+THREADTIME_RE = re.compile(
+    r'^(?P<ts>(?:\d{4}-)?\d\d-\d\d \d\d:\d\d:\d\d\.\d+)\s+\d+\s+(?P<tid>\d+)\s+(?P<level>[VDIWEF])\s+(?P<tag>.*?)\s*: (?P<msg>.*)$')
+BRIEF_RE = re.compile(r'^(?P<level>[VDIWEF])/(?P<tag>[^(]*?)\s*\(\s*(?P<tid>\d+)\): (?P<msg>.*)$')
+# OkHttp HttpLoggingInterceptor: "--> GET url", "<-- 200 OK url (123ms, ...)", "<-- HTTP FAILED: error".
+REQUEST_RE = re.compile(r'^--> (?P<method>[A-Z]+) (?P<url>\S+)')
+RESPONSE_RE = re.compile(r'^<-- (?P<status>\d{3})\b.*? (?P<url>[a-z][a-z0-9+.-]*://\S+) \((?P<ms>\d+)ms')
+FAILED_RE = re.compile(r'^<-- HTTP FAILED: (?P<error>.*)')
+URL_RE = re.compile(r'[a-z][a-z0-9+.-]*://[^\s"\'<>)]+', re.I)
+ERROR_WORDS_RE = re.compile(r'fail|error|exception|timeout', re.I)
+# Rewrites that let an -e pattern sit inside the combined alternation (as in
+# tools/ci/report-release-warnings.py): named groups would clash with the per-pattern groups, and
+# leading global flags are only legal at the very start of a pattern. Back-references count the
+# groups of their own pattern, so such patterns are searched on their own instead.
+NAMED_GROUP_RE = re.compile(r'(?<!\\)\(\?P<[A-Za-z_][A-Za-z0-9_]*>')
+GLOBAL_FLAGS_RE = re.compile(r'\(\?([aiLmsux]+)\)')
+BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+RECORD_COLUMNS = ('ts', 'level', 'tag', 'kind', 'method', 'url', 'host', 'status', 'duration_ms', 'error')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Find pattern hits with line numbers in a hexnovels log')
+    parser.add_argument('log', nargs='?', default='hexnovels_live.log')
+    parser.add_argument('-e', '--pattern', action='append', dest='patterns',
+                        help='regex to search for (repeatable, default: novelimg)')
+    parser.add_argument('--case-sensitive', action='store_true')
+    parser.add_argument('--context', type=int, default=60, help='characters of context on each side of a hit')
+    parser.add_argument('--index', help='line index path (default: <log>.lineidx)')
+    parser.add_argument('--no-index', action='store_true', help='count lines in one forward pass without persisting an index')
+    parser.add_argument('--follow', action='store_true', help='tail the log and print hits as they are written')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--summary-every', type=float, default=30.0)
+    parser.add_argument('--idle-timeout', type=float, default=0.0, help='stop following after this many idle seconds (0 = never)')
+    parser.add_argument('--structured', action='store_true', help='parse the log into SQLite records and print per-host summaries')
+    parser.add_argument('--db', help='SQLite output for --structured (default: <log>.sqlite)')
+    parser.add_argument('--top', type=int, default=10, help='failing URLs listed by --structured')
+    parser.add_argument('--max-hits', type=int, default=None, help='exit 3 as soon as more hits than this are seen')
+    args = parser.parse_args()
+    args.patterns = args.patterns or ['novelimg']
+    return args
+
+
+def merge_alternative(index, text):
+    """``text`` as the named alternative ``p<index>`` of the combined regex, or None if it cannot be."""
+    if BACKREF_RE.search(text):
+        return None
+    text = NAMED_GROUP_RE.sub('(?:', text)
+    flags = GLOBAL_FLAGS_RE.match(text)
+    if flags:
+        # "(?i)http" -> "(?i:http)": same meaning, but scoped to this pattern.
+        text = f'(?{flags.group(1)}:{text[flags.end():]})'
+    return f'(?P<p{index}>{text})'
+
+
+class PatternSet:
+    """The -e patterns, searched as one alternation when they can be merged, else one by one.
+
+    ``finditer`` yields ``(pattern index, match)`` with the semantics of an alternation either way:
+    leftmost match first, the earlier pattern on a tie, and no overlapping hits.
+    """
+
+    def __init__(self, patterns, case_sensitive):
+        # str patterns, so re.I folds Cyrillic and other non-ASCII letters too.
+        flags = 0 if case_sensitive else re.I
+        self.patterns = patterns
+        self.regexes = [re.compile(text, flags) for text in patterns]
+        self.combined = None
+        alternatives = [merge_alternative(index, text) for index, text in enumerate(patterns)]
+        if None not in alternatives:
+            try:
+                self.combined = re.compile('|'.join(alternatives), flags)
+            except re.error:
+                pass
+
+    def finditer(self, text, pos=0, endpos=None):
+        endpos = len(text) if endpos is None else endpos
+        if self.combined is not None:
+            for match in self.combined.finditer(text, pos, endpos):
+                yield int(match.lastgroup[1:]), match
+            return
+        found = [regex.search(text, pos, endpos) for regex in self.regexes]
+        while True:
+            candidates = [(match.start(), index) for index, match in enumerate(found) if match]
+            if not candidates:
+                return
+            _, index = min(candidates)
+            match = found[index]
+            yield index, match
+            pos = match.end() if match.end() > match.start() else match.end() + 1
+            for other, pending in enumerate(found):
+                if pending and pending.start() < pos:
+                    found[other] = self.regexes[other].search(text, pos, endpos) if pos <= endpos else None
+
+
+def decode_text(raw):
+    """Decode like ``read_text(errors='ignore')``: "\r\n" and a bare "\r" become "\n"."""
+    return raw.decode(errors='ignore').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def count_breaks(mm, start, end):
+    """Line breaks in mm[start:end] as universal newlines see them; a "\r\n" pair split by
+    ``end`` is counted with its "\n"."""
+    chunk = mm[start:end]
+    breaks = chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+    if chunk.endswith(b'\r') and mm[end:end + 1] == b'\n':
+        breaks -= 1
+    return breaks
+
+
+def line_runs(mm, size):
+    """(start, end) byte ranges of whole lines, each about INDEX_BLOCK bytes long."""
+    start = 0
+    while start < size:
+        cut = mm.find(b'\n', start + INDEX_BLOCK - 1) if start + INDEX_BLOCK < size else -1
+        end = size if cut < 0 else cut + 1
+        yield start, end
+        start = end
+
+
+def head_digest(mm, size):
+    return hashlib.blake2b(mm[:min(size, HEAD_BYTES)], digest_size=16).digest()
+
+
+def load_index(index_path, size, mtime_ns, digest):
+    """Return (cumulative counts, indexed bytes) reusable for this file, or (None, 0).
+
+    An index of an older, shorter version of the same log (same head bytes) is reused and
+    extended, which keeps repeated searches over an appended live log cheap.
+    """
+    try:
+        raw = index_path.read_bytes()
+    except OSError:
+        return None, 0
+    if len(raw) < INDEX_HEADER.size:
+        return None, 0
+    magic, block, indexed_size, indexed_mtime, indexed_digest = INDEX_HEADER.unpack_from(raw)
+    if magic != INDEX_MAGIC or block != INDEX_BLOCK or indexed_digest != digest or indexed_size > size:
+        return None, 0
+    counts = array('Q')
+    counts.frombytes(raw[INDEX_HEADER.size:])
+    if indexed_size == size and indexed_mtime == mtime_ns:
+        return counts, size
+    # Drop the trailing partial block; it is recounted from the new data.
+    full_blocks = indexed_size // INDEX_BLOCK
+    del counts[full_blocks + 1:]
+    return counts, full_blocks * INDEX_BLOCK
+
+
+def build_index(mm, size, counts=None, start=0):
+    """counts[i] = line breaks before byte i * INDEX_BLOCK."""
+    if counts is None:
+        counts = array('Q', [0])
+    total = counts[-1]
+    for offset in range(start, size, INDEX_BLOCK):
+        total += count_breaks(mm, offset, min(offset + INDEX_BLOCK, size))
+        if offset + INDEX_BLOCK <= size:
+            counts.append(total)
+    return counts
+
+
+def save_index(index_path, counts, size, mtime_ns, digest):
+    try:
+        with index_path.open('wb') as handle:
+            handle.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_BLOCK, size, mtime_ns, digest))
+            handle.write(counts.tobytes())
+    except OSError as error:
+        print(f'warning: cannot write line index {index_path}: {error}', file=sys.stderr)
+
+
+class LineCounter:
+    """Line number of ascending offsets: jumps via the block index, then counts forward from the
+    previous hit when it is in the same block."""
+
+    def __init__(self, mm, counts):
+        self.mm = mm
+        self.counts = counts
+        self.offset = 0
+        self.line = 1
+
+    def line_at(self, offset):
+        block = offset // INDEX_BLOCK
+        if self.counts is not None and block < len(self.counts) and self.offset < block * INDEX_BLOCK:
+            self.offset = block * INDEX_BLOCK
+            self.line = self.counts[block] + 1
+        self.line += count_breaks(self.mm, self.offset, offset)
+        self.offset = offset
+        return self.line
+
+
+def label_of(index, patterns):
+    if len(patterns) == 1:
+        return ''
+    return f'[{patterns[index]}] '
+
+
+def search(args, regex):
+    path = pathlib.Path(args.log)
+    stat = path.stat()
+    if stat.st_size == 0:
+        return 0
+    hits = 0
+    with path.open('rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        counts = None
+        if not args.no_index:
+            index_path = pathlib.Path(args.index) if args.index else path.with_name(path.name + '.lineidx')
+            digest = head_digest(mm, size)
+            counts, indexed = load_index(index_path, size, stat.st_mtime_ns, digest)
+            if counts is None or indexed < size:
+                counts = build_index(mm, size, counts, indexed)
+                save_index(index_path, counts, size, stat.st_mtime_ns, digest)
+        lines = LineCounter(mm, counts)
+        context = args.context
+        tail = ''
+        for start, end in line_runs(mm, size):
+            text = decode_text(mm[start:end])
+            # Context may reach into the neighbouring runs; 4 bytes cover any UTF-8 character.
+            head = decode_text(mm[end:end + 4 * context])[:context] if context else ''
+            window = tail + text + head
+            line = lines.line_at(start)
+            counted = len(tail)
+            for index, match in regex.finditer(window, len(tail), len(tail) + len(text)):
+                hits += 1
+                line += window.count('\n', counted, match.start())
+                counted = match.start()
+                snippet = window[max(0, match.start() - context):match.end() + context].replace('\n', ' ')
+                print('line', line, f'{label_of(index, args.patterns)}{snippet}')
+            tail = (tail + text)[-context:] if context else ''
+    return hits
+
+
+def over_budget(args, hits):
+    return args.max_hits is not None and hits > args.max_hits
+
+
+def print_line_hits(args, regex, line_no, raw):
+    line = raw.decode(errors='ignore').rstrip('\r')
+    found = 0
+    for index, match in regex.finditer(line):
+        found += 1
+        snippet = line[max(0, match.start() - args.context):match.end() + args.context]
+        print('line', line_no, f'{label_of(index, args.patterns)}{snippet}', flush=True)
+    return found
+
+
+def follow(args, regex):
+    """Poll the size, read only the appended bytes and scan complete lines once."""
+    path = pathlib.Path(args.log)
+    offset = 0
+    line_no = 0
+    hits = 0
+    carry = b''
+    started = last_growth = last_summary = time.monotonic()
+    try:
+        while True:
+            size = path.stat().st_size if path.exists() else 0
+            if size < offset:
+                offset, line_no, carry = 0, 0, b''
+            grew = size > offset
+            if grew:
+                with path.open('rb') as handle:
+                    handle.seek(offset)
+                    while offset < size:
+                        block = handle.read(min(INDEX_BLOCK, size - offset))
+                        if not block:
+                            break
+                        offset += len(block)
+                        lines = (carry + block).split(b'\n')
+                        carry = lines.pop()
+                        for raw in lines:
+                            line_no += 1
+                            hits += print_line_hits(args, regex, line_no, raw)
+                if over_budget(args, hits):
+                    print(f'max_hits exceeded: hits={hits} max_hits={args.max_hits}')
+                    return 3
+                last_growth = time.monotonic()
+            now = time.monotonic()
+            if now - last_summary >= args.summary_every:
+                print(f'[follow t={now - started:.0f}s lines={line_no}] hits={hits}', flush=True)
+                last_summary = now
+            if args.idle_timeout > 0 and now - last_growth >= args.idle_timeout:
+                break
+            if not grew:
+                time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    if carry:
+        line_no += 1
+        hits += print_line_hits(args, regex, line_no, carry)
+    print(f'hits={hits} lines={line_no}')
+    return 3 if over_budget(args, hits) else 0
+
+
+def parse_record(line, pending):
+    """Turn one logcat line into a record tuple (RECORD_COLUMNS) or None.
+
+    ``pending`` maps thread id -> last request URL so "HTTP FAILED" lines, which carry no URL,
+    are attributed to the request that failed.
+    """
+    match = THREADTIME_RE.match(line) or BRIEF_RE.match(line)
+    if not match:
+        return None
+    ts = match.groupdict().get('ts') or ''
+    level, tag, tid, msg = match['level'], match['tag'], match['tid'], match['msg']
+    method = status = duration = error = None
+    request = REQUEST_RE.match(msg)
+    if request:
+        kind, url, method = 'request', request['url'], request['method']
+        pending[tid] = url
+    elif (response := RESPONSE_RE.match(msg)):
+        kind, url = 'response', response['url']
+        status, duration = int(response['status']), int(response['ms'])
+        pending.pop(tid, None)
+    elif (failed := FAILED_RE.match(msg)):
+        kind, url, error = 'failed', pending.pop(tid, ''), failed['error']
+    else:
+        found = URL_RE.search(msg)
+        if not found or level not in 'WEF' and not ERROR_WORDS_RE.search(msg):
+            return None
+        kind, url = ('error' if level in 'EF' or ERROR_WORDS_RE.search(msg) else 'warning'), found.group(0)
+        error = msg[:500]
+    host = (urlparse(url).hostname or '') if url else ''
+    return (ts, level, tag, kind, method, url, host, status, duration, error)
+
+
+def write_records(path, db_path):
+    """Stream the log into ``records`` (rebuilt on every run) in batches; returns the record count."""
+    conn = sqlite3.connect(db_path)
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS records;
+        CREATE TABLE records (
+            ts TEXT, level TEXT, tag TEXT, kind TEXT, method TEXT, url TEXT, host TEXT,
+            status INTEGER, duration_ms INTEGER, error TEXT
+        );
+        """
+    )
+    pending = {}
+    batch = []
+    total = 0
+    insert = f"INSERT INTO records VALUES ({', '.join('?' * len(RECORD_COLUMNS))})"
+    with path.open('rb') as handle:
+        for raw in handle:
+            record = parse_record(raw.decode(errors='ignore').rstrip('\r\n'), pending)
+            if record is None:
+                continue
+            batch.append(record)
+            if len(batch) >= 5000:
+                conn.executemany(insert, batch)
+                total += len(batch)
+                batch.clear()
+    conn.executemany(insert, batch)
+    total += len(batch)
+    conn.execute('CREATE INDEX records_host ON records (host, kind)')
+    conn.commit()
+    return conn, total
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an ascending list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * pct // 100) - 1))]
+
+
+def summarize_records(conn, top):
+    print(f"{'host':<40} {'req':>6} {'resp':>6} {'err':>5} {'p50':>6} {'p90':>6} {'p99':>6} {'max':>7}")
+    hosts = conn.execute(
+        """
+        SELECT host,
+               SUM(kind = 'request'),
+               SUM(kind = 'response'),
+               SUM(kind IN ('failed', 'error') OR status >= 400)
+        FROM records GROUP BY host ORDER BY 4 DESC, 2 DESC
+        """
+    ).fetchall()
+    for host, requests, responses, errors in hosts:
+        durations = [row[0] for row in conn.execute(
+            'SELECT duration_ms FROM records WHERE host = ? AND duration_ms IS NOT NULL ORDER BY duration_ms', (host,))]
+        cells = [percentile(durations, pct) for pct in (50, 90, 99)] + [durations[-1] if durations else None]
+        print(f"{host or '-':<40} {requests:>6} {responses:>6} {errors:>5} "
+              + ' '.join(f"{'-' if value is None else value:>{width}}" for value, width in zip(cells, (6, 6, 6, 7))))
+    failing = conn.execute(
+        """
+        SELECT url, COUNT(*), MAX(COALESCE(error, status)) FROM records
+        WHERE url != '' AND (kind IN ('failed', 'error') OR status >= 400)
+        GROUP BY url ORDER BY 2 DESC LIMIT ?
+        """,
+        (top,),
+    ).fetchall()
+    if failing:
+        print('\nfailing_urls:')
+        for url, count, last_error in failing:
+            print(f'  {count} {url} {str(last_error)[:120]}')
+    slowest = conn.execute(
+        'SELECT duration_ms, status, url FROM records WHERE duration_ms IS NOT NULL ORDER BY duration_ms DESC LIMIT ?',
+        (top,),
+    ).fetchall()
+    if slowest:
+        print('\nslowest_responses:')
+        for duration, status, url in slowest:
+            print(f'  {duration}ms {status} {url}')
+
+
+def structured(args):
+    path = pathlib.Path(args.log)
+    db_path = pathlib.Path(args.db) if args.db else path.with_name(path.name + '.sqlite')
+    conn, total = write_records(path, db_path)
+    try:
+        print(f'records={total} db={db_path}\n')
+        summarize_records(conn, args.top)
+    finally:
+        conn.close()
+    return 0
+
+
+def main():
+    args = parse_args()
+    try:
+        regex = PatternSet(args.patterns, args.case_sensitive)
+    except re.error as error:
+        print(f'invalid pattern: {error}')
+        return 2
+    if args.follow:
+        return follow(args, regex)
+    if not pathlib.Path(args.log).exists():
+        print(f'Log file not found: {args.log}')
+        return 2
+    if args.structured:
+        return structured(args)
+    hits = search(args, regex)
+    return 3 if over_budget(args, hits) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
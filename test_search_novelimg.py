@@ -0,0 +1,28 @@
+"""Tests for the pattern handling of search_novelimg.py."""
+
+import pytest
+
+import search_novelimg
+
+LOG = 'GET HTTP://cdn/a.jpg foo foo\nnovelimg load failed\nfoo bar Http://x\n'
+
+
+def hits(patterns, case_sensitive=False, merge=True):
+    pattern_set = search_novelimg.PatternSet(patterns, case_sensitive)
+    if not merge:
+        pattern_set.combined = None
+    return [(patterns[index], match.start(), match.group()) for index, match in pattern_set.finditer(LOG)]
+
+
+def test_backreference_and_inline_flags_find_hits():
+    assert hits([r'(foo) \1', '(?i)http']) == [('(?i)http', 4, 'HTTP'), (r'(foo) \1', 21, 'foo foo'), ('(?i)http', 58, 'Http')]
+
+
+@pytest.mark.parametrize('patterns', [['novelimg', '(?i)http', 'fo+'], ['(?P<a>fail)', '(?P<a>foo)'], ['o', 'foo']])
+def test_separate_search_matches_the_alternation(patterns):
+    assert hits(patterns, case_sensitive=True) == hits(patterns, case_sensitive=True, merge=False)
+
+
+def test_named_groups_and_flags_are_merged():
+    assert search_novelimg.PatternSet(['(?P<a>x)', '(?P<a>y)', '(?i)z'], False).combined is not None
+    assert search_novelimg.PatternSet([r'(x)\1', 'y'], False).combined is None
@@ -1,16 +1,54 @@
 #!/usr/bin/env python3
 import argparse
+import base64
+import codecs
+import difflib
+import gzip
+import hashlib
 import html
 import json
+import math
+import os
+import random
 import re
+import socket
+import sqlite3
+import sys
+import threading
 import time
-from dataclasses import asdict, dataclass
+import tracemalloc
+import unicodedata
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator
 from urllib.parse import urlparse
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+REPORT_DIR = Path("build/reports/airforce-diagnostics")
+CACHE_DIR = Path("build/cache/airforce-diagnostics")
+CHAPTER_FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "chapters"
+DEFAULT_XML_SEGMENTS = ["Hello world.", "How are you?"]
+# Offline chapter used by `bench` when neither --chapter-url nor a mock page is given.
+SAMPLE_CHAPTER_SEGMENTS = [
+    "The rain had not stopped for three days, and the old watchtower groaned under the weight of the storm.",
+    "Lin Feng pulled his cloak tighter and stared at the flickering lantern, counting the seconds between thunderclaps.",
+    "\"You should not be here,\" the sect elder said quietly, stepping out of the shadows near the stairwell.",
+    "He bowed, but his fingers never left the hilt of the sword his master had left him before vanishing.",
+    "Somewhere below, the iron gate creaked open, and the smell of wet earth and burning incense drifted upward.",
+    "The magic circle carved into the floor began to glow, faint at first, then bright enough to cast long shadows.",
+    "\"If the seal breaks tonight,\" the elder continued, \"none of us will see the morning sun again.\"",
+    "Lin Feng exhaled slowly, feeling the familiar warmth of qi gathering in his dantian like a second heartbeat.",
+]
 
 
 def now_iso() -> str:
@@ -50,6 +88,50 @@ def parse_retry_seconds(message: str) -> float | None:
         return None
 
 
+def delta_text_len(value: Any) -> int:
+    # Stream deltas carry meaningful leading/trailing whitespace, so plain strings are not stripped.
+    if isinstance(value, str):
+        return len(value)
+    return len(text_from_value(value))
+
+
+def iter_sse_data(lines: Iterable[bytes | str]) -> Iterator[str]:
+    """Yield the joined ``data:`` payload of each server-sent event as it completes."""
+    data_lines: list[str] = []
+    for raw in lines:
+        line = raw.decode("utf-8", errors="replace") if isinstance(raw, bytes) else raw
+        line = line.rstrip("\r")
+        if not line:
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith(":"):
+            continue
+        if line.startswith("data:"):
+            value = line[5:]
+            data_lines.append(value[1:] if value.startswith(" ") else value)
+    if data_lines:
+        yield "\n".join(data_lines)
+
+
+def percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    value = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return round(value, 2)
+
+
+def rate_per_sec(amount: int | None, elapsed_ms: int) -> float | None:
+    if not amount or elapsed_ms <= 0:
+        return None
+    return round(amount * 1000.0 / elapsed_ms, 2)
+
+
 def strip_html_tags(value: str) -> str:
     without_tags = re.sub(r"<[^>]+>", " ", value)
     without_entities = html.unescape(without_tags)
@@ -57,15 +139,737 @@ def strip_html_tags(value: str) -> str:
     return normalized.strip()
 
 
-def fetch_chapter_segments(chapter_url: str, timeout_sec: int, max_segments: int, max_chars: int) -> tuple[list[str], str]:
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml",
-    }
-    response = requests.get(chapter_url, headers=headers, timeout=timeout_sec)
-    response.raise_for_status()
-    page_html = response.text or ""
+CACHE_MODES = ("off", "read", "write", "readwrite")
+
+
+class ResponseCache:
+    """On-disk, content-addressed cache for chapter pages and chat completions.
+
+    Each entry is ``<sha256>.json`` (status, validators, timestamps) next to ``<sha256>.body``.
+    Hits refresh the entry's mtime, and writes evict the least recently used entries once the
+    cache grows past ``max_bytes``. Entries older than ``ttl_sec`` are reported as stale so
+    callers can revalidate them with ETag / Last-Modified instead of downloading again.
+    """
+
+    def __init__(self, root: Path, mode: str = "off", ttl_sec: float = 86400.0, max_bytes: int = 256 * 1024 * 1024) -> None:
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.root = root
+        self.mode = mode
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self.counters: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        # key -> (last use, bytes of meta + body) and their byte total; read from disk on first use.
+        self._entries: dict[str, tuple[float, int]] | None = None
+        self._total_bytes = 0
+
+    @property
+    def can_read(self) -> bool:
+        return self.mode in ("read", "readwrite")
+
+    @property
+    def can_write(self) -> bool:
+        return self.mode in ("write", "readwrite")
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        canonical = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        folder = self.root / key[:2]
+        return folder / f"{key}.json", folder / f"{key}.body"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key: str) -> tuple[dict[str, Any], Path, bool] | None:
+        """Return ``(meta, body_path, fresh)`` for a readable entry, or ``None`` on a miss."""
+        if not self.can_read:
+            return None
+        meta_path, body_path = self._paths(key)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        if not body_path.exists():
+            self._count("misses")
+            return None
+        fresh = time.time() - float(meta.get("stored_at", 0)) <= self.ttl_sec
+        self._count("hits" if fresh else "stale")
+        now = time.time()
+        with self._lock:
+            if self._entries is not None and key in self._entries:
+                self._entries[key] = (now, self._entries[key][1])
+        for path in (meta_path, body_path):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        return meta, body_path, fresh
+
+    def get_text(self, key: str) -> tuple[dict[str, Any], str] | None:
+        entry = self.get(key)
+        if entry is None:
+            return None
+        meta, body_path, fresh = entry
+        if not fresh:
+            return None
+        try:
+            return meta, body_path.read_text(encoding="utf-8")
+        except OSError:
+            # Evicted (or removed) after get(): a miss after all.
+            with self._lock:
+                self.counters["hits"] -= 1
+                self.counters["misses"] += 1
+            return None
+
+    def temp_body_path(self, key: str) -> Path:
+        _, body_path = self._paths(key)
+        body_path.parent.mkdir(parents=True, exist_ok=True)
+        return body_path.with_suffix(f".body.{threading.get_ident()}.tmp")
+
+    def commit_body(self, key: str, meta: dict[str, Any], tmp_path: Path) -> None:
+        """Move a fully written temporary body into place and store its metadata."""
+        if not self.can_write:
+            return
+        _, body_path = self._paths(key)
+        os.replace(tmp_path, body_path)
+        self.touch(key, meta)
+        self._count("writes")
+        self._account(key)
+
+    def put(self, key: str, meta: dict[str, Any], body: str | bytes) -> None:
+        if not self.can_write:
+            return
+        tmp_path = self.temp_body_path(key)
+        tmp_path.write_bytes(body.encode("utf-8") if isinstance(body, str) else body)
+        self.commit_body(key, meta, tmp_path)
+
+    def touch(self, key: str, meta: dict[str, Any]) -> None:
+        """Rewrite the metadata of an existing entry, restarting its TTL (e.g. after a 304)."""
+        if not self.can_write:
+            return
+        meta_path, _ = self._paths(key)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_meta = meta_path.with_suffix(f".json.{threading.get_ident()}.tmp")
+        tmp_meta.write_text(json.dumps({**meta, "stored_at": time.time()}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_meta, meta_path)
+
+    def revalidated(self, key: str, meta: dict[str, Any]) -> None:
+        self._count("revalidated")
+        self.touch(key, meta)
+        self._account(key)
+
+    def _scan(self) -> None:
+        """Read size and last use of every entry on disk; called once, with ``self._lock`` held."""
+        entries: dict[str, tuple[float, int]] = {}
+        for meta_path in self.root.glob("*/*.json"):
+            body_path = meta_path.with_suffix(".body")
+            try:
+                stat = meta_path.stat()
+                size = stat.st_size + (body_path.stat().st_size if body_path.exists() else 0)
+            except OSError:
+                continue
+            entries[meta_path.stem] = (stat.st_mtime, size)
+        self._entries = entries
+        self._total_bytes = sum(size for _, size in entries.values())
+
+    def _account(self, key: str) -> None:
+        """Add the (re)written entry ``key`` to the running byte total and evict if it went over."""
+        meta_path, body_path = self._paths(key)
+        try:
+            size = meta_path.stat().st_size + (body_path.stat().st_size if body_path.exists() else 0)
+        except OSError:
+            return
+        with self._lock:
+            if self._entries is None:
+                self._scan()
+            assert self._entries is not None
+            _, old_size = self._entries.get(key, (0.0, 0))
+            self._entries[key] = (time.time(), size)
+            self._total_bytes += size - old_size
+            over = self._total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the tracked total fits in ``max_bytes``."""
+        victims: list[str] = []
+        with self._lock:
+            if self._entries is None:
+                self._scan()
+            assert self._entries is not None
+            if self._total_bytes <= self.max_bytes:
+                return
+            for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+                if self._total_bytes <= self.max_bytes:
+                    break
+                del self._entries[key]
+                self._total_bytes -= size
+                victims.append(key)
+            self.counters["evictions"] += len(victims)
+        for key in victims:
+            for path in self._paths(key):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"mode": self.mode, "dir": str(self.root), **{k: self.counters.get(k, 0) for k in ("hits", "misses", "stale", "revalidated", "writes", "evictions")}}
+
+
+# Per-thread phase record of the request currently inside TimedHTTPAdapter.send; connections created
+# while it is set write their DNS / connect / TLS durations into it.
+_phase_local = threading.local()
+
+
+def _elapsed_ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 1)
+
+
+class _TimedConnectionMixin:
+    """Splits urllib3's connection setup into DNS resolution and TCP connect."""
+
+    def _new_conn(self) -> socket.socket:
+        record = getattr(_phase_local, "record", None)
+        if record is None:
+            return super()._new_conn()  # type: ignore[misc]
+        host = self._dns_host  # type: ignore[attr-defined]
+        started = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)  # type: ignore[attr-defined]
+        except OSError:
+            # Let urllib3 resolve again and raise its own NameResolutionError.
+            return super()._new_conn()  # type: ignore[misc]
+        record["dns_ms"] = _elapsed_ms(started)
+        resolved = time.perf_counter()
+        last_exc: Exception | None = None
+        for *_, sockaddr in addresses:
+            self._dns_host = sockaddr[0]
+            try:
+                sock = super()._new_conn()  # type: ignore[misc]
+            except urllib3.exceptions.HTTPError as exc:
+                last_exc = exc
+                continue
+            finally:
+                self._dns_host = host
+            record["connect_ms"] = _elapsed_ms(resolved)
+            record["new_connection"] = True
+            return sock
+        assert last_exc is not None
+        raise last_exc
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    def connect(self) -> None:
+        record = getattr(_phase_local, "record", None)
+        started = time.perf_counter()
+        super().connect()
+        if record is not None and record.get("connect_ms") is not None:
+            record["tls_ms"] = round(max(0.0, _elapsed_ms(started) - record["dns_ms"] - record["connect_ms"]), 1)
+
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """Transport adapter that attaches a phase breakdown to every response and counts pool reuse.
+
+    ``response.phase_timings`` holds ``dns_ms``, ``connect_ms`` and ``tls_ms`` (``None`` when a
+    pooled keep-alive connection was reused), ``ttfb_ms`` (connection ready until response
+    headers, so the phases add up) and ``headers_at``, the wall-clock time the headers arrived,
+    from which callers derive the body download time once they have consumed it.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.pool_stats: dict[str, Counter[str]] = {}
+        self._stats_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+    def _count(self, url: str, new_connection: bool) -> None:
+        host = urlparse(url).netloc
+        with self._stats_lock:
+            stats = self.pool_stats.setdefault(host, Counter())
+            stats["requests"] += 1
+            stats["new_connections" if new_connection else "reused_connections"] += 1
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, **kwargs: Any) -> requests.Response:
+        record: dict[str, Any] = {"dns_ms": None, "connect_ms": None, "tls_ms": None, "new_connection": False}
+        _phase_local.record = record
+        started = time.perf_counter()
+        try:
+            resp = super().send(request, stream=stream, **kwargs)
+        finally:
+            _phase_local.record = None
+        setup_ms = sum(record[name] or 0.0 for name in ("dns_ms", "connect_ms", "tls_ms"))
+        record["ttfb_ms"] = round(max(0.0, _elapsed_ms(started) - setup_ms), 1)
+        record["headers_at"] = time.time()
+        self._count(request.url or "", record["new_connection"])
+        resp.phase_timings = record  # type: ignore[attr-defined]
+        return resp
+
+
+def connection_pool_stats(session: requests.Session) -> dict[str, Any]:
+    """Merge the reuse counters of every :class:`TimedHTTPAdapter` mounted on ``session``."""
+    hosts: dict[str, Counter[str]] = {}
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+        if not isinstance(adapter, TimedHTTPAdapter):
+            continue
+        with adapter._stats_lock:
+            for host, stats in adapter.pool_stats.items():
+                hosts.setdefault(host, Counter()).update(stats)
+    summary: dict[str, Any] = {}
+    for host, stats in sorted(hosts.items()):
+        requests_sent = stats.get("requests", 0)
+        summary[host] = {
+            "requests": requests_sent,
+            "new_connections": stats.get("new_connections", 0),
+            "reused_connections": stats.get("reused_connections", 0),
+            "reuse_rate": round(stats.get("reused_connections", 0) / requests_sent, 4) if requests_sent else None,
+        }
+    return summary
+
+
+CASSETTE_MODES = ("off", "record", "replay", "replay-realtime")
+# Hop-by-hop or body-shape headers that no longer describe the decoded body stored in a cassette.
+CASSETTE_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive", "set-cookie"}
+
+
+class CassetteMiss(requests.ConnectionError):
+    """Raised in replay mode when a request has no recorded interaction."""
+
+
+def cassette_request_key(method: str, url: str, body: str | bytes | None) -> str:
+    """Match on method, path + query and body; the host is ignored so a cassette recorded against
+    the stub or a mirror replays against any ``--base-url``."""
+    parsed = urlparse(url)
+    target = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    raw = body.encode("utf-8") if isinstance(body, str) else (body or b"")
+    return f"{method.upper()} {target} {hashlib.sha256(raw).hexdigest()[:16]}"
+
+
+def encode_cassette_chunk(offset_ms: int, chunk: bytes) -> list[Any]:
+    try:
+        return [offset_ms, chunk.decode("utf-8")]
+    except UnicodeDecodeError:
+        return [offset_ms, base64.b64encode(chunk).decode("ascii"), "b64"]
+
+
+def decode_cassette_chunk(item: list[Any]) -> tuple[int, bytes]:
+    if len(item) > 2 and item[2] == "b64":
+        return int(item[0]), base64.b64decode(item[1])
+    return int(item[0]), str(item[1]).encode("utf-8")
+
+
+class _RecordingBody:
+    """Wraps a urllib3 response body and captures every decoded chunk with its arrival offset."""
+
+    def __init__(self, raw: Any, cassette: "HttpCassette", interaction: dict[str, Any], started: float) -> None:
+        self._raw = raw
+        self._cassette = cassette
+        self._interaction = interaction
+        self._started = started
+        self._done = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._raw, name)
+
+    def _capture(self, chunk: bytes) -> None:
+        if chunk:
+            offset_ms = int((time.time() - self._started) * 1000)
+            self._interaction["chunks"].append(encode_cassette_chunk(offset_ms, chunk))
+
+    def _finish(self, truncated: bool) -> None:
+        if self._done:
+            return
+        self._done = True
+        self._interaction["truncated"] = truncated
+        self._interaction["elapsed_ms"] = int((time.time() - self._started) * 1000)
+        self._cassette.append(self._interaction)
+
+    def stream(self, amt: int | None = None, decode_content: bool | None = None) -> Iterator[bytes]:
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._capture(chunk)
+            yield chunk
+        self._finish(truncated=False)
+
+    def read(self, amt: int | None = None, *args: Any, **kwargs: Any) -> bytes:
+        chunk = self._raw.read(amt, *args, **kwargs)
+        self._capture(chunk)
+        if not chunk or amt is None:
+            self._finish(truncated=False)
+        return chunk
+
+    def close(self) -> None:
+        self._finish(truncated=True)
+        self._raw.close()
+
+
+class _ReplayBody:
+    """File-like body that yields recorded chunks, optionally at their recorded offsets."""
+
+    def __init__(self, chunks: list[tuple[int, bytes]], started: float, realtime: bool) -> None:
+        self._chunks = chunks
+        self._started = started
+        self._realtime = realtime
+        self._position = 0
+
+    def _next(self) -> bytes | None:
+        if self._position >= len(self._chunks):
+            return None
+        offset_ms, chunk = self._chunks[self._position]
+        self._position += 1
+        if self._realtime:
+            delay = self._started + offset_ms / 1000 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return chunk
+
+    def stream(self, amt: int | None = None, decode_content: bool | None = None) -> Iterator[bytes]:
+        while (chunk := self._next()) is not None:
+            yield chunk
+
+    def read(self, amt: int | None = None, *args: Any, **kwargs: Any) -> bytes:
+        parts = []
+        while (chunk := self._next()) is not None:
+            parts.append(chunk)
+            if amt is not None:
+                break
+        return b"".join(parts)
+
+    def close(self) -> None:
+        self._position = len(self._chunks)
+
+    def release_conn(self) -> None:
+        pass
+
+
+class HttpCassette:
+    """Record/replay store for every HTTP exchange of a run, kept as one JSON line per interaction.
+
+    ``record`` passes requests through to the network and appends status, response headers, the
+    decoded body chunks and their arrival offsets (time to headers and to each chunk) to
+    ``path`` (gzip-compressed when it ends in ``.gz``). ``replay`` serves those interactions
+    without touching the network, instantly, and ``replay-realtime`` sleeps for the recorded
+    offsets so latency, TTFT and chunk-gap metrics look like the original run. Interactions are
+    matched by :func:`cassette_request_key`; repeated identical requests are served in recorded
+    order, cycling when a replay sends more of them than were recorded.
+    """
+
+    def __init__(self, path: Path, mode: str = "replay") -> None:
+        if mode not in CASSETTE_MODES or mode == "off":
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.counters: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._interactions: dict[str, list[dict[str, Any]]] = {}
+        self._served: Counter[str] = Counter()
+        if self.replaying:
+            self._load()
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with self._open("wt"):
+                pass
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode in ("replay", "replay-realtime")
+
+    @property
+    def realtime(self) -> bool:
+        return self.mode != "replay"
+
+    def _open(self, mode: str) -> Any:
+        if self.path.suffix == ".gz":
+            return gzip.open(self.path, mode, encoding="utf-8")
+        return self.path.open(mode, encoding="utf-8")
+
+    def _load(self) -> None:
+        with self._open("rt") as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                interaction = json.loads(line)
+                self._interactions.setdefault(interaction["key"], []).append(interaction)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def append(self, interaction: dict[str, Any]) -> None:
+        line = json.dumps(interaction, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            with self._open("at") as handle:
+                handle.write(line + "\n")
+            self.counters["recorded"] += 1
+
+    def lookup(self, key: str) -> dict[str, Any] | None:
+        with self._lock:
+            recorded = self._interactions.get(key)
+            if not recorded:
+                self.counters["misses"] += 1
+                return None
+            index = self._served[key]
+            self._served[key] += 1
+            self.counters["replayed"] += 1
+            return recorded[index % len(recorded)]
+
+    def mount(self, session: requests.Session) -> requests.Session:
+        adapter = CassetteAdapter(self)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def recorded_base_url(self) -> str:
+        """``scheme://host`` of the recorded API requests, so replay reports name the original provider."""
+        urls = [str(i.get("url") or "") for items in self._interactions.values() for i in items]
+        for url in sorted(urls, key=lambda u: "/v1/" not in u):
+            parsed = urlparse(url)
+            if parsed.scheme and parsed.netloc:
+                return f"{parsed.scheme}://{parsed.netloc}"
+        return ""
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "path": str(self.path),
+                "interactions": sum(len(items) for items in self._interactions.values()),
+                **{k: self.counters.get(k, 0) for k in ("recorded", "replayed", "misses")},
+            }
+
+
+class CassetteAdapter(TimedHTTPAdapter):
+    """Transport adapter that records through to the network or replays from an :class:`HttpCassette`."""
+
+    def __init__(self, cassette: HttpCassette) -> None:
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, **kwargs: Any) -> requests.Response:
+        key = cassette_request_key(request.method or "GET", request.url or "", request.body)
+        if self.cassette.replaying:
+            return self._replay(request, key)
+
+        started = time.time()
+        interaction: dict[str, Any] = {
+            "key": key,
+            "method": request.method,
+            "url": request.url,
+            "recorded_at": now_iso(),
+            "chunks": [],
+        }
+        try:
+            resp = super().send(request, stream=True, **kwargs)
+        except requests.RequestException as exc:
+            self.cassette.append({**interaction, "error": f"{type(exc).__name__}: {exc}", "elapsed_ms": int((time.time() - started) * 1000)})
+            raise
+        interaction.update(
+            status=resp.status_code,
+            reason=resp.reason,
+            headers={k: v for k, v in resp.headers.items() if k.lower() not in CASSETTE_DROPPED_HEADERS},
+            ttfb_ms=int((time.time() - started) * 1000),
+            phases={k: resp.phase_timings.get(k) for k in ("dns_ms", "connect_ms", "tls_ms", "new_connection")},  # type: ignore[attr-defined]
+        )
+        resp.raw = _RecordingBody(resp.raw, self.cassette, interaction, started)
+        if not stream:
+            resp.content
+        return resp
+
+    def _replay(self, request: requests.PreparedRequest, key: str) -> requests.Response:
+        started = time.time()
+        perf_started = time.perf_counter()
+        interaction = self.cassette.lookup(key)
+        if interaction is None:
+            raise CassetteMiss(f"No cassette interaction for {key} in {self.cassette.path}", request=request)
+        if self.cassette.realtime:
+            wait_ms = interaction.get("elapsed_ms", 0) if interaction.get("error") else interaction.get("ttfb_ms", 0)
+            time.sleep(max(0, int(wait_ms)) / 1000)
+        if interaction.get("error"):
+            raise requests.ConnectionError(f"Recorded failure: {interaction['error']}", request=request)
+
+        resp = requests.Response()
+        resp.status_code = int(interaction["status"])
+        resp.reason = interaction.get("reason") or ""
+        resp.headers = CaseInsensitiveDict(interaction.get("headers") or {})
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.url = request.url or ""
+        resp.request = request
+        resp.connection = self
+        resp.raw = _ReplayBody(
+            [decode_cassette_chunk(item) for item in interaction.get("chunks") or []],
+            started,
+            self.cassette.realtime,
+        )
+        # No socket is opened on replay; realtime replay reports the connection phases seen while recording.
+        recorded_phases = (interaction.get("phases") or {}) if self.cassette.realtime else {}
+        resp.phase_timings = {  # type: ignore[attr-defined]
+            "dns_ms": recorded_phases.get("dns_ms"),
+            "connect_ms": recorded_phases.get("connect_ms"),
+            "tls_ms": recorded_phases.get("tls_ms"),
+            "new_connection": recorded_phases.get("new_connection"),
+            "ttfb_ms": _elapsed_ms(perf_started),
+            "headers_at": time.time(),
+        }
+        return resp
+
+
+# Tags that implicitly close an open <p> (HTML "p end tag omission" rules, trimmed to what chapter pages use).
+PARAGRAPH_CLOSERS = {
+    "address", "article", "aside", "blockquote", "details", "div", "dl", "fieldset", "figcaption", "figure",
+    "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "main", "nav", "ol", "pre",
+    "section", "table", "ul",
+}
+SKIPPED_CONTENT_TAGS = {"script", "style", "noscript", "template"}
+CHAPTER_READ_CHUNK = 64 * 1024
+
+
+CHAPTER_TOKEN_RE = re.compile(r"<(?:(/?)([A-Za-z][A-Za-z0-9]*)\b[^>]*>|!--.*?-->|[!?][^>]*>)", re.DOTALL)
+
+
+class ChapterSegmentParser:
+    """Incremental ``<p>`` text extractor for chapter pages.
+
+    Fed with HTML chunks of any size; keeps only the unparsed tail of the last chunk, the
+    paragraph currently being read and the accepted segments. Sets ``done`` once
+    ``max_segments`` unique segments are found so callers can stop downloading. ``<p>``
+    elements close implicitly on the next block element as in browsers, and script/style
+    content is skipped. Segment rules match the original regex extractor: at least 30
+    characters, at least one Latin letter, truncated to ``max_chars``.
+    """
+
+    def __init__(self, max_segments: int, max_chars: int) -> None:
+        self.max_segments = max_segments
+        self.max_chars = max_chars
+        self.segments: list[str] = []
+        self.done = max_segments <= 0
+        self._seen: set[str] = set()
+        self._buffer = ""
+        self._skip_until: re.Pattern[str] | None = None
+        self._in_paragraph = False
+        self._parts: list[str] = []
+        self._parts_len = 0
+        self._full = False
 
+    def feed(self, chunk: str) -> None:
+        data = self._buffer + chunk
+        pos = 0
+        end = len(data)
+        while pos < end and not self.done:
+            if self._skip_until is not None:
+                closing = self._skip_until.search(data, pos)
+                if closing is None:
+                    # Only the tail can still start the closing tag.
+                    pos = max(pos, end - 16)
+                    break
+                self._skip_until = None
+                pos = closing.end()
+                continue
+            match = CHAPTER_TOKEN_RE.search(data, pos)
+            if match is None:
+                lt = data.find("<", pos)
+                stop = end if lt < 0 else lt
+                if self._in_paragraph and stop > pos:
+                    self._append(data[pos:stop])
+                pos = stop
+                break
+            if self._in_paragraph and match.start() > pos:
+                self._append(data[pos : match.start()])
+            pos = match.end()
+            name = match.group(2)
+            if name is not None:
+                self._handle_tag(name.lower(), bool(match.group(1)))
+        self._buffer = data[pos:] if not self.done else ""
+
+    def _handle_tag(self, tag: str, closing: bool) -> None:
+        if tag in SKIPPED_CONTENT_TAGS:
+            if not closing:
+                self._skip_until = re.compile(rf"</{tag}\s*>", re.IGNORECASE)
+            return
+        if tag == "p":
+            self._close_paragraph()
+            if not closing:
+                self._in_paragraph = True
+                self._parts = []
+                self._parts_len = 0
+                self._full = False
+        elif tag in PARAGRAPH_CLOSERS or (closing and tag in ("body", "html", "td", "li")):
+            self._close_paragraph()
+        elif self._in_paragraph:
+            self._append(" ")
+
+    def _append(self, text: str) -> None:
+        if self._full:
+            return
+        self._parts.append(text)
+        self._parts_len += len(text)
+        limit = max(self.max_chars, 30) + 1
+        if self._parts_len > 4 * limit:
+            # Collapse early so a huge paragraph never grows past a few times max_chars.
+            collapsed = " ".join(html.unescape("".join(self._parts)).split())
+            self._parts = [collapsed]
+            self._parts_len = len(collapsed)
+            self._full = len(collapsed) >= limit
+
+    def _close_paragraph(self) -> None:
+        if not self._in_paragraph:
+            return
+        self._in_paragraph = False
+        text = " ".join(html.unescape("".join(self._parts)).split())
+        self._parts = []
+        if self.done or len(text) < 30 or not re.search(r"[A-Za-z]", text):
+            return
+        text = text[: self.max_chars].strip()
+        if not text or text in self._seen:
+            return
+        self._seen.add(text)
+        self.segments.append(text)
+        if len(self.segments) >= self.max_segments:
+            self.done = True
+
+    def close(self) -> None:
+        if self._in_paragraph and self._buffer and self._skip_until is None:
+            self._append(self._buffer)
+        self._buffer = ""
+        self._close_paragraph()
+
+
+def extract_chapter_segments(chunks: Iterable[str], max_segments: int, max_chars: int) -> tuple[list[str], int]:
+    """Extract segments from HTML text chunks; returns the segments and the characters consumed."""
+    parser = ChapterSegmentParser(max_segments=max_segments, max_chars=max_chars)
+    consumed = 0
+    for chunk in chunks:
+        consumed += len(chunk)
+        parser.feed(chunk)
+        if parser.done:
+            break
+    else:
+        parser.close()
+    return parser.segments, consumed
+
+
+def extract_segments_legacy(page_html: str, max_segments: int, max_chars: int) -> list[str]:
+    """Original whole-page regex extractor, kept as the baseline for ``bench-extract``."""
     chunks = re.findall(r"<p[^>]*>(.*?)</p>", page_html, flags=re.IGNORECASE | re.DOTALL)
     candidates: list[str] = []
     for chunk in chunks:
@@ -88,8 +892,120 @@ def fetch_chapter_segments(chapter_url: str, timeout_sec: int, max_segments: int
         segments.append(item)
         if len(segments) >= max_segments:
             break
+    return segments
+
+
+def iter_decoded(byte_chunks: Iterable[bytes], encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_file_chunks(path: Path, chunk_size: int = CHAPTER_READ_CHUNK) -> Iterator[bytes]:
+    with path.open("rb") as handle:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
 
-    return segments, page_html
+
+def read_chapter_file_segments(path: Path, max_segments: int, max_chars: int, encoding: str = "utf-8") -> tuple[list[str], int]:
+    """Stream a saved chapter page from disk; returns the segments and the bytes read."""
+    bytes_read = 0
+
+    def counted() -> Iterator[bytes]:
+        nonlocal bytes_read
+        for chunk in iter_file_chunks(path):
+            bytes_read += len(chunk)
+            yield chunk
+
+    segments, _ = extract_chapter_segments(iter_decoded(counted(), encoding), max_segments, max_chars)
+    return segments, bytes_read
+
+
+def fetch_chapter_segments(
+    chapter_url: str,
+    timeout_sec: int,
+    max_segments: int,
+    max_chars: int,
+    cache: ResponseCache | None = None,
+    session: requests.Session | None = None,
+) -> tuple[list[str], int]:
+    """Stream a chapter page and extract up to ``max_segments`` segments; returns them with the HTML bytes read.
+
+    The download stops as soon as enough segments are found, unless the page is being written
+    to the cache, in which case the rest of the body is copied to disk without being parsed.
+    Pass a ``session`` (e.g. one with an :class:`HttpCassette` mounted) to control the transport.
+    """
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36",
+        "Accept": "text/html,application/xhtml+xml",
+    }
+    cache_key = ResponseCache.key("GET", chapter_url)
+    entry = cache.get(cache_key) if cache is not None else None
+    if entry is not None:
+        meta, body_path, fresh = entry
+        if fresh:
+            # Decode as the network path did; entries written before "encoding" was stored were UTF-8.
+            return read_chapter_file_segments(body_path, max_segments, max_chars, meta.get("encoding") or "utf-8")
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    http = session if session is not None else requests
+    with http.get(chapter_url, headers=headers, timeout=timeout_sec, stream=True) as response:
+        if response.status_code == 304 and entry is not None and cache is not None:
+            meta, body_path, _ = entry
+            cache.revalidated(cache_key, meta)
+            return read_chapter_file_segments(body_path, max_segments, max_chars, meta.get("encoding") or "utf-8")
+        response.raise_for_status()
+
+        tmp_path = cache.temp_body_path(cache_key) if cache is not None and cache.can_write else None
+        sink = tmp_path.open("wb") if tmp_path is not None else None
+        bytes_read = 0
+
+        def body_chunks() -> Iterator[bytes]:
+            nonlocal bytes_read
+            for chunk in response.iter_content(CHAPTER_READ_CHUNK):
+                bytes_read += len(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                yield chunk
+
+        encoding = response.encoding or "utf-8"
+        try:
+            chunks = body_chunks()
+            segments, _ = extract_chapter_segments(iter_decoded(chunks, encoding), max_segments, max_chars)
+            if sink is not None and cache is not None and tmp_path is not None:
+                for _ in chunks:
+                    pass
+                sink.close()
+                cache.commit_body(
+                    cache_key,
+                    {
+                        "kind": "chapter",
+                        "url": chapter_url,
+                        "status": response.status_code,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "encoding": encoding,
+                    },
+                    tmp_path,
+                )
+        finally:
+            if sink is not None:
+                sink.close()
+            if tmp_path is not None and tmp_path.exists():
+                tmp_path.unlink()
+
+    return segments, bytes_read
 
 
 def build_classic_system_prompt() -> str:
@@ -113,134 +1029,1259 @@ def build_classic_system_prompt() -> str:
     )
 
 
-def build_airforce_user_prompt(source_lang: str, target_lang: str, tagged_input: str) -> str:
+def build_airforce_instruction_block(source_lang: str, target_lang: str) -> str:
+    """The fixed part of the Airforce user prompt; identical for every request of a language pair."""
     return (
         f"TRANSLATE from {source_lang} to {target_lang}.\n"
         "Inject soul into the text. Make the reader believe this was written by a Russian author.\n\n"
         "Use popular genre terminology (Magic -> Магия, etc.). Make it sound like high-quality fiction.\n\n"
         "1. Keep the XML structure exactly as is (<s i='...'>...</s>).\n"
         "2. NO PREAMBLE. NO ANALYSIS TEXT. NO MARKDOWN HEADERS.\n"
-        "3. Start your response IMMEDIATELY with the first XML tag.\n\n"
-        "INPUT BLOCK:\n"
-        f"{tagged_input}"
+        "3. Start your response IMMEDIATELY with the first XML tag."
     )
 
 
+def build_airforce_user_prompt(source_lang: str, target_lang: str, tagged_input: str) -> str:
+    return f"{build_airforce_instruction_block(source_lang, target_lang)}\n\nINPUT BLOCK:\n{tagged_input}"
+
+
 def to_tagged_input(segments: list[str]) -> str:
     lines = [f"<s i='{index}'>{text}</s>" for index, text in enumerate(segments)]
     return "\n".join(lines)
 
 
-def run_preflight(base_url: str, api_key: str, models: list[str], timeout_sec: int, retries: int, min_spacing: float) -> tuple[bool, list[str]]:
-    issues: list[str] = []
-    warnings: list[str] = []
+def build_xml_translate_messages(source_lang: str, target_lang: str, segments: list[str]) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": build_classic_system_prompt()},
+        {
+            "role": "user",
+            "content": build_airforce_user_prompt(
+                source_lang=source_lang,
+                target_lang=target_lang,
+                tagged_input=to_tagged_input(segments),
+            ),
+        },
+    ]
 
-    parsed = urlparse(base_url)
-    if parsed.scheme not in ("http", "https") or not parsed.netloc:
-        issues.append(f"Invalid base URL: {base_url}")
 
-    if not api_key or len(api_key.strip()) < 20:
-        issues.append("API key is empty or too short")
-    elif not api_key.startswith("sk-"):
-        warnings.append("API key does not start with 'sk-'")
+def build_prefix_padding(pad_tokens: int) -> str:
+    """Static reference notes of roughly ``pad_tokens`` heuristic tokens.
 
-    if not models:
-        issues.append("Models list is empty")
-    else:
-        empty_models = [m for m in models if not m or not m.strip()]
-        if empty_models:
-            issues.append("Models list contains empty value")
+    Only used by the prompt-cache experiment to lengthen the cacheable prefix (many providers
+    cache nothing below ~1024 prompt tokens); real prompts would put a glossary here instead.
+    """
+    if pad_tokens <= 0:
+        return ""
+    lines = ["### REFERENCE NOTES"]
+    while heuristic_token_count("\n".join(lines)) < pad_tokens:
+        lines.append(f"{len(lines):04d}. Keep names, terms and honorifics consistent with earlier chapters.")
+    return "\n".join(lines)
 
-    if timeout_sec <= 0:
-        issues.append("timeout-sec must be > 0")
-    if retries <= 0:
-        issues.append("retries must be > 0")
-    if min_spacing < 0:
-        issues.append("min-spacing must be >= 0")
 
-    return len(issues) == 0, issues + warnings
+def build_layout_messages(
+    layout: str, source_lang: str, target_lang: str, segments: list[str], pad_tokens: int = 0, salt: str = ""
+) -> list[dict[str, str]]:
+    """Chat messages for one ``PROMPT_LAYOUTS`` entry.
 
+    ``current`` is :func:`build_xml_translate_messages`; ``input-first`` puts the tagged input
+    ahead of the instruction block, so only the system prompt is a shared prefix; ``static-system``
+    moves the instruction block into the system message and leaves only the input in the user turn.
+    ``pad_tokens`` appends :func:`build_prefix_padding` to the system message and ``salt`` prefixes
+    it, so experiment runs never share a provider cache entry.
+    """
+    system = build_classic_system_prompt()
+    instructions = build_airforce_instruction_block(source_lang, target_lang)
+    tagged_input = to_tagged_input(segments)
+    if layout == "current":
+        user = build_airforce_user_prompt(source_lang, target_lang, tagged_input)
+    elif layout == "input-first":
+        user = f"INPUT BLOCK:\n{tagged_input}\n\n{instructions}"
+    elif layout == "static-system":
+        system = f"{system}\n\n{instructions}"
+        user = f"INPUT BLOCK:\n{tagged_input}"
+    else:
+        raise ValueError(f"Unknown prompt layout: {layout}")
+    padding = build_prefix_padding(pad_tokens)
+    if padding:
+        system = f"{system}\n\n{padding}"
+    if salt:
+        system = f"[{salt}]\n{system}"
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
 
-@dataclass
-class ProbeResult:
-    success: bool
-    model: str
-    prompt: str
-    elapsed_ms: int
-    http_status: int | None = None
-    finish_reason: str = ""
-    prompt_tokens: int | None = None
-    completion_tokens: int | None = None
-    total_tokens: int | None = None
-    message_content_len: int = 0
-    choice_text_len: int = 0
-    output_text_len: int = 0
-    reasoning_len: int = 0
-    tool_calls_len: int = 0
-    error: str = ""
-    error_body: str = ""
-    body_raw: str = ""
 
+PROMPT_LAYOUTS = ("current", "input-first", "static-system")
 
-class AirforceDiagnoser:
-    def __init__(self, base_url: str, api_key: str, timeout_sec: int, retries: int, min_spacing: float) -> None:
-        self.base_url = base_url.rstrip("/")
-        self.timeout_sec = timeout_sec
-        self.retries = retries
-        self.min_spacing = min_spacing
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            }
-        )
-        self._last_call_ts = 0.0
 
-    def _respect_spacing(self) -> None:
-        elapsed = time.time() - self._last_call_ts
-        wait = self.min_spacing - elapsed
-        if wait > 0:
-            time.sleep(wait)
+def shared_message_prefix(variants: list[list[dict[str, str]]]) -> str:
+    """The text every message list starts with, serialized role by role; what a prefix cache can reuse."""
+    return os.path.commonprefix(["".join(f"{m.get('role')}\n{m.get('content')}\n" for m in messages) for messages in variants])
 
-    def _request_json(self, method: str, path: str, payload: dict[str, Any] | None = None) -> tuple[int, str]:
-        url = f"{self.base_url}{path}"
-        last_exc: Exception | None = None
-        for attempt in range(1, self.retries + 1):
-            self._respect_spacing()
-            started = time.time()
-            try:
-                if method == "GET":
-                    resp = self.session.get(url, timeout=self.timeout_sec)
-                else:
-                    resp = self.session.post(url, data=json.dumps(payload or {}), timeout=self.timeout_sec)
-                self._last_call_ts = time.time()
 
-                body_text = resp.text or ""
-                if resp.status_code == 429 and attempt < self.retries:
-                    retry_s = None
-                    try:
-                        err = resp.json().get("error", {})
-                        retry_s = parse_retry_seconds(str(err.get("message", "")))
-                    except Exception:
-                        retry_s = None
-                    sleep_for = max(self.min_spacing, (retry_s or 1.0) + 0.3)
-                    print(f"429 rate-limit on {path} attempt={attempt}, sleeping {sleep_for:.2f}s")
-                    time.sleep(sleep_for)
-                    continue
+TOKEN_CALIBRATION_PATH = REPORT_DIR / "token-calibration.json"
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+_WORD_CHAR_RE = re.compile(r"[^\WЀ-ӿ぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+_SYMBOL_RE = re.compile(r"[^\w\s]")
+# Chars per token for the uncalibrated heuristic, per script (BPE vocabularies of current chat models).
+HEURISTIC_CHARS_PER_TOKEN = {"latin": 4.0, "cyrillic": 2.6, "cjk": 1.1, "symbol": 1.6}
+# Chat-format framing per message (role markers, separators) and per request (reply priming).
+MESSAGE_OVERHEAD_TOKENS = 4
+REQUEST_OVERHEAD_TOKENS = 3
 
-                return resp.status_code, body_text
-            except Exception as exc:
-                self._last_call_ts = time.time()
-                last_exc = exc
-                if attempt < self.retries:
-                    time.sleep(max(self.min_spacing, 1.0) + attempt * 0.5)
-                    continue
-                raise RuntimeError(f"{method} {path} failed after {self.retries} attempts: {exc}") from exc
-            finally:
-                _ = started
 
-        raise RuntimeError(f"{method} {path} failed: {last_exc}")
+def heuristic_token_count(text: str) -> float:
+    if not text:
+        return 0.0
+    return (
+        len(_WORD_CHAR_RE.findall(text)) / HEURISTIC_CHARS_PER_TOKEN["latin"]
+        + len(_CYRILLIC_RE.findall(text)) / HEURISTIC_CHARS_PER_TOKEN["cyrillic"]
+        + len(_CJK_RE.findall(text)) / HEURISTIC_CHARS_PER_TOKEN["cjk"]
+        + len(_SYMBOL_RE.findall(text)) / HEURISTIC_CHARS_PER_TOKEN["symbol"]
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    return int(math.ceil(heuristic_token_count(text)))
+
+
+def tiktoken_counter(encoding_name: str) -> Callable[[str], int] | None:
+    try:
+        import tiktoken  # type: ignore[import-not-found]
+    except ImportError:
+        return None
+    encoding = tiktoken.get_encoding(encoding_name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class TokenEstimator:
+    """Local prompt/completion token estimates without a provider round trip.
+
+    ``tokenizers`` maps a model-name prefix to an exact counter (longest prefix wins); models
+    without one fall back to the script-aware heuristic. Both are multiplied by a per-model
+    scale learned from the ``usage`` fields of earlier probes, and completion sizes use a learned
+    output chars-per-token figure.
+    """
+
+    def __init__(self, tokenizers: dict[str, Callable[[str], int]] | None = None) -> None:
+        self.tokenizers: dict[str, Callable[[str], int]] = dict(tokenizers or {})
+        self.prompt_scale: dict[str, float] = {}
+        self.output_chars_per_token: dict[str, float] = {}
+        self.samples: dict[str, int] = {}
+
+    def register(self, model_prefix: str, counter: Callable[[str], int]) -> None:
+        self.tokenizers[model_prefix] = counter
+
+    def _counter(self, model: str) -> Callable[[str], int] | None:
+        matches = [prefix for prefix in self.tokenizers if model.startswith(prefix)]
+        return self.tokenizers[max(matches, key=len)] if matches else None
+
+    def raw_count(self, text: str, model: str = "") -> float:
+        counter = self._counter(model)
+        return float(counter(text)) if counter is not None else heuristic_token_count(text)
+
+    def raw_messages(self, messages: list[dict[str, str]], model: str = "") -> float:
+        total = float(REQUEST_OVERHEAD_TOKENS)
+        for message in messages:
+            total += MESSAGE_OVERHEAD_TOKENS + self.raw_count(str(message.get("content") or ""), model)
+        return total
+
+    def count(self, text: str, model: str = "") -> int:
+        return int(math.ceil(self.raw_count(text, model) * self.prompt_scale.get(model, 1.0)))
+
+    def count_messages(self, messages: list[dict[str, str]], model: str = "") -> int:
+        return int(math.ceil(self.raw_messages(messages, model) * self.prompt_scale.get(model, 1.0)))
+
+    def predict_completion(self, source_chars: int, model: str = "", length_ratio: float = 1.15) -> int:
+        """Completion tokens for translating ``source_chars`` characters (tags included)."""
+        chars_per_token = self.output_chars_per_token.get(model, HEURISTIC_CHARS_PER_TOKEN["cyrillic"])
+        return int(math.ceil(source_chars * length_ratio / chars_per_token))
+
+    def calibrate(self, results: Iterable[dict[str, Any]]) -> None:
+        """Fit per-model scales from report ``results`` that carry both an estimate and provider usage."""
+        estimated: Counter[str] = Counter()
+        actual: Counter[str] = Counter()
+        output_chars: Counter[str] = Counter()
+        output_tokens: Counter[str] = Counter()
+        for r in results:
+            model = str(r.get("model") or "")
+            if not r.get("success") or r.get("cached"):
+                continue
+            if r.get("prompt_tokens") and r.get("prompt_tokens_estimate"):
+                estimated[model] += float(r["prompt_tokens_estimate"])
+                actual[model] += int(r["prompt_tokens"])
+                self.samples[model] = self.samples.get(model, 0) + 1
+            chars = int(r.get("message_content_len") or 0) + int(r.get("reasoning_len") or 0)
+            if r.get("completion_tokens") and chars and r.get("finish_reason") != "length":
+                output_chars[model] += chars
+                output_tokens[model] += int(r["completion_tokens"])
+        for model, value in estimated.items():
+            if value > 0:
+                self.prompt_scale[model] = round(actual[model] / value, 4)
+        for model, tokens in output_tokens.items():
+            if tokens > 0:
+                self.output_chars_per_token[model] = round(output_chars[model] / tokens, 4)
+
+    def calibrate_from_reports(self, paths: Iterable[Path]) -> int:
+        results: list[dict[str, Any]] = []
+        for path in paths:
+            try:
+                results.extend(json.loads(path.read_text(encoding="utf-8")).get("results") or [])
+            except (OSError, ValueError):
+                continue
+        self.calibrate(results)
+        return len(results)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "prompt_scale": self.prompt_scale,
+            "output_chars_per_token": self.output_chars_per_token,
+            "samples": self.samples,
+            "tokenizers": sorted(self.tokenizers),
+        }
+
+    def load(self, path: Path) -> bool:
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+        self.prompt_scale.update(data.get("prompt_scale") or {})
+        self.output_chars_per_token.update(data.get("output_chars_per_token") or {})
+        self.samples.update(data.get("samples") or {})
+        return True
+
+
+def build_token_estimator(tokenizer_specs: list[str], calibration_path: Path | None = TOKEN_CALIBRATION_PATH) -> TokenEstimator:
+    """Create an estimator from ``prefix=tiktoken:<encoding>`` specs plus the saved calibration."""
+    estimator = TokenEstimator()
+    for spec in tokenizer_specs:
+        prefix, _, target = spec.partition("=")
+        kind, _, name = target.partition(":")
+        counter = tiktoken_counter(name) if kind == "tiktoken" else None
+        if counter is None:
+            print(f"tokenizer {spec!r} unavailable, using heuristic for {prefix!r}")
+            continue
+        estimator.register(prefix, counter)
+    if calibration_path is not None:
+        estimator.load(calibration_path)
+    return estimator
+
+
+@dataclass
+class PackedPrompt:
+    chapters: list[int]
+    segment_count: int
+    source_chars: int
+    source_tokens: int
+    prompt_tokens: int
+    completion_tokens_estimate: int = 0
+    oversized: bool = False
+    length_risk: bool = False
+
+
+def load_chapter_segments(
+    source: str,
+    timeout_sec: int,
+    max_segments: int,
+    max_chars: int,
+    cache: ResponseCache | None = None,
+    session: requests.Session | None = None,
+) -> tuple[list[str], int]:
+    """Extract segments from a chapter URL or a saved HTML file."""
+    if urlparse(source).scheme in ("http", "https"):
+        return fetch_chapter_segments(
+            source, timeout_sec=timeout_sec, max_segments=max_segments, max_chars=max_chars, cache=cache, session=session
+        )
+    return read_chapter_file_segments(Path(source), max_segments=max_segments, max_chars=max_chars)
+
+
+def pack_segments(
+    chapters: list[list[str]],
+    token_budget: int,
+    source_lang: str,
+    target_lang: str,
+    cross_chapter: bool = False,
+    estimator: TokenEstimator | None = None,
+    model: str = "",
+    max_tokens: int = 0,
+    length_ratio: float = 1.15,
+) -> list[PackedPrompt]:
+    """Greedily pack segments, in order, into translation requests that fit ``token_budget`` prompt tokens.
+
+    Segment costs are summed incrementally from their tagged lines; each finished request is then
+    re-measured from the real ``build_xml_translate_messages`` output and given a completion
+    prediction. A segment that alone exceeds the budget is sent on its own and flagged
+    ``oversized``; a request whose predicted completion exceeds ``max_tokens`` is flagged
+    ``length_risk`` (it would likely end with ``finish_reason == "length"``).
+    """
+    estimator = estimator or TokenEstimator()
+    overhead = estimator.count_messages(build_xml_translate_messages(source_lang, target_lang, []), model)
+    packed: list[PackedPrompt] = []
+    batch: list[str] = []
+    batch_chapters: list[int] = []
+    batch_tokens = overhead
+
+    def flush() -> None:
+        nonlocal batch, batch_chapters, batch_tokens
+        if not batch:
+            return
+        prompt_tokens = estimator.count_messages(build_xml_translate_messages(source_lang, target_lang, batch), model)
+        completion = estimator.predict_completion(len(to_tagged_input(batch)), model, length_ratio)
+        packed.append(
+            PackedPrompt(
+                chapters=batch_chapters,
+                segment_count=len(batch),
+                source_chars=sum(len(s) for s in batch),
+                source_tokens=sum(estimator.count(s, model) for s in batch),
+                prompt_tokens=prompt_tokens,
+                completion_tokens_estimate=completion,
+                oversized=prompt_tokens > token_budget,
+                length_risk=max_tokens > 0 and completion > max_tokens,
+            )
+        )
+        batch, batch_chapters, batch_tokens = [], [], overhead
+
+    for chapter_index, segments in enumerate(chapters):
+        if not cross_chapter:
+            flush()
+        for segment in segments:
+            line_tokens = estimator.count(f"<s i='{len(batch)}'>{segment}</s>\n", model)
+            if batch and batch_tokens + line_tokens > token_budget:
+                flush()
+                line_tokens = estimator.count(f"<s i='0'>{segment}</s>\n", model)
+            batch.append(segment)
+            if not batch_chapters or batch_chapters[-1] != chapter_index:
+                batch_chapters.append(chapter_index)
+            batch_tokens += line_tokens
+    flush()
+    return packed
+
+
+def summarize_packing(packed: list[PackedPrompt], token_budget: int) -> dict[str, Any]:
+    prompt_tokens = sum(p.prompt_tokens for p in packed)
+    source_tokens = sum(p.source_tokens for p in packed)
+    completion_tokens = sum(p.completion_tokens_estimate for p in packed)
+    return {
+        "token_budget": token_budget,
+        "requests": len(packed),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens_estimate": completion_tokens,
+        "total_tokens_estimate": prompt_tokens + completion_tokens,
+        "overhead_tokens": prompt_tokens - source_tokens,
+        "mean_fill": round(prompt_tokens / (len(packed) * token_budget), 3) if packed else 0.0,
+        "oversized_requests": sum(1 for p in packed if p.oversized),
+        "requests_over_max_tokens": sum(1 for p in packed if p.length_risk),
+        "max_segments_per_request": max((p.segment_count for p in packed), default=0),
+        "length_risk_batches": [
+            {"index": i, "chapters": p.chapters, "segments": p.segment_count, "completion_tokens_estimate": p.completion_tokens_estimate}
+            for i, p in enumerate(packed)
+            if p.length_risk
+        ],
+    }
+
+
+XML_SEGMENT_TOKEN_RE = re.compile(r"<s\s+i\s*=\s*['\"]?(\d+)['\"]?\s*>|</s\s*>", re.IGNORECASE)
+# Target/source length ratios outside this band usually mean a dropped or hallucinated segment.
+XML_LENGTH_RATIO_BAND = (0.3, 3.0)
+
+
+class XmlSegmentValidator:
+    """Streaming checker for ``<s i='N'>...</s>`` translation output.
+
+    ``feed`` accepts the response text in arbitrary pieces (SSE deltas or a whole message);
+    only the currently open segment and an unparsed tail of at most one tag are buffered.
+    ``close`` compares what was returned with the ``source_lengths`` that ``to_tagged_input``
+    sent: missing, duplicated, out-of-range and reordered indexes, unclosed (truncated) tags,
+    text outside tags and per-segment target/source length ratios.
+    """
+
+    def __init__(self, source_lengths: list[int], keep_text: bool = False) -> None:
+        self.source_lengths = source_lengths
+        # With keep_text the accepted segment texts are kept by index (for the translation memory).
+        self.texts: dict[int, str] | None = {} if keep_text else None
+        self._buffer = ""
+        self._open_index: int | None = None
+        self._open_parts: list[str] = []
+        self._lengths: dict[int, int] = {}
+        self._order: list[int] = []
+        self.duplicated: list[int] = []
+        self.unexpected: list[int] = []
+        self.truncated: list[int] = []
+        self.stray_chars = 0
+
+    def feed(self, text: str) -> None:
+        data = self._buffer + text
+        pos = 0
+        for match in XML_SEGMENT_TOKEN_RE.finditer(data):
+            self._text(data[pos : match.start()])
+            pos = match.end()
+            if match.group(1) is not None:
+                if self._open_index is not None:
+                    self.truncated.append(self._open_index)
+                self._open_index = int(match.group(1))
+                self._open_parts = []
+            elif self._open_index is not None:
+                self._finish(self._open_index, "".join(self._open_parts).strip())
+                self._open_index = None
+                self._open_parts = []
+        tail = data[pos:]
+        lt = tail.rfind("<")
+        if lt >= 0 and ">" not in tail[lt:] and len(tail) - lt < 64:
+            self._text(tail[:lt])
+            self._buffer = tail[lt:]
+        else:
+            self._text(tail)
+            self._buffer = ""
+
+    def _text(self, text: str) -> None:
+        if not text:
+            return
+        if self._open_index is not None:
+            self._open_parts.append(text)
+        else:
+            self.stray_chars += len(text.strip())
+
+    def _finish(self, index: int, text: str) -> None:
+        if not 0 <= index < len(self.source_lengths):
+            self.unexpected.append(index)
+            return
+        if index in self._lengths:
+            self.duplicated.append(index)
+            return
+        self._lengths[index] = len(text)
+        self._order.append(index)
+        if self.texts is not None and text:
+            self.texts[index] = text
+
+    def close(self) -> dict[str, Any]:
+        self._text(self._buffer)
+        self._buffer = ""
+        if self._open_index is not None:
+            self.truncated.append(self._open_index)
+            self._open_index = None
+        reordered = sum(1 for a, b in zip(self._order, self._order[1:]) if b < a)
+        ratios = [
+            self._lengths[i] / self.source_lengths[i]
+            for i in self._order
+            if self.source_lengths[i] > 0
+        ]
+        low, high = XML_LENGTH_RATIO_BAND
+        empty = sum(1 for length in self._lengths.values() if length == 0)
+        missing = [i for i in range(len(self.source_lengths)) if i not in self._lengths]
+        valid = len(self._lengths) - empty
+        return {
+            "expected_segments": len(self.source_lengths),
+            "returned_segments": len(self._order) + len(self.duplicated) + len(self.unexpected),
+            "valid_segments": valid,
+            "missing": missing,
+            "duplicated": self.duplicated,
+            "unexpected": self.unexpected,
+            "reordered": reordered,
+            "truncated": self.truncated,
+            "empty_segments": empty,
+            "stray_chars": self.stray_chars,
+            "length_ratio": {
+                "min": round(min(ratios), 3) if ratios else None,
+                "p50": percentile(ratios, 50),
+                "max": round(max(ratios), 3) if ratios else None,
+                "outliers": sum(1 for r in ratios if not low <= r <= high),
+            },
+            "complete": not missing and not self.duplicated and not self.unexpected and not self.truncated and empty == 0,
+        }
+
+
+def validate_xml_response(text: str, source_lengths: list[int]) -> dict[str, Any]:
+    validator = XmlSegmentValidator(source_lengths)
+    validator.feed(text)
+    return validator.close()
+
+
+TM_DB_PATH = CACHE_DIR / "translation-memory.sqlite"
+TM_NUM_PERM = 64
+TM_BANDS = 16
+_TM_PRIME = (1 << 61) - 1
+# Fixed seed: signatures are stored in the database and must not change between runs.
+_TM_RANDOM = random.Random(0x7A11)
+_TM_PERMUTATIONS = [(_TM_RANDOM.randrange(1, _TM_PRIME), _TM_RANDOM.randrange(0, _TM_PRIME)) for _ in range(TM_NUM_PERM)]
+_TM_WORD_RE = re.compile(r"\w+")
+_TM_DIGITS_RE = re.compile(r"\d+")
+_TM_PUNCT = str.maketrans({"“": '"', "”": '"', "„": '"', "«": '"', "»": '"', "‘": "'", "’": "'", "–": "-", "—": "-", "…": "..."})
+
+
+def normalize_segment(text: str) -> str:
+    """Translation-memory key text: NFKC, unified quotes / dashes / ellipses and collapsed whitespace."""
+    return " ".join(unicodedata.normalize("NFKC", text).translate(_TM_PUNCT).split())
+
+
+def segment_shingles(normalized: str) -> set[str]:
+    """Word bigrams of the case-folded text (single words for one-word segments)."""
+    words = _TM_WORD_RE.findall(normalized.casefold())
+    if len(words) < 2:
+        return set(words) or {normalized.casefold()}
+    return {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def minhash_signature(shingles: set[str]) -> list[int]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles]
+    return [min((a * h + b) % _TM_PRIME for h in hashes) for a, b in _TM_PERMUTATIONS]
+
+
+@dataclass
+class TmMatch:
+    kind: str
+    source: str
+    target: str
+    similarity: float = 1.0
+
+
+class TranslationMemory:
+    """SQLite store of per-segment source -> target translations for one language pair.
+
+    Exact lookups hit the normalized-text key. Fuzzy lookups use MinHash LSH over word bigrams
+    (``TM_BANDS`` bands of ``TM_NUM_PERM / TM_BANDS`` rows) to find candidates in a few indexed
+    queries, then accept the best candidate whose character similarity (``difflib`` ratio) is at
+    least ``fuzzy_threshold`` and whose numbers are identical, so "Chapter 12" never matches
+    "Chapter 13". ``fuzzy_threshold <= 0`` disables fuzzy lookups. Fuzzy matches are advisory only:
+    a one-word change ("did" / "did not", "He" / "She") keeps the similarity high, so callers report
+    them as potential savings and still send the segment.
+    """
+
+    def __init__(self, db_path: Path, source_lang: str, target_lang: str, fuzzy_threshold: float = 0.0) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lang_pair = f"{source_lang}->{target_lang}"
+        self.fuzzy_threshold = fuzzy_threshold
+        self.counters: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tm_segments (
+                key TEXT PRIMARY KEY,
+                lang_pair TEXT,
+                source TEXT,
+                target TEXT,
+                model TEXT,
+                created_at TEXT,
+                hits INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS tm_bands (bucket TEXT, key TEXT, PRIMARY KEY (bucket, key)) WITHOUT ROWID;
+            """
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def _key(self, normalized: str) -> str:
+        return hashlib.sha256(f"{self.lang_pair}\0{normalized}".encode("utf-8")).hexdigest()[:32]
+
+    def _buckets(self, normalized: str) -> list[str]:
+        signature = minhash_signature(segment_shingles(normalized))
+        rows = TM_NUM_PERM // TM_BANDS
+        buckets = []
+        for band in range(TM_BANDS):
+            values = ".".join(str(v) for v in signature[band * rows : (band + 1) * rows])
+            buckets.append(hashlib.blake2b(f"{self.lang_pair}|{band}|{values}".encode("ascii"), digest_size=10).hexdigest())
+        return buckets
+
+    def add(self, source: str, target: str, model: str = "") -> None:
+        normalized = normalize_segment(source)
+        if not normalized or not target.strip():
+            return
+        key = self._key(normalized)
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO tm_segments (key, lang_pair, source, target, model, created_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET target = excluded.target, model = excluded.model, created_at = excluded.created_at",
+                (key, self.lang_pair, normalized, target.strip(), model, now_iso()),
+            )
+            self.conn.executemany("INSERT OR IGNORE INTO tm_bands (bucket, key) VALUES (?, ?)", [(b, key) for b in self._buckets(normalized)])
+            self.conn.commit()
+            self.counters["added"] += 1
+
+    def lookup(self, source: str) -> TmMatch | None:
+        normalized = normalize_segment(source)
+        key = self._key(normalized)
+        with self._lock:
+            self.counters["lookups"] += 1
+            row = self.conn.execute("SELECT source, target FROM tm_segments WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.conn.execute("UPDATE tm_segments SET hits = hits + 1 WHERE key = ?", (key,))
+                self.counters["exact"] += 1
+                return TmMatch("exact", row[0], row[1])
+            match = self._fuzzy(normalized) if self.fuzzy_threshold > 0 else None
+            self.counters["fuzzy" if match is not None else "misses"] += 1
+            return match
+
+    def _fuzzy(self, normalized: str) -> TmMatch | None:
+        buckets = self._buckets(normalized)
+        placeholders = ",".join("?" * len(buckets))
+        rows = self.conn.execute(
+            f"SELECT DISTINCT s.source, s.target FROM tm_bands b JOIN tm_segments s ON s.key = b.key WHERE b.bucket IN ({placeholders})",
+            buckets,
+        ).fetchall()
+        digits = _TM_DIGITS_RE.findall(normalized)
+        best: TmMatch | None = None
+        for candidate, target in rows:
+            if _TM_DIGITS_RE.findall(candidate) != digits:
+                continue
+            similarity = difflib.SequenceMatcher(None, normalized, candidate, autojunk=False).ratio()
+            if similarity >= self.fuzzy_threshold and (best is None or similarity > best.similarity):
+                best = TmMatch("fuzzy", candidate, target, round(similarity, 4))
+        return best
+
+    def size(self) -> int:
+        with self._lock:
+            return int(self.conn.execute("SELECT COUNT(*) FROM tm_segments WHERE lang_pair = ?", (self.lang_pair,)).fetchone()[0])
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"lang_pair": self.lang_pair, **{k: self.counters.get(k, 0) for k in ("lookups", "exact", "fuzzy", "misses", "added")}}
+
+
+@dataclass
+class TmChapterPlan:
+    """How a chapter's segments split into translation-memory hits and segments still to send.
+
+    ``matches`` are exact hits that are not sent; ``fuzzy`` segments are still sent and only
+    counted as potential savings.
+    """
+
+    segments: list[str]
+    matches: dict[int, TmMatch]
+    repeats: dict[int, int]
+    unseen: list[str]
+    unseen_index: dict[int, int]
+    fuzzy: dict[int, TmMatch]
+
+    @property
+    def hit_rate(self) -> float:
+        return round((len(self.matches) + len(self.repeats)) / len(self.segments), 4) if self.segments else 0.0
+
+
+def plan_tm_chapter(tm: TranslationMemory, segments: list[str], seen: dict[str, int] | None = None) -> TmChapterPlan:
+    """Look every segment up in ``tm``; segments repeated within the run (``seen``, normalized text ->
+    first position) are sent once, so only the first occurrence of an unknown segment is unseen.
+    Fuzzy matches stay unseen and are recorded in ``fuzzy``."""
+    seen = {} if seen is None else seen
+    matches: dict[int, TmMatch] = {}
+    fuzzy: dict[int, TmMatch] = {}
+    repeats: dict[int, int] = {}
+    unseen: list[str] = []
+    unseen_index: dict[int, int] = {}
+    for index, segment in enumerate(segments):
+        normalized = normalize_segment(segment)
+        if normalized in seen:
+            repeats[index] = seen[normalized]
+            continue
+        match = tm.lookup(segment)
+        if match is not None and match.kind == "exact":
+            matches[index] = match
+            continue
+        if match is not None:
+            fuzzy[index] = match
+        seen[normalized] = index
+        unseen_index[index] = len(unseen)
+        unseen.append(segment)
+    return TmChapterPlan(segments=segments, matches=matches, repeats=repeats, unseen=unseen, unseen_index=unseen_index, fuzzy=fuzzy)
+
+
+def summarize_tm_chapter(
+    plan: TmChapterPlan,
+    estimator: TokenEstimator,
+    model: str,
+    source_lang: str,
+    target_lang: str,
+    length_ratio: float = 1.15,
+) -> dict[str, Any]:
+    """Hit rate and the prompt / completion tokens and requests one chapter saves through the memory.
+
+    ``fuzzy_potential_*`` is what reusing the fuzzy candidates would save on top; it is not saved.
+    """
+
+    def cost(segments: list[str]) -> tuple[int, int]:
+        if not segments:
+            return 0, 0
+        prompt = estimator.count_messages(build_xml_translate_messages(source_lang, target_lang, segments), model)
+        return prompt, estimator.predict_completion(len(to_tagged_input(segments)), model, length_ratio)
+
+    full_prompt, full_completion = cost(plan.segments)
+    tm_prompt, tm_completion = cost(plan.unseen)
+    fuzzy_prompt, fuzzy_completion = cost([plan.unseen[i] for index, i in plan.unseen_index.items() if index not in plan.fuzzy])
+    return {
+        "segments": len(plan.segments),
+        "exact_hits": len(plan.matches),
+        "fuzzy_candidates": len(plan.fuzzy),
+        "repeats": len(plan.repeats),
+        "unseen": len(plan.unseen),
+        "hit_rate": plan.hit_rate,
+        "prompt_tokens_saved": full_prompt - tm_prompt,
+        "completion_tokens_saved": full_completion - tm_completion,
+        "requests_saved": 1 if plan.segments and not plan.unseen else 0,
+        "fuzzy_potential_prompt_tokens": tm_prompt - fuzzy_prompt,
+        "fuzzy_potential_completion_tokens": tm_completion - fuzzy_completion,
+    }
+
+
+def run_preflight(
+    base_url: str,
+    api_key: str,
+    models: list[str],
+    timeout_sec: int,
+    retries: int,
+    min_spacing: float,
+    concurrency: int = 1,
+    max_rate: float = 10.0,
+) -> tuple[bool, list[str]]:
+    issues: list[str] = []
+    warnings: list[str] = []
+
+    parsed = urlparse(base_url)
+    if parsed.scheme not in ("http", "https") or not parsed.netloc:
+        issues.append(f"Invalid base URL: {base_url}")
+
+    if not api_key or len(api_key.strip()) < 20:
+        issues.append("API key is empty or too short")
+    elif not api_key.startswith("sk-"):
+        warnings.append("API key does not start with 'sk-'")
+
+    if not models:
+        issues.append("Models list is empty")
+    else:
+        empty_models = [m for m in models if not m or not m.strip()]
+        if empty_models:
+            issues.append("Models list contains empty value")
+
+    if timeout_sec <= 0:
+        issues.append("timeout-sec must be > 0")
+    if retries <= 0:
+        issues.append("retries must be > 0")
+    if min_spacing < 0:
+        issues.append("min-spacing must be >= 0")
+    if max_rate <= 0:
+        issues.append("max-rate must be > 0")
+    if concurrency <= 0:
+        issues.append("concurrency must be > 0")
+
+    return len(issues) == 0, issues + warnings
+
+
+# Plain numbers above this are Unix timestamps (``X-RateLimit-Reset: 1767225600``), not durations;
+# above the second threshold they are millisecond timestamps.
+EPOCH_SECONDS_THRESHOLD = 1e9
+EPOCH_MILLIS_THRESHOLD = 1e12
+
+
+def parse_duration_seconds(value: str | None) -> float | None:
+    """Parse rate-limit header durations: ``"2"``, ``"1.5s"``, ``"250ms"``, ``"6m0s"``, an HTTP date
+    or a Unix timestamp in seconds / milliseconds."""
+    if value is None:
+        return None
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        pass
+    else:
+        if number > EPOCH_MILLIS_THRESHOLD:
+            number = number / 1000.0 - time.time()
+        elif number > EPOCH_SECONDS_THRESHOLD:
+            number -= time.time()
+        return max(0.0, number)
+    parts = re.findall(r"([0-9]*\.?[0-9]+)\s*(ms|h|m|s)", text, flags=re.IGNORECASE)
+    if parts and "".join(n + u for n, u in parts).replace(" ", "") == text.replace(" ", ""):
+        scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+        return sum(float(n) * scale[u.lower()] for n, u in parts)
+    try:
+        retry_at = parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def header_retry_seconds(headers: Any) -> float | None:
+    if not headers:
+        return None
+    for name in ("Retry-After", "X-RateLimit-Reset-Requests", "X-RateLimit-Reset"):
+        seconds = parse_duration_seconds(headers.get(name))
+        if seconds is not None:
+            return seconds
+    return None
+
+
+def header_remaining_requests(headers: Any) -> int | None:
+    if not headers:
+        return None
+    for name in ("X-RateLimit-Remaining-Requests", "X-RateLimit-Remaining"):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return int(float(value))
+        except ValueError:
+            continue
+    return None
+
+
+@dataclass
+class LimiterState:
+    rate: float
+    tokens: float
+    updated_at: float
+    blocked_until: float = 0.0
+    successes: int = 0
+    throttles: int = 0
+    increases: int = 0
+    decreases: int = 0
+    waited_ms: int = 0
+    min_rate_seen: float = 0.0
+    max_rate_seen: float = 0.0
+
+
+class AdaptiveRateLimiter:
+    """Token-bucket limiter with AIMD rate control, kept per ``(endpoint, model)`` key.
+
+    Every success raises the key's rate additively up to ``max_rate``; every 429 halves it
+    (down to ``min_rate``) and blocks the key until the provider's ``Retry-After`` /
+    ``X-RateLimit-Reset`` hint, the "Try again in N seconds" message or a jittered exponential
+    back-off expires. Provider hints are clamped to ``max_retry_wait`` so one bogus header cannot
+    stall a key indefinitely. Callers reserve tokens under the lock and sleep outside of it, so one
+    limiter can be shared by all probe worker threads.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float,
+        max_rate: float = 10.0,
+        min_rate: float = 0.05,
+        burst: float = 1.0,
+        increase_step: float = 0.1,
+        decrease_factor: float = 0.5,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 30.0,
+        max_retry_wait: float = 120.0,
+        max_events: int = 200,
+    ) -> None:
+        self.max_rate = max(max_rate, min_rate)
+        self.min_rate = min_rate
+        self.initial_rate = min(max(initial_rate, min_rate), self.max_rate)
+        self.burst = max(1.0, burst)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_retry_wait = max_retry_wait
+        self.max_events = max_events
+        self.events: list[dict[str, Any]] = []
+        self._states: dict[str, LimiterState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, key: str, now: float) -> LimiterState:
+        state = self._states.get(key)
+        if state is None:
+            state = LimiterState(
+                rate=self.initial_rate,
+                tokens=self.burst,
+                updated_at=now,
+                min_rate_seen=self.initial_rate,
+                max_rate_seen=self.initial_rate,
+            )
+            self._states[key] = state
+        return state
+
+    def _refill(self, state: LimiterState, now: float) -> None:
+        state.tokens = min(self.burst, state.tokens + (now - state.updated_at) * state.rate)
+        state.updated_at = now
+
+    def _set_rate(self, state: LimiterState, rate: float) -> None:
+        state.rate = min(self.max_rate, max(self.min_rate, rate))
+        state.min_rate_seen = min(state.min_rate_seen, state.rate)
+        state.max_rate_seen = max(state.max_rate_seen, state.rate)
+
+    def _record(self, key: str, event: str, state: LimiterState, **extra: Any) -> None:
+        self.events.append({"ts": round(time.time(), 3), "key": key, "event": event, "rate": round(state.rate, 3), **extra})
+        if len(self.events) > self.max_events:
+            del self.events[: len(self.events) - self.max_events]
+
+    def acquire(self, key: str) -> float:
+        """Block until ``key`` may send one request; returns the seconds spent waiting."""
+        started = time.time()
+        with self._lock:
+            state = self._state(key, started)
+            self._refill(state, started)
+            state.tokens -= 1.0
+            wait = max(0.0, -state.tokens / state.rate, state.blocked_until - started)
+        if wait > 0:
+            time.sleep(wait)
+        while True:
+            with self._lock:
+                remaining = self._states[key].blocked_until - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+        waited = time.time() - started
+        with self._lock:
+            self._states[key].waited_ms += int(waited * 1000)
+        return waited
+
+    def backoff_delay(self, attempt: int) -> float:
+        ceiling = min(self.backoff_cap, self.backoff_base * (2 ** max(0, attempt - 1)))
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def on_success(self, key: str, headers: Any = None) -> None:
+        now = time.time()
+        with self._lock:
+            state = self._state(key, now)
+            state.successes += 1
+            if header_remaining_requests(headers) == 0:
+                reset = header_retry_seconds(headers)
+                if reset:
+                    reset = min(reset, self.max_retry_wait)
+                    state.blocked_until = max(state.blocked_until, now + reset)
+                    self._record(key, "quota_exhausted", state, block_sec=round(reset, 3))
+                    return
+            if state.rate < self.max_rate:
+                self._set_rate(state, state.rate + self.increase_step)
+                state.increases += 1
+
+    def on_throttle(self, key: str, headers: Any = None, message: str = "", attempt: int = 1) -> float:
+        """Apply multiplicative decrease for a 429 and return how long ``key`` is now blocked."""
+        now = time.time()
+        hint = header_retry_seconds(headers)
+        if hint is None:
+            hint = parse_retry_seconds(message)
+        if hint is not None:
+            hint = min(hint, self.max_retry_wait)
+        with self._lock:
+            state = self._state(key, now)
+            state.throttles += 1
+            state.decreases += 1
+            self._set_rate(state, state.rate * self.decrease_factor)
+            state.tokens = min(state.tokens, 0.0)
+            if hint is not None:
+                block = hint + random.uniform(0, 0.3)
+            else:
+                block = self.backoff_delay(attempt)
+            state.blocked_until = max(state.blocked_until, now + block)
+            self._record(key, "throttled", state, block_sec=round(block, 3), hint_sec=hint, attempt=attempt)
+        return block
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "config": {
+                    "initial_rate": self.initial_rate,
+                    "min_rate": self.min_rate,
+                    "max_rate": self.max_rate,
+                    "burst": self.burst,
+                    "increase_step": self.increase_step,
+                    "decrease_factor": self.decrease_factor,
+                    "backoff_base": self.backoff_base,
+                    "backoff_cap": self.backoff_cap,
+                    "max_retry_wait": self.max_retry_wait,
+                },
+                "keys": {
+                    key: {
+                        "rate": round(state.rate, 3),
+                        "min_rate_seen": round(state.min_rate_seen, 3),
+                        "max_rate_seen": round(state.max_rate_seen, 3),
+                        "successes": state.successes,
+                        "throttles": state.throttles,
+                        "increases": state.increases,
+                        "decreases": state.decreases,
+                        "waited_ms": state.waited_ms,
+                    }
+                    for key, state in sorted(self._states.items())
+                },
+                "events": list(self.events),
+            }
+
+
+def drain_stream(pending: Iterator[Any], limit: int = 1000) -> None:
+    """Exhaust a partially consumed body iterator (e.g. the chunked terminator after ``[DONE]``).
+
+    Abandoning the iterator instead makes urllib3 close the socket when the generator is
+    finalised, so every streamed completion would pay DNS / connect / TLS again.
+    """
+    try:
+        for count, _ in enumerate(pending):
+            if count >= limit:
+                return
+    except (requests.RequestException, urllib3.exceptions.HTTPError):
+        pass
+
+
+def limiter_key(path: str, payload: dict[str, Any] | None) -> str:
+    model = (payload or {}).get("model") or ""
+    return f"{path}|{model}" if model else path
+
+
+@dataclass
+class ProbeResult:
+    success: bool
+    model: str
+    prompt: str
+    elapsed_ms: int
+    http_status: int | None = None
+    finish_reason: str = ""
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    total_tokens: int | None = None
+    cached_prompt_tokens: int | None = None
+    prompt_tokens_estimate: float | None = None
+    message_content_len: int = 0
+    choice_text_len: int = 0
+    output_text_len: int = 0
+    reasoning_len: int = 0
+    tool_calls_len: int = 0
+    stream: bool = False
+    ttft_ms: int | None = None
+    chunk_count: int = 0
+    chunk_gap_p50_ms: float | None = None
+    chunk_gap_p90_ms: float | None = None
+    chunk_gap_p99_ms: float | None = None
+    output_chars_per_sec: float | None = None
+    completion_tokens_per_sec: float | None = None
+    attempts: int = 1
+    rate_limited: int = 0
+    cached: bool = False
+    segments_per_sec: float | None = None
+    xml_validation: dict[str, Any] | None = None
+    dns_ms: float | None = None
+    connect_ms: float | None = None
+    tls_ms: float | None = None
+    ttfb_ms: float | None = None
+    download_ms: float | None = None
+    retry_wait_ms: float = 0.0
+    spacing_wait_ms: float = 0.0
+    connection_reused: bool | None = None
+    hedge: dict[str, Any] | None = None
+    translations: dict[int, str] | None = None
+    error: str = ""
+    error_body: str = ""
+    body_raw: str = ""
+
+
+# Timing fields copied from RequestTrace onto ProbeResult.
+PHASE_FIELDS = (
+    "dns_ms",
+    "connect_ms",
+    "tls_ms",
+    "ttfb_ms",
+    "download_ms",
+    "retry_wait_ms",
+    "spacing_wait_ms",
+    "connection_reused",
+)
+
+
+def usage_cached_tokens(usage: dict[str, Any]) -> int | None:
+    """Prompt tokens the provider served from its prefix cache, or ``None`` when it does not say.
+
+    Reads OpenAI's ``prompt_tokens_details.cached_tokens`` (``input_tokens_details`` on the
+    Responses API), DeepSeek's ``prompt_cache_hit_tokens`` and Anthropic-style ``cache_read_input_tokens``.
+    """
+    for details_key in ("prompt_tokens_details", "input_tokens_details"):
+        details = usage.get(details_key)
+        if isinstance(details, dict) and isinstance(details.get("cached_tokens"), int):
+            return details["cached_tokens"]
+    for key in ("prompt_cache_hit_tokens", "cache_read_input_tokens", "cached_tokens"):
+        if isinstance(usage.get(key), int):
+            return usage[key]
+    return None
+
+
+@dataclass
+class RequestTrace:
+    """Per-request bookkeeping shared by ``_send`` and the probe methods.
+
+    Connection setup (DNS / connect / TLS) and waits are summed over all attempts; TTFB,
+    download and connection reuse describe the attempt whose response was used.
+    """
+
+    attempts: int = 0
+    rate_limited: int = 0
+    cached: bool = False
+    dns_ms: float | None = None
+    connect_ms: float | None = None
+    tls_ms: float | None = None
+    ttfb_ms: float | None = None
+    download_ms: float | None = None
+    retry_wait_ms: float = 0.0
+    spacing_wait_ms: float = 0.0
+    connection_reused: bool | None = None
+    headers_at: float | None = None
+
+    def record_phases(self, phases: dict[str, Any] | None) -> None:
+        if not phases:
+            return
+        for name in ("dns_ms", "connect_ms", "tls_ms"):
+            if phases.get(name) is not None:
+                setattr(self, name, round((getattr(self, name) or 0.0) + phases[name], 1))
+        self.ttfb_ms = phases.get("ttfb_ms")
+        self.headers_at = phases.get("headers_at")
+        new_connection = phases.get("new_connection")
+        self.connection_reused = None if new_connection is None else not new_connection
+
+    def record_wait(self, seconds: float, retry: bool) -> None:
+        if retry:
+            self.retry_wait_ms = round(self.retry_wait_ms + seconds * 1000, 1)
+        else:
+            self.spacing_wait_ms = round(self.spacing_wait_ms + seconds * 1000, 1)
+
+    def finish_download(self, finished_at: float | None = None) -> None:
+        if self.headers_at is not None and self.download_ms is None:
+            self.download_ms = round(max(0.0, ((finished_at or time.time()) - self.headers_at) * 1000), 1)
+
+
+@dataclass
+class ProbeJob:
+    step: str
+    model: str
+    prompt_name: str
+    messages: list[dict[str, str]]
+    source_lengths: list[int] | None = None
+    keep_translations: bool = False
+
+
+class AirforceDiagnoser:
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        timeout_sec: int,
+        retries: int,
+        min_spacing: float,
+        max_rate: float = 10.0,
+        cache: ResponseCache | None = None,
+        estimator: TokenEstimator | None = None,
+        cassette: HttpCassette | None = None,
+        max_retry_wait: float = 120.0,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.cache = cache
+        self.cassette = cassette
+        self.estimator = estimator or TokenEstimator()
+        self.timeout_sec = timeout_sec
+        self.retries = retries
+        self.min_spacing = min_spacing
+        self.session = requests.Session()
+        timed_adapter = TimedHTTPAdapter()
+        self.session.mount("http://", timed_adapter)
+        self.session.mount("https://", timed_adapter)
+        self.session.headers.update(
+            {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            }
+        )
+        if cassette is not None:
+            cassette.mount(self.session)
+        # min_spacing is the starting point; AIMD then moves each key towards what the provider allows.
+        self.limiter = AdaptiveRateLimiter(
+            initial_rate=1.0 / min_spacing if min_spacing > 0 else max_rate,
+            max_rate=max_rate,
+            max_retry_wait=max_retry_wait,
+        )
+
+    @property
+    def instant_replay(self) -> bool:
+        """True when responses come from a cassette without recorded delays, so waits are skipped."""
+        return self.cassette is not None and self.cassette.replaying and not self.cassette.realtime
+
+    def connection_stats(self) -> dict[str, Any]:
+        return connection_pool_stats(self.session)
+
+    def _respect_spacing(self, key: str) -> float:
+        if self.instant_replay:
+            return 0.0
+        return self.limiter.acquire(key)
+
+    def _send(
+        self,
+        method: str,
+        path: str,
+        payload: dict[str, Any] | None = None,
+        stream: bool = False,
+        trace: RequestTrace | None = None,
+    ) -> tuple[requests.Response, float]:
+        """Send one request with spacing and 429 retries; returns the response and its send time."""
+        url = f"{self.base_url}{path}"
+        trace = trace or RequestTrace()
+        key = limiter_key(path, payload)
+        last_exc: Exception | None = None
+        for attempt in range(1, self.retries + 1):
+            trace.attempts = attempt
+            # Waits before a retry (429 block, back-off) count as retry wait, the rest as spacing.
+            trace.record_wait(self._respect_spacing(key), retry=attempt > 1)
+            sent_at = time.time()
+            try:
+                if method == "GET":
+                    resp = self.session.get(url, timeout=self.timeout_sec, stream=stream)
+                else:
+                    resp = self.session.post(url, data=json.dumps(payload or {}), timeout=self.timeout_sec, stream=stream)
+                trace.record_phases(getattr(resp, "phase_timings", None))
+
+                if resp.status_code == 429:
+                    trace.rate_limited += 1
+                    message = ""
+                    try:
+                        message = str(resp.json().get("error", {}).get("message", ""))
+                    except Exception:
+                        message = ""
+                    sleep_for = self.limiter.on_throttle(key, resp.headers, message, attempt)
+                    if attempt < self.retries:
+                        resp.close()
+                        if self.instant_replay:
+                            sleep_for = 0.0
+                        print(f"429 rate-limit on {path} attempt={attempt}, sleeping {sleep_for:.2f}s")
+                        continue
+                elif resp.status_code < 500:
+                    self.limiter.on_success(key, resp.headers)
+
+                return resp, sent_at
+            except Exception as exc:
+                last_exc = exc
+                if attempt < self.retries and not isinstance(exc, CassetteMiss):
+                    if not self.instant_replay:
+                        delay = self.limiter.backoff_delay(attempt)
+                        time.sleep(delay)
+                        trace.record_wait(delay, retry=True)
+                    continue
+                raise RuntimeError(f"{method} {path} failed after {attempt} attempts: {exc}") from exc
+
+        raise RuntimeError(f"{method} {path} failed: {last_exc}")
+
+    def _request_json(
+        self,
+        method: str,
+        path: str,
+        payload: dict[str, Any] | None = None,
+        trace: RequestTrace | None = None,
+    ) -> tuple[int, str]:
+        cache_key = ResponseCache.key(method, f"{self.base_url}{path}", payload)
+        if self.cache is not None:
+            cached = self.cache.get_text(cache_key)
+            if cached is not None:
+                if trace is not None:
+                    trace.cached = True
+                return int(cached[0].get("status") or 200), cached[1]
+
+        trace = trace or RequestTrace()
+        resp, _ = self._send(method, path, payload=payload, trace=trace)
+        body_text = resp.text or ""
+        trace.finish_download()
+        if self.cache is not None and 200 <= resp.status_code < 300:
+            self.cache.put(
+                cache_key,
+                {"kind": "api", "method": method, "path": path, "model": (payload or {}).get("model"), "status": resp.status_code},
+                body_text,
+            )
+        return resp.status_code, body_text
 
     def probe_models(self) -> dict[str, Any]:
         try:
@@ -268,129 +2309,1661 @@ class AirforceDiagnoser:
                 "error": str(exc),
             }
 
-    def probe_chat(self, model: str, prompt_name: str, messages: list[dict[str, str]], max_tokens: int) -> ProbeResult:
-        payload = {
+    def probe_chat(
+        self,
+        model: str,
+        prompt_name: str,
+        messages: list[dict[str, str]],
+        max_tokens: int,
+        stream: bool = False,
+        source_lengths: list[int] | None = None,
+        cancel: threading.Event | None = None,
+        keep_translations: bool = False,
+    ) -> ProbeResult:
+        """Send one chat completion and measure it.
+
+        ``cancel`` lets a hedged duplicate abandon a streamed response once another request won;
+        a non-streaming request cannot be interrupted and runs to completion.
+        """
+        payload: dict[str, Any] = {
             "model": model,
             "messages": messages,
             "temperature": 0.2,
             "top_p": 0.95,
             "max_tokens": max_tokens,
-            "stream": False,
+            "stream": stream,
         }
+        trace = RequestTrace()
+        validator = XmlSegmentValidator(source_lengths, keep_text=keep_translations) if source_lengths is not None else None
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+            result = self._probe_chat_stream(model, prompt_name, payload, trace, validator, cancel)
+        else:
+            result = self._probe_chat_json(model, prompt_name, payload, trace, validator)
+        if validator is not None and result.success:
+            result.xml_validation = validator.close()
+            result.segments_per_sec = rate_per_sec(result.xml_validation["valid_segments"], result.elapsed_ms)
+            result.translations = validator.texts
+        result.attempts = trace.attempts
+        result.rate_limited = trace.rate_limited
+        result.cached = trace.cached
+        for name in PHASE_FIELDS:
+            setattr(result, name, getattr(trace, name))
+        # Uncalibrated on purpose: calibrate-tokens fits the per-model scale against provider usage.
+        result.prompt_tokens_estimate = round(self.estimator.raw_messages(messages, model), 1)
+        return result
 
+    def _probe_chat_json(
+        self,
+        model: str,
+        prompt_name: str,
+        payload: dict[str, Any],
+        trace: RequestTrace,
+        validator: XmlSegmentValidator | None = None,
+    ) -> ProbeResult:
         started = time.time()
         try:
-            status, body_raw = self._request_json("POST", "/v1/chat/completions", payload=payload)
+            status, body_raw = self._request_json("POST", "/v1/chat/completions", payload=payload, trace=trace)
             elapsed_ms = int((time.time() - started) * 1000)
 
-            if not body_raw:
-                return ProbeResult(
-                    success=False,
-                    model=model,
-                    prompt=prompt_name,
-                    elapsed_ms=elapsed_ms,
-                    http_status=status,
-                    error="Empty HTTP body",
-                    body_raw="",
-                )
+            if not body_raw:
+                return ProbeResult(
+                    success=False,
+                    model=model,
+                    prompt=prompt_name,
+                    elapsed_ms=elapsed_ms,
+                    http_status=status,
+                    error="Empty HTTP body",
+                    body_raw="",
+                )
+
+            try:
+                body = json.loads(body_raw)
+            except Exception as exc:
+                return ProbeResult(
+                    success=False,
+                    model=model,
+                    prompt=prompt_name,
+                    elapsed_ms=elapsed_ms,
+                    http_status=status,
+                    error=f"Non-JSON response: {exc}",
+                    body_raw=body_raw,
+                )
+
+            if not (200 <= status < 300):
+                err = body.get("error", {}) if isinstance(body, dict) else {}
+                return ProbeResult(
+                    success=False,
+                    model=model,
+                    prompt=prompt_name,
+                    elapsed_ms=elapsed_ms,
+                    http_status=status,
+                    error=str(err.get("message") or f"HTTP {status}"),
+                    error_body=body_raw,
+                    body_raw=body_raw,
+                )
+
+            choice = ((body.get("choices") or [None])[0]) if isinstance(body, dict) else None
+            message = choice.get("message", {}) if isinstance(choice, dict) else {}
+
+            message_content = text_from_value(message.get("content"))
+            choice_text = text_from_value(choice.get("text") if isinstance(choice, dict) else None)
+            output_text = text_from_value(choice.get("output_text") if isinstance(choice, dict) else None)
+            reasoning = text_from_value(message.get("reasoning_content")) or text_from_value(message.get("reasoning"))
+            tool_calls = text_from_value(message.get("tool_calls"))
+            usage = body.get("usage", {}) if isinstance(body, dict) else {}
+            completion_tokens = usage.get("completion_tokens")
+            if validator is not None:
+                validator.feed(message_content or choice_text or output_text)
+
+            return ProbeResult(
+                success=True,
+                model=model,
+                prompt=prompt_name,
+                elapsed_ms=elapsed_ms,
+                http_status=status,
+                finish_reason=str(choice.get("finish_reason", "") if isinstance(choice, dict) else ""),
+                prompt_tokens=usage.get("prompt_tokens"),
+                completion_tokens=completion_tokens,
+                total_tokens=usage.get("total_tokens"),
+                cached_prompt_tokens=usage_cached_tokens(usage),
+                message_content_len=len(message_content),
+                choice_text_len=len(choice_text),
+                output_text_len=len(output_text),
+                reasoning_len=len(reasoning),
+                tool_calls_len=len(tool_calls),
+                completion_tokens_per_sec=rate_per_sec(completion_tokens, elapsed_ms),
+                body_raw=body_raw,
+            )
+        except Exception as exc:
+            elapsed_ms = int((time.time() - started) * 1000)
+            return ProbeResult(
+                success=False,
+                model=model,
+                prompt=prompt_name,
+                elapsed_ms=elapsed_ms,
+                error=str(exc),
+            )
+
+    def _probe_chat_stream(
+        self,
+        model: str,
+        prompt_name: str,
+        payload: dict[str, Any],
+        trace: RequestTrace,
+        validator: XmlSegmentValidator | None = None,
+        cancel: threading.Event | None = None,
+    ) -> ProbeResult:
+        """Consume an SSE completion incrementally, keeping only counters and chunk timings."""
+        started = time.time()
+        try:
+            resp, sent_at = self._send("POST", "/v1/chat/completions", payload=payload, stream=True, trace=trace)
+        except Exception as exc:
+            return ProbeResult(
+                success=False,
+                model=model,
+                prompt=prompt_name,
+                elapsed_ms=int((time.time() - started) * 1000),
+                stream=True,
+                error=str(exc),
+            )
+
+        result = ProbeResult(success=False, model=model, prompt=prompt_name, elapsed_ms=0, http_status=resp.status_code, stream=True)
+        try:
+            if not (200 <= resp.status_code < 300):
+                error_body = resp.text or ""
+                trace.finish_download()
+                result.error = f"HTTP {resp.status_code}"
+                try:
+                    err = json.loads(error_body).get("error", {})
+                    result.error = str(err.get("message") or result.error)
+                except Exception:
+                    pass
+                result.error_body = error_body
+                return result
+
+            token_times: list[float] = []
+            usage: dict[str, Any] = {}
+            # chunk_size=None yields each HTTP chunk as soon as it arrives, which keeps TTFT honest.
+            events = iter_sse_data(resp.iter_lines(chunk_size=None))
+            for data in events:
+                if data.strip() == "[DONE]":
+                    break
+                if cancel is not None and cancel.is_set():
+                    result.error = "cancelled"
+                    return result
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    result.error = f"Non-JSON SSE event: {data[:200]}"
+                    return result
+                if not isinstance(event, dict):
+                    continue
+                if isinstance(event.get("usage"), dict):
+                    usage = event["usage"]
+                if isinstance(event.get("error"), dict):
+                    result.error = str(event["error"].get("message") or "SSE error event")
+                    return result
+
+                choice = ((event.get("choices") or [None])[0])
+                if not isinstance(choice, dict):
+                    continue
+                delta = choice.get("delta") or {}
+                if validator is not None and isinstance(delta.get("content"), str):
+                    validator.feed(delta["content"])
+                content_len = delta_text_len(delta.get("content"))
+                reasoning_len = delta_text_len(delta.get("reasoning_content")) or delta_text_len(delta.get("reasoning"))
+                tool_calls_len = delta_text_len(delta.get("tool_calls"))
+                text_len = delta_text_len(choice.get("text"))
+                result.message_content_len += content_len
+                result.reasoning_len += reasoning_len
+                result.tool_calls_len += tool_calls_len
+                result.choice_text_len += text_len
+                if content_len or reasoning_len or tool_calls_len or text_len:
+                    token_times.append(time.time())
+                if choice.get("finish_reason"):
+                    result.finish_reason = str(choice.get("finish_reason"))
+
+            finished_at = time.time()
+            trace.finish_download(finished_at)
+            drain_stream(events)
+            result.success = True
+            result.prompt_tokens = usage.get("prompt_tokens")
+            result.completion_tokens = usage.get("completion_tokens")
+            result.total_tokens = usage.get("total_tokens")
+            result.cached_prompt_tokens = usage_cached_tokens(usage)
+            result.chunk_count = len(token_times)
+            if token_times:
+                result.ttft_ms = int((token_times[0] - sent_at) * 1000)
+                gaps = [(b - a) * 1000 for a, b in zip(token_times, token_times[1:])]
+                result.chunk_gap_p50_ms = percentile(gaps, 50)
+                result.chunk_gap_p90_ms = percentile(gaps, 90)
+                result.chunk_gap_p99_ms = percentile(gaps, 99)
+                generation_ms = int((finished_at - token_times[0]) * 1000)
+                output_len = result.message_content_len + result.reasoning_len + result.tool_calls_len + result.choice_text_len
+                result.output_chars_per_sec = rate_per_sec(output_len, generation_ms)
+                result.completion_tokens_per_sec = rate_per_sec(result.completion_tokens or len(token_times), generation_ms)
+            return result
+        except Exception as exc:
+            result.success = False
+            result.error = str(exc)
+            return result
+        finally:
+            trace.finish_download()
+            resp.close()
+            result.elapsed_ms = int((time.time() - started) * 1000)
+
+
+class StubAirforceServer:
+    """Offline stand-in for the Airforce OpenAI-compatible API.
+
+    Serves ``/v1/models``, ``/v1/chat/completions`` (plain JSON and SSE) and an ETag-aware
+    sample chapter page under ``/chapter`` from a background thread. Chat replies echo every ``<s i='N'>`` input segment with a target-language marker,
+    so streaming, reporting and XML handling can be exercised without network access.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: int = 0,
+        chunk_delay_ms: int = 0,
+        chunk_chars: int = 16,
+        rate_limit_every: int = 0,
+        retry_after_sec: float = 1.0,
+        models: list[str] | None = None,
+        slow_rate: float = 0.0,
+        slow_ms: int = 0,
+        seed: int | None = None,
+        prefill_ms_per_1k: float = 0.0,
+        cache_block_tokens: int = 0,
+        cache_min_tokens: int = 1024,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.cache_block_tokens = cache_block_tokens
+        self.cache_min_tokens = cache_min_tokens
+        self._prefix_blocks: set[str] = set()
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self._random = random.Random(seed)
+        self.chunk_delay_ms = chunk_delay_ms
+        self.chunk_chars = max(1, chunk_chars)
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_sec = retry_after_sec
+        self.models = models or ["deepseek-v3.2", "deepseek-v3.2-thinking", "glm-5-fast"]
+        self.chat_requests = 0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self.httpd = ThreadingHTTPServer((host, port), _StubAirforceHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self  # type: ignore[attr-defined]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_chat_is_rate_limited(self) -> bool:
+        with self._lock:
+            self.chat_requests += 1
+            return self.rate_limit_every > 0 and self.chat_requests % self.rate_limit_every == 0
+
+    def chat_latency_ms(self) -> int:
+        """Base latency plus ``slow_ms`` for a random ``slow_rate`` share of requests (a latency tail)."""
+        with self._lock:
+            slow = self.slow_rate > 0 and self._random.random() < self.slow_rate
+        return self.latency_ms + (self.slow_ms if slow else 0)
+
+    def cached_prefix_tokens(self, model: str, messages: list[Any]) -> int:
+        """Per-model prompt-prefix cache in ``cache_block_tokens`` blocks (4 chars per token, like ``usage``).
+
+        Every block-aligned prefix of the serialized messages is remembered; the reply counts the
+        longest one seen before, and nothing below ``cache_min_tokens``. ``0`` block tokens disables it.
+        """
+        if self.cache_block_tokens <= 0:
+            return 0
+        text = "".join(f"{m.get('role')}\n{m.get('content') or ''}\n" for m in messages if isinstance(m, dict))
+        block = self.cache_block_tokens * 4
+        digest = hashlib.sha256(model.encode("utf-8") + b"\0")
+        cached_chars = 0
+        with self._lock:
+            for end in range(block, len(text) + 1, block):
+                # Chained digest: a block only matches behind an identical prefix.
+                digest.update(text[end - block : end].encode("utf-8"))
+                key = digest.hexdigest()
+                if key in self._prefix_blocks:
+                    cached_chars = end
+                else:
+                    self._prefix_blocks.add(key)
+        cached = cached_chars // 4
+        return cached if cached >= self.cache_min_tokens else 0
+
+    def reply_for(self, payload: dict[str, Any]) -> str:
+        messages = payload.get("messages") or []
+        user_text = ""
+        for message in messages:
+            if isinstance(message, dict) and message.get("role") == "user":
+                user_text = str(message.get("content") or "")
+        segments = re.findall(r"<s i='(\d+)'>(.*?)</s>", user_text, flags=re.DOTALL)
+        if not segments:
+            return "OK"
+        return "\n".join(f"<s i='{index}'>[ru] {text}</s>" for index, text in segments)
+
+    def chapter_html(self) -> str:
+        paragraphs = "\n".join(f"<p>{html.escape(text)}</p>" for text in SAMPLE_CHAPTER_SEGMENTS)
+        return f"<html><head><title>Chapter 1</title></head><body><div class='chapter'>\n{paragraphs}\n</div></body></html>"
+
+    def start(self) -> "StubAirforceServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="airforce-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def __enter__(self) -> "StubAirforceServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+class _StubAirforceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and the first SSE chunk go out as separate writes; with Nagle on, a kept-alive
+    # connection holds the chunk for the client's delayed ACK and adds ~40 ms to TTFT.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        return
+
+    @property
+    def stub(self) -> StubAirforceServer:
+        return self.server.stub  # type: ignore[attr-defined]
+
+    def _send_json(self, status: int, body: dict[str, Any], headers: dict[str, str] | None = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes) -> bool:
+        """Write one HTTP chunk (an empty one ends the body); False once the client has gone away."""
+        try:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # A cancelled (e.g. hedged-out) stream closes its connection mid-body.
+            self.close_connection = True
+            return False
+        return True
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": m, "object": "model"} for m in self.stub.models]})
+            return
+        if self.path.startswith("/chapter"):
+            page = self.stub.chapter_html().encode("utf-8")
+            etag = '"' + hashlib.sha256(page).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(page)
+            return
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if self.stub.next_chat_is_rate_limited():
+            self._send_json(
+                429,
+                {"error": {"message": f"Rate limit exceeded. Try again in {self.stub.retry_after_sec} seconds."}},
+                headers={"Retry-After": str(self.stub.retry_after_sec)},
+            )
+            return
+
+        model = str(payload.get("model") or "")
+        messages = payload.get("messages") or []
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in messages if isinstance(m, dict))
+        prompt_tokens = max(1, prompt_chars // 4)
+        cached_tokens = min(prompt_tokens, self.stub.cached_prefix_tokens(model, messages))
+        # Prefill cost scales with the uncached part of the prompt, so cache hits show up in TTFT.
+        latency_ms = self.stub.chat_latency_ms() + self.stub.prefill_ms_per_1k * (prompt_tokens - cached_tokens) / 1000.0
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000.0)
+
+        reply = self.stub.reply_for(payload)
+        pieces = [reply[i : i + self.stub.chunk_chars] for i in range(0, len(reply), self.stub.chunk_chars)]
+        usage: dict[str, Any] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces),
+            "total_tokens": prompt_tokens + len(pieces),
+        }
+        if self.stub.cache_block_tokens > 0:
+            usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+
+        if not payload.get("stream"):
+            self._send_json(
+                200,
+                {
+                    "object": "chat.completion",
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for piece in pieces:
+            if self.stub.chunk_delay_ms > 0:
+                time.sleep(self.stub.chunk_delay_ms / 1000.0)
+            event = {
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            if not self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8")):
+                return
+        final = {
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            final["usage"] = usage
+        for data in (f"data: {json.dumps(final)}\n\n".encode("utf-8"), b"data: [DONE]\n\n", b""):
+            if not self._write_chunk(data):
+                return
+
+
+def format_probe_line(r: ProbeResult) -> str:
+    line = (
+        f"{'OK' if r.success else 'FAILED'} status={r.http_status} elapsed_ms={r.elapsed_ms} "
+        f"finish_reason={r.finish_reason} prompt_tokens={r.prompt_tokens} "
+        f"completion_tokens={r.completion_tokens} total_tokens={r.total_tokens} "
+        f"lens=message:{r.message_content_len},text:{r.choice_text_len},output_text:{r.output_text_len},"
+        f"reasoning:{r.reasoning_len},tool_calls:{r.tool_calls_len}"
+    )
+    if r.prompt_tokens_estimate is not None:
+        line += f" prompt_tokens_est={r.prompt_tokens_estimate}"
+    if r.cached_prompt_tokens is not None:
+        line += f" cached_prompt_tokens={r.cached_prompt_tokens}"
+    if r.stream:
+        line += (
+            f" ttft_ms={r.ttft_ms} chunks={r.chunk_count} "
+            f"gap_ms=p50:{r.chunk_gap_p50_ms},p90:{r.chunk_gap_p90_ms},p99:{r.chunk_gap_p99_ms} "
+            f"chars_per_sec={r.output_chars_per_sec}"
+        )
+    if r.completion_tokens_per_sec is not None:
+        line += f" tokens_per_sec={r.completion_tokens_per_sec}"
+    if r.cached:
+        line += " cached=true"
+    if r.ttfb_ms is not None:
+        line += (
+            f" phases_ms=dns:{r.dns_ms},connect:{r.connect_ms},tls:{r.tls_ms},ttfb:{r.ttfb_ms},download:{r.download_ms},"
+            f"retry_wait:{r.retry_wait_ms},spacing_wait:{r.spacing_wait_ms} reused={r.connection_reused}"
+        )
+    if r.xml_validation is not None:
+        v = r.xml_validation
+        line += (
+            f" xml=valid:{v['valid_segments']}/{v['expected_segments']},missing:{len(v['missing'])},"
+            f"duplicated:{len(v['duplicated'])},reordered:{v['reordered']},truncated:{len(v['truncated'])},"
+            f"ratio_outliers:{v['length_ratio']['outliers']} segments_per_sec={r.segments_per_sec}"
+        )
+    return line
+
+
+@dataclass
+class ModelLatencyState:
+    ewma_ms: float | None = None
+    error_ewma: float = 0.0
+    observations: int = 0
+    failures: int = 0
+
+
+class ModelLatencyTracker:
+    """Live per-model latency and error statistics used to rank models and time hedges.
+
+    Keeps an EWMA of successful latencies, an EWMA of the failure rate and a sliding window of
+    recent latencies for percentiles. Latencies of requests cancelled after losing a hedge are
+    recorded as the time at which they were cancelled, a lower bound that keeps the window
+    from forgetting slow requests.
+    """
+
+    def __init__(self, alpha: float = 0.2, window: int = 200, min_samples: int = 5, error_penalty: float = 4.0) -> None:
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.error_penalty = error_penalty
+        self._window = window
+        self._states: dict[str, ModelLatencyState] = {}
+        self._latencies: dict[str, deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, latency_ms: float, ok: bool) -> None:
+        with self._lock:
+            state = self._states.setdefault(model, ModelLatencyState())
+            state.observations += 1
+            state.error_ewma += self.alpha * ((0.0 if ok else 1.0) - state.error_ewma)
+            if not ok:
+                state.failures += 1
+                return
+            state.ewma_ms = latency_ms if state.ewma_ms is None else state.ewma_ms + self.alpha * (latency_ms - state.ewma_ms)
+            self._latencies.setdefault(model, deque(maxlen=self._window)).append(latency_ms)
+
+    def percentile_ms(self, model: str, pct: float) -> float | None:
+        with self._lock:
+            values = list(self._latencies.get(model) or [])
+        if len(values) < self.min_samples:
+            return None
+        return percentile(values, pct)
+
+    def score(self, model: str) -> float:
+        """Expected cost of sending to ``model``: EWMA latency inflated by its recent error rate."""
+        with self._lock:
+            state = self._states.get(model)
+            if state is None or state.ewma_ms is None:
+                # Unknown models rank after measured ones but before ones that only ever failed.
+                return math.inf if state is not None and state.failures else 1e12
+            return state.ewma_ms * (1.0 + self.error_penalty * state.error_ewma)
+
+    def ranked(self, models: list[str], exclude: set[str] | None = None) -> list[str]:
+        candidates = [m for m in models if m not in (exclude or set())]
+        return sorted(candidates, key=lambda m: (self.score(m), models.index(m)))
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            states = {model: (state, list(self._latencies.get(model) or [])) for model, state in self._states.items()}
+        return {
+            model: {
+                "observations": state.observations,
+                "failures": state.failures,
+                "ewma_ms": round(state.ewma_ms, 1) if state.ewma_ms is not None else None,
+                "error_ewma": round(state.error_ewma, 4),
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+            }
+            for model, (state, latencies) in sorted(states.items())
+        }
+
+
+def probe_is_valid(result: ProbeResult) -> bool:
+    """A response a translation request could use: HTTP success and, for XML prompts, every segment back."""
+    if not result.success:
+        return False
+    return result.xml_validation is None or bool(result.xml_validation.get("complete"))
+
+
+def probe_spend_tokens(result: ProbeResult) -> int:
+    """Tokens a request cost; cancelled streams have no usage, so prompt estimate + streamed chars / 4."""
+    if result.total_tokens:
+        return int(result.total_tokens)
+    streamed = result.message_content_len + result.reasoning_len + result.choice_text_len + result.tool_calls_len
+    if not streamed and not (result.http_status is not None and 200 <= result.http_status < 300):
+        return 0  # rejected (429 / 5xx / connection error) before any generation
+    return int(round((result.prompt_tokens_estimate or 0) + streamed / 4))
+
+
+def store_tm_translations(tm: TranslationMemory, sent: list[str], results: list[ProbeResult]) -> int:
+    """Store the segments of the first successful XML response (``--models`` order is the preference)."""
+    for r in results:
+        if not r.success or not r.translations:
+            continue
+        stored = 0
+        for index, text in sorted(r.translations.items()):
+            if 0 <= index < len(sent):
+                tm.add(sent[index], text, r.model)
+                stored += 1
+        return stored
+    return 0
+
+
+class HedgedProber:
+    """Sends each probe to its model and hedges to the next-best model when it runs slow or fails.
+
+    The hedge fires once the primary has been outstanding for the primary model's
+    ``hedge_percentile`` latency (from :class:`ModelLatencyTracker`, clamped to
+    ``[min_delay_ms, timeout]``, ``initial_delay_ms`` until enough samples exist), or at once if the
+    primary fails (failover). The first valid response wins; a losing stream is cancelled, a
+    losing non-streaming request runs to completion. Every request, including losers, is
+    recorded in ``requests`` so the report can put the tail-latency gain next to the extra spend.
+    """
+
+    def __init__(
+        self,
+        diagnoser: AirforceDiagnoser,
+        models: list[str],
+        tracker: ModelLatencyTracker,
+        hedge_percentile: float = 95.0,
+        initial_delay_ms: float = 2000.0,
+        min_delay_ms: float = 50.0,
+        max_hedges: int = 1,
+        workers: int = 8,
+    ) -> None:
+        self.diagnoser = diagnoser
+        # Duplicates would count as hedge targets that tracker.ranked() never offers.
+        self.models = list(dict.fromkeys(models))
+        self.tracker = tracker
+        self.hedge_percentile = hedge_percentile
+        self.initial_delay_ms = initial_delay_ms
+        self.min_delay_ms = min_delay_ms
+        self.max_hedges = max_hedges
+        self.requests: list[ProbeResult] = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(2, workers), thread_name_prefix="hedge")
+
+    def hedge_delay_ms(self, model: str) -> float:
+        learned = self.tracker.percentile_ms(model, self.hedge_percentile)
+        delay = self.initial_delay_ms if learned is None else learned
+        return min(max(delay, self.min_delay_ms), self.diagnoser.timeout_sec * 1000.0)
+
+    def _launch(self, job: ProbeJob, model: str, max_tokens: int, stream: bool, cancel: threading.Event) -> Future:
+        sent_at = time.time()
+
+        def run() -> ProbeResult:
+            return self.diagnoser.probe_chat(
+                model=model,
+                prompt_name=job.prompt_name,
+                messages=job.messages,
+                max_tokens=max_tokens,
+                stream=stream,
+                source_lengths=job.source_lengths,
+                cancel=cancel,
+                keep_translations=job.keep_translations,
+            )
+
+        def record(future: Future) -> None:
+            try:
+                result = future.result()
+            except Exception as exc:
+                result = ProbeResult(success=False, model=model, prompt=job.prompt_name, elapsed_ms=int((time.time() - sent_at) * 1000), error=str(exc))
+            cancelled = cancel.is_set() and result.error == "cancelled"
+            # A cancelled loser was at least this slow; a real failure counts against the model.
+            self.tracker.observe(model, result.elapsed_ms, ok=probe_is_valid(result) or cancelled)
+            with self._lock:
+                self.requests.append(result)
+
+        future = self._pool.submit(run)
+        future.add_done_callback(record)
+        return future
+
+    def probe(self, job: ProbeJob, max_tokens: int, stream: bool = False) -> ProbeResult:
+        started = time.time()
+        cancel = threading.Event()
+        threshold_ms = self.hedge_delay_ms(job.model)
+        launched = [job.model]
+        pending: dict[Future, str] = {self._launch(job, job.model, max_tokens, stream, cancel): job.model}
+        reason = ""
+        winner: ProbeResult | None = None
+        last: ProbeResult | None = None
+        while pending:
+            can_hedge = len(launched) <= self.max_hedges and any(m not in launched for m in self.models)
+            timeout = None
+            if can_hedge:
+                timeout = max(0.0, started + threshold_ms / 1000.0 * len(launched) - time.time())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            failed = False
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    result = ProbeResult(success=False, model=launched[0], prompt=job.prompt_name, elapsed_ms=0, error=str(exc))
+                last = result
+                if winner is None and probe_is_valid(result):
+                    winner = result
+                failed = failed or not probe_is_valid(result)
+            if winner is not None:
+                break
+            if can_hedge and (not done or (failed and not pending)):
+                reason = reason or ("slow" if not done else "failover")
+                candidates = self.tracker.ranked(self.models, exclude=set(launched))
+                if candidates:
+                    launched.append(candidates[0])
+                    pending[self._launch(job, candidates[0], max_tokens, stream, cancel)] = candidates[0]
+        cancel.set()
+
+        chosen = winner or last
+        assert chosen is not None
+        # The per-request result may still be on its way into ``requests`` (done callback), so
+        # the end-to-end time goes on a copy instead of overwriting that request's own latency.
+        chosen = replace(chosen, elapsed_ms=int((time.time() - started) * 1000))
+        chosen.hedge = {
+            "primary_model": job.model,
+            "winner_model": chosen.model if winner is not None else None,
+            "threshold_ms": round(threshold_ms, 1),
+            "fired": len(launched) > 1,
+            "reason": reason or None,
+            "models": launched,
+        }
+        return chosen
+
+    def close(self) -> None:
+        """Wait for losing requests still in flight so their spend is accounted for."""
+        self._pool.shutdown(wait=True)
+
+
+def summarize_hedging(results: list[ProbeResult], requests_sent: list[ProbeResult], baseline: list[ProbeResult] | None = None) -> dict[str, Any]:
+    """End-to-end latency of hedged probes next to the extra requests / tokens the hedges cost."""
+    latencies = [r.elapsed_ms for r in results if probe_is_valid(r)]
+    fired = [r for r in results if r.hedge and r.hedge["fired"]]
+    hedge_wins = [r for r in fired if r.hedge and r.hedge["winner_model"] not in (None, r.hedge["primary_model"])]
+    spent_tokens = sum(probe_spend_tokens(r) for r in requests_sent)
+    useful_tokens = sum(probe_spend_tokens(r) for r in results if probe_is_valid(r))
+    summary: dict[str, Any] = {
+        "probes": len(results),
+        "valid": len(latencies),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "hedges_fired": len(fired),
+        "hedge_rate": round(len(fired) / len(results), 4) if results else 0.0,
+        "failovers": sum(1 for r in fired if r.hedge and r.hedge["reason"] == "failover"),
+        "hedge_wins": len(hedge_wins),
+        "requests_sent": len(requests_sent),
+        "extra_requests": len(requests_sent) - len(results),
+        "tokens_spent": spent_tokens,
+        "extra_tokens": spent_tokens - useful_tokens,
+    }
+    if baseline is not None:
+        base_latencies = [r.elapsed_ms for r in baseline if probe_is_valid(r)]
+        base_tokens = sum(probe_spend_tokens(r) for r in baseline)
+        base_p99 = percentile(base_latencies, 99)
+        hedged_p99 = summary["latency_ms"]["p99"]
+        summary["baseline"] = {
+            "valid": len(base_latencies),
+            "latency_ms": {
+                "p50": percentile(base_latencies, 50),
+                "p90": percentile(base_latencies, 90),
+                "p99": base_p99,
+                "max": max(base_latencies) if base_latencies else None,
+            },
+            "requests_sent": len(baseline),
+            "tokens_spent": base_tokens,
+        }
+        summary["p99_improvement"] = round(1 - hedged_p99 / base_p99, 4) if base_p99 and hedged_p99 is not None else None
+        summary["token_overhead"] = round(spent_tokens / base_tokens - 1, 4) if base_tokens else None
+        summary["request_overhead"] = round(len(requests_sent) / len(baseline) - 1, 4) if baseline else None
+    return summary
+
+
+def print_hedging_summary(summary: dict[str, Any], tracker: ModelLatencyTracker) -> None:
+    latency = summary["latency_ms"]
+    print(
+        f"hedged valid={summary['valid']}/{summary['probes']} p50={latency['p50']} p90={latency['p90']} p99={latency['p99']} "
+        f"hedges={summary['hedges_fired']} ({summary['hedge_rate']:.1%}) failovers={summary['failovers']} "
+        f"hedge_wins={summary['hedge_wins']} extra_requests={summary['extra_requests']} extra_tokens={summary['extra_tokens']}"
+    )
+    if "baseline" in summary:
+        base = summary["baseline"]["latency_ms"]
+        print(
+            f"baseline p50={base['p50']} p90={base['p90']} p99={base['p99']} "
+            f"p99_improvement={summary['p99_improvement']} token_overhead={summary['token_overhead']} "
+            f"request_overhead={summary['request_overhead']}"
+        )
+    for model, stats in tracker.snapshot().items():
+        print(
+            f"tracker model={model} ewma_ms={stats['ewma_ms']} p95_ms={stats['p95_ms']} "
+            f"error_ewma={stats['error_ewma']} observations={stats['observations']}"
+        )
+
+
+def run_probe_jobs(
+    diagnoser: AirforceDiagnoser,
+    jobs: list[ProbeJob],
+    max_tokens: int,
+    concurrency: int,
+    stream: bool = False,
+    rate: float = 0.0,
+    hedger: HedgedProber | None = None,
+) -> tuple[list[ProbeResult], int]:
+    """Run chat probes on a bounded thread pool; results keep the order of ``jobs``.
+
+    With ``rate`` > 0 job ``i`` is not started before ``i / rate`` seconds (open-loop arrival).
+    With a ``hedger`` every job goes through :meth:`HedgedProber.probe`.
+    """
+    started = time.time()
+
+    def run(indexed: tuple[int, ProbeJob]) -> ProbeResult:
+        index, job = indexed
+        if rate > 0:
+            delay = started + index / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if hedger is not None:
+            return hedger.probe(job, max_tokens=max_tokens, stream=stream)
+        return diagnoser.probe_chat(
+            model=job.model,
+            prompt_name=job.prompt_name,
+            messages=job.messages,
+            max_tokens=max_tokens,
+            stream=stream,
+            source_lengths=job.source_lengths,
+            keep_translations=job.keep_translations,
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        results = list(pool.map(run, enumerate(jobs)))
+    wall_ms = int((time.time() - started) * 1000)
+    return results, wall_ms
+
+
+def summarize_xml_throughput(results: list[ProbeResult]) -> dict[str, dict[str, Any]]:
+    """Per-model useful throughput: validated segments per second of request time."""
+    summary: dict[str, dict[str, Any]] = {}
+    for r in results:
+        if r.xml_validation is None:
+            continue
+        stats = summary.setdefault(r.model, {"probes": 0, "complete": 0, "valid_segments": 0, "expected_segments": 0, "elapsed_ms": 0})
+        stats["probes"] += 1
+        stats["complete"] += int(bool(r.xml_validation["complete"]))
+        stats["valid_segments"] += r.xml_validation["valid_segments"]
+        stats["expected_segments"] += r.xml_validation["expected_segments"]
+        stats["elapsed_ms"] += r.elapsed_ms
+    for stats in summary.values():
+        stats["segments_per_sec"] = rate_per_sec(stats["valid_segments"], stats["elapsed_ms"])
+        stats["segment_yield"] = round(stats["valid_segments"] / stats["expected_segments"], 4) if stats["expected_segments"] else None
+    return summary
+
+
+def print_xml_throughput(results: list[ProbeResult]) -> None:
+    ranked = sorted(summarize_xml_throughput(results).items(), key=lambda item: -(item[1]["segments_per_sec"] or 0))
+    for model, stats in ranked:
+        print(
+            f"xml model={model} segments_per_sec={stats['segments_per_sec']} yield={stats['segment_yield']} "
+            f"complete={stats['complete']}/{stats['probes']}"
+        )
+
+
+PHASE_SUMMARY_FIELDS = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "download_ms", "retry_wait_ms", "spacing_wait_ms")
+
+
+def summarize_phases(results: list[ProbeResult]) -> dict[str, dict[str, Any]]:
+    """Per-model p50 / p90 of each request phase, plus how many requests reused a pooled connection."""
+    by_model: dict[str, list[ProbeResult]] = {}
+    for r in results:
+        if r.ttfb_ms is not None:
+            by_model.setdefault(r.model, []).append(r)
+    summary: dict[str, dict[str, Any]] = {}
+    for model, items in by_model.items():
+        known = [r for r in items if r.connection_reused is not None]
+        stats: dict[str, Any] = {
+            "requests": len(items),
+            "reused_connections": sum(1 for r in known if r.connection_reused),
+            "known_connections": len(known),
+        }
+        for name in PHASE_SUMMARY_FIELDS:
+            values = [float(getattr(r, name)) for r in items if getattr(r, name) is not None]
+            stats[name] = {"p50": percentile(values, 50), "p90": percentile(values, 90)} if values else None
+        summary[model] = stats
+    return summary
+
+
+def print_phase_summary(results: list[ProbeResult], connection_stats: dict[str, Any]) -> None:
+    for model, stats in summarize_phases(results).items():
+        phases = " ".join(
+            f"{name[:-3]}={stats[name]['p50']}/{stats[name]['p90']}" for name in PHASE_SUMMARY_FIELDS if stats[name] is not None
+        )
+        print(f"phases model={model} p50/p90_ms {phases} reused={stats['reused_connections']}/{stats['known_connections']}")
+    for host, stats in connection_stats.items():
+        print(
+            f"connections host={host} requests={stats['requests']} new={stats['new_connections']} "
+            f"reused={stats['reused_connections']} reuse_rate={stats['reuse_rate']}"
+        )
+
+
+def summarize_prompt_cache(results: list[ProbeResult]) -> dict[str, dict[str, Any]]:
+    """Per-model share of prompt tokens served from the provider's prefix cache (only usage that reports it)."""
+    by_model: dict[str, list[ProbeResult]] = {}
+    for r in results:
+        if r.success and r.prompt_tokens and r.cached_prompt_tokens is not None:
+            by_model.setdefault(r.model, []).append(r)
+    summary: dict[str, dict[str, Any]] = {}
+    for model, items in by_model.items():
+        prompt_tokens = sum(int(r.prompt_tokens or 0) for r in items)
+        cached_tokens = sum(int(r.cached_prompt_tokens or 0) for r in items)
+        summary[model] = {
+            "requests": len(items),
+            "requests_with_hits": sum(1 for r in items if r.cached_prompt_tokens),
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+        }
+    return summary
+
+
+def print_prompt_cache_summary(results: list[ProbeResult]) -> None:
+    for model, stats in summarize_prompt_cache(results).items():
+        print(
+            f"prompt_cache model={model} cached_tokens={stats['cached_prompt_tokens']}/{stats['prompt_tokens']} "
+            f"hit_ratio={stats['hit_ratio']} requests_with_hits={stats['requests_with_hits']}/{stats['requests']}"
+        )
+
+
+def print_limiter_summary(limiter: AdaptiveRateLimiter) -> None:
+    for key, state in limiter.snapshot()["keys"].items():
+        print(
+            f"limiter key={key} rate={state['rate']} range={state['min_rate_seen']}..{state['max_rate_seen']} "
+            f"successes={state['successes']} throttles={state['throttles']} waited_ms={state['waited_ms']}"
+        )
+
+
+def report_origin(base_url: str, cassette: HttpCassette | None) -> dict[str, Any]:
+    """``base_url`` / ``replayed`` report fields; a replay reports the recorded provider, not the CLI default."""
+    if cassette is not None and cassette.replaying:
+        return {"base_url": cassette.recorded_base_url() or base_url, "replayed": True}
+    return {"base_url": base_url, "replayed": False}
+
+
+def print_cassette_summary(cassette: HttpCassette | None) -> None:
+    if cassette is None:
+        return
+    stats = cassette.stats()
+    print(
+        f"cassette mode={stats['mode']} recorded={stats['recorded']} replayed={stats['replayed']} "
+        f"misses={stats['misses']} path={stats['path']}"
+    )
+
+
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+
+def latency_histogram(values_ms: list[int]) -> dict[str, int]:
+    histogram = {f"le_{bound}": 0 for bound in LATENCY_BUCKETS_MS}
+    histogram["inf"] = 0
+    for value in values_ms:
+        for bound in LATENCY_BUCKETS_MS:
+            if value <= bound:
+                histogram[f"le_{bound}"] += 1
+                break
+        else:
+            histogram["inf"] += 1
+    return histogram
+
+
+def summarize_bench(results: list[ProbeResult], wall_ms: int) -> dict[str, dict[str, Any]]:
+    by_model: dict[str, list[ProbeResult]] = {}
+    for r in results:
+        by_model.setdefault(r.model, []).append(r)
+
+    summary: dict[str, dict[str, Any]] = {}
+    for model, items in by_model.items():
+        ok = [r for r in items if r.success and r.http_status is not None and 200 <= r.http_status < 300]
+        latencies = [r.elapsed_ms for r in ok]
+        attempts = sum(r.attempts for r in items)
+        rate_limited = sum(r.rate_limited for r in items)
+        completion_tokens = sum(r.completion_tokens or 0 for r in ok)
+        busy_ms = sum(latencies)
+        ttfts = [r.ttft_ms for r in ok if r.ttft_ms is not None]
+        summary[model] = {
+            "requests": len(items),
+            "succeeded": len(ok),
+            "failed": len(items) - len(ok),
+            "error_rate": round((len(items) - len(ok)) / len(items), 4),
+            "attempts": attempts,
+            "retries": attempts - len(items),
+            "rate_limited": rate_limited,
+            "rate_limited_rate": round(rate_limited / attempts, 4) if attempts else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies) if latencies else None,
+                "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            },
+            "latency_histogram": latency_histogram(latencies),
+            "ttft_ms": {
+                "p50": percentile(ttfts, 50),
+                "p90": percentile(ttfts, 90),
+                "p99": percentile(ttfts, 99),
+            }
+            if ttfts
+            else None,
+            "completion_tokens": completion_tokens,
+            # Per-request generation speed vs. what the endpoint delivered over the whole run.
+            "tokens_per_sec": rate_per_sec(completion_tokens, busy_ms),
+            "tokens_per_sec_wall": rate_per_sec(completion_tokens, wall_ms),
+            "requests_per_sec_wall": rate_per_sec(len(ok), wall_ms),
+        }
+    return summary
+
+
+def add_translation_memory_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--translation-memory",
+        action="store_true",
+        help="Reuse per-segment translations from the local translation memory and only send unseen segments",
+    )
+    parser.add_argument("--tm-db", default=str(TM_DB_PATH))
+    parser.add_argument(
+        "--tm-fuzzy",
+        type=float,
+        default=0.0,
+        help="Report segments at least this similar to a stored one as potential savings; they are still sent (0 = exact matches only)",
+    )
+
+
+def add_cassette_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--cassette", default="", help="HTTP cassette file (.jsonl or .jsonl.gz) to record to or replay from")
+    parser.add_argument(
+        "--cassette-mode",
+        choices=CASSETTE_MODES,
+        default="off",
+        help="record: save every HTTP exchange; replay: serve them offline instantly; replay-realtime: with recorded latencies",
+    )
+
+
+def open_cassette(args: argparse.Namespace) -> HttpCassette | None:
+    if args.cassette_mode == "off":
+        return None
+    if not args.cassette:
+        raise SystemExit("--cassette is required with --cassette-mode")
+    cassette = HttpCassette(Path(args.cassette), mode=args.cassette_mode)
+    print(f"Cassette: mode={cassette.mode} path={cassette.path.resolve()}")
+    return cassette
+
+
+def bench_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py bench",
+        description="Replay chapter-translation requests under load and report latency / 429 statistics",
+    )
+    parser.add_argument("--api-key", default="", help="Airforce API key (not needed with --mock)")
+    parser.add_argument("--base-url", default="https://api.airforce")
+    parser.add_argument("--models", nargs="+", default=["deepseek-v3.2", "deepseek-v3.2-thinking", "glm-5-fast"])
+    parser.add_argument("--requests", type=int, default=20, help="Requests per model")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.0, help="Target request rate per second across all models (0 = closed loop)")
+    parser.add_argument("--timeout-sec", type=int, default=180)
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--min-spacing", type=float, default=0.0)
+    parser.add_argument("--max-rate", type=float, default=10.0)
+    parser.add_argument("--max-retry-wait", type=float, default=120.0, help="Cap in seconds for provider Retry-After / rate-limit reset hints")
+    parser.add_argument("--chapter-url", default="", help="Chapter URL or saved HTML file; defaults to a built-in sample chapter")
+    parser.add_argument("--chapter-max-segments", type=int, default=24)
+    parser.add_argument("--chapter-max-chars", type=int, default=1200)
+    parser.add_argument("--source-lang", default="English")
+    parser.add_argument("--target-lang", default="Russian")
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--mock", action="store_true", help="Run against an in-process StubAirforceServer (no network)")
+    parser.add_argument("--mock-latency-ms", type=int, default=150)
+    parser.add_argument("--mock-chunk-delay-ms", type=int, default=5)
+    parser.add_argument("--mock-rate-limit-every", type=int, default=0)
+    parser.add_argument("--mock-retry-after-sec", type=float, default=0.2)
+    parser.add_argument("--mock-slow-rate", type=float, default=0.0, help="Share of mock chat requests that get --mock-slow-ms extra latency")
+    parser.add_argument("--mock-slow-ms", type=int, default=2000)
+    parser.add_argument("--mock-seed", type=int, default=None)
+    parser.add_argument(
+        "--hedge",
+        choices=("off", "on", "compare"),
+        default="off",
+        help="Hedge slow or failed requests to the next-best model; compare runs the jobs unhedged first and reports the p99 gain vs. extra spend",
+    )
+    parser.add_argument("--hedge-percentile", type=float, default=95.0, help="Hedge once a request is slower than this percentile of its model")
+    parser.add_argument("--hedge-initial-ms", type=float, default=2000.0, help="Hedge delay until a model has enough latency samples")
+    parser.add_argument("--hedge-min-ms", type=float, default=50.0)
+    parser.add_argument("--max-hedges", type=int, default=1, help="Extra models a single request may be sent to")
+    add_cassette_arguments(parser)
+    args = parser.parse_args(argv)
+
+    cassette = open_cassette(args)
+    stub: StubAirforceServer | None = None
+    base_url = args.base_url
+    api_key = args.api_key
+    if cassette is not None and cassette.replaying:
+        api_key = api_key or "sk-replay-" + "0" * 24
+    elif args.mock:
+        stub = StubAirforceServer(
+            latency_ms=args.mock_latency_ms,
+            chunk_delay_ms=args.mock_chunk_delay_ms,
+            rate_limit_every=args.mock_rate_limit_every,
+            retry_after_sec=args.mock_retry_after_sec,
+            models=args.models,
+            slow_rate=args.mock_slow_rate,
+            slow_ms=args.mock_slow_ms,
+            seed=args.mock_seed,
+        ).start()
+        base_url = stub.base_url
+        api_key = api_key or "sk-mock-" + "0" * 24
+
+    ok, notes = run_preflight(
+        base_url=base_url,
+        api_key=api_key,
+        models=args.models,
+        timeout_sec=args.timeout_sec,
+        retries=args.retries,
+        min_spacing=args.min_spacing,
+        concurrency=args.concurrency,
+        max_rate=args.max_rate,
+    )
+    if not ok or args.requests <= 0:
+        print("FAILED preflight:")
+        for note in notes + ([] if args.requests > 0 else ["requests must be > 0"]):
+            print(f"- {note}")
+        if stub is not None:
+            stub.stop()
+        return 2
+
+    try:
+        if args.chapter_url.strip():
+            segments, _ = load_chapter_segments(
+                args.chapter_url.strip(),
+                timeout_sec=args.timeout_sec,
+                max_segments=args.chapter_max_segments,
+                max_chars=args.chapter_max_chars,
+                session=cassette.mount(requests.Session()) if cassette is not None else None,
+            )
+            if not segments:
+                print("FAILED: chapter parsed but no text segments extracted")
+                return 3
+        else:
+            segments = SAMPLE_CHAPTER_SEGMENTS[: args.chapter_max_segments]
+        messages = build_xml_translate_messages(args.source_lang, args.target_lang, segments)
+
+        diagnoser = AirforceDiagnoser(
+            base_url=base_url,
+            api_key=api_key,
+            timeout_sec=args.timeout_sec,
+            retries=args.retries,
+            min_spacing=args.min_spacing,
+            max_rate=args.max_rate,
+            cassette=cassette,
+            max_retry_wait=args.max_retry_wait,
+        )
+        jobs = [
+            ProbeJob(
+                step="bench",
+                model=model,
+                prompt_name="xml_translate_chapter",
+                messages=messages,
+                source_lengths=[len(s) for s in segments],
+            )
+            for _ in range(args.requests)
+            for model in args.models
+        ]
+        print("=== Airforce Bench ===")
+        print(
+            f"BaseUrl: {base_url}{' (mock)' if stub else ''} models={','.join(args.models)} "
+            f"requests={len(jobs)} concurrency={args.concurrency} rate={args.rate or 'unbounded'} segments={len(segments)}"
+            + (f" hedge={args.hedge}" if args.hedge != "off" else "")
+        )
+        tracker = ModelLatencyTracker()
+        baseline: list[ProbeResult] | None = None
+        if args.hedge == "compare":
+            baseline, baseline_wall_ms = run_probe_jobs(
+                diagnoser,
+                jobs,
+                max_tokens=args.max_tokens,
+                concurrency=args.concurrency,
+                stream=args.stream,
+                rate=args.rate,
+            )
+            for r in baseline:
+                tracker.observe(r.model, r.elapsed_ms, ok=probe_is_valid(r))
+            print(f"baseline (unhedged) wall_ms={baseline_wall_ms}")
+        hedger = None
+        if args.hedge != "off":
+            hedger = HedgedProber(
+                diagnoser,
+                args.models,
+                tracker,
+                hedge_percentile=args.hedge_percentile,
+                initial_delay_ms=args.hedge_initial_ms,
+                min_delay_ms=args.hedge_min_ms,
+                max_hedges=args.max_hedges,
+                workers=args.concurrency * (args.max_hedges + 1),
+            )
+        try:
+            results, wall_ms = run_probe_jobs(
+                diagnoser,
+                jobs,
+                max_tokens=args.max_tokens,
+                concurrency=args.concurrency,
+                stream=args.stream,
+                rate=args.rate,
+                hedger=hedger,
+            )
+        finally:
+            if hedger is not None:
+                hedger.close()
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    summary = summarize_bench(results, wall_ms)
+    for model, stats in summary.items():
+        latency = stats["latency_ms"]
+        print(
+            f"model={model} ok={stats['succeeded']}/{stats['requests']} "
+            f"p50={latency['p50']} p90={latency['p90']} p99={latency['p99']} "
+            f"429={stats['rate_limited']} ({stats['rate_limited_rate']:.1%}) retries={stats['retries']} "
+            f"tokens_per_sec={stats['tokens_per_sec']}"
+        )
+    print(f"wall_ms={wall_ms}")
+    hedging = summarize_hedging(results, hedger.requests, baseline) if hedger is not None else None
+    if hedging is not None:
+        print_hedging_summary(hedging, tracker)
+    print_xml_throughput(results)
+    print_phase_summary(results, diagnoser.connection_stats())
+    print_prompt_cache_summary(results)
+    print_limiter_summary(diagnoser.limiter)
+    print_cassette_summary(cassette)
+
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    json_path = REPORT_DIR / f"bench-{timestamp}.json"
+    payload = {
+        "generated_at": now_iso(),
+        "kind": "bench",
+        **report_origin(base_url, cassette),
+        "mock": bool(stub),
+        "cassette": cassette.stats() if cassette is not None else {"mode": "off"},
+        "models": args.models,
+        "config": {
+            "requests_per_model": args.requests,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "stream": args.stream,
+            "segments": len(segments),
+            "max_tokens": args.max_tokens,
+            "hedge": args.hedge,
+            "hedge_percentile": args.hedge_percentile,
+            "max_hedges": args.max_hedges,
+        },
+        "wall_ms": wall_ms,
+        "summary": summary,
+        "hedging": {**hedging, "tracker": tracker.snapshot()} if hedging is not None else None,
+        "xml_throughput": summarize_xml_throughput(results),
+        "phase_timing": summarize_phases(results),
+        "prompt_cache": summarize_prompt_cache(results),
+        "connection_pool": diagnoser.connection_stats(),
+        "rate_limiter": diagnoser.limiter.snapshot(),
+        "results": [{**asdict(r), "body_raw": "", "translations": None} for r in results],
+    }
+    json_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"JSON report: {json_path.resolve()}")
+    return 0
+
+
+def summarize_layout_variant(
+    results: list[ProbeResult], layout: str, prefix_pad_tokens: int, static_prefix_tokens: int, cached_price: float
+) -> dict[str, Any]:
+    """Cold (first request) vs. warm (the rest) TTFT and prompt cost of one prompt-layout variant.
+
+    ``effective`` prompt tokens bill cached tokens at ``cached_price`` of the normal input price.
+    """
+    warm = [r for r in results[1:] if r.success]
+    prompt_tokens = sum(int(r.prompt_tokens or 0) for r in warm)
+    cached_tokens = sum(int(r.cached_prompt_tokens or 0) for r in warm)
+    ttft = [float(r.ttft_ms) for r in warm if r.ttft_ms is not None]
+    return {
+        "layout": layout,
+        "prefix_pad_tokens": prefix_pad_tokens,
+        "requests": len(results),
+        "succeeded": sum(1 for r in results if r.success),
+        "static_prefix_tokens": static_prefix_tokens,
+        "cache_reported": any(r.cached_prompt_tokens is not None for r in results),
+        "cold_ttft_ms": results[0].ttft_ms if results else None,
+        "warm_ttft_ms": {"p50": percentile(ttft, 50), "p90": percentile(ttft, 90)},
+        "warm_prompt_tokens": round(prompt_tokens / len(warm), 1) if warm else None,
+        "warm_cached_prompt_tokens": round(cached_tokens / len(warm), 1) if warm else None,
+        "warm_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+        "warm_effective_prompt_tokens": (
+            round((prompt_tokens - cached_tokens + cached_tokens * cached_price) / len(warm), 1) if warm else None
+        ),
+    }
+
+
+def recommend_layout(variants: dict[str, dict[str, Any]], baseline_layout: str) -> list[dict[str, Any]]:
+    """Best layout per padding level, compared with ``baseline_layout`` at the same level.
+
+    Padding adds the same tokens to every layout of a level but is itself part of the cost, so
+    layouts are only ranked against each other within a level: cheapest fully successful variant
+    by warm effective prompt tokens, then warm TTFT p50. Without cached-token usage from the
+    provider the token figures carry no cache signal, so the ranking falls back to TTFT alone.
+    """
+    levels: dict[int, dict[str, dict[str, Any]]] = {}
+    for name, v in variants.items():
+        levels.setdefault(v["prefix_pad_tokens"], {})[name] = v
+    recommendations = []
+    for pad, level in levels.items():
+        recommendation = recommend_level_layout(level, baseline_layout)
+        if recommendation is not None:
+            recommendations.append({"prefix_pad_tokens": pad, **recommendation})
+    return recommendations
+
+
+def recommend_level_layout(variants: dict[str, dict[str, Any]], baseline_layout: str) -> dict[str, Any] | None:
+    complete = {name: v for name, v in variants.items() if v["succeeded"] == v["requests"] and v["warm_effective_prompt_tokens"] is not None}
+    if not complete:
+        return None
+    reported = any(v["cache_reported"] for v in complete.values())
+
+    def rank(name: str) -> tuple[float, float]:
+        v = complete[name]
+        ttft = v["warm_ttft_ms"]["p50"] if v["warm_ttft_ms"]["p50"] is not None else math.inf
+        return (v["warm_effective_prompt_tokens"], ttft) if reported else (ttft, v["warm_effective_prompt_tokens"])
+
+    best = min(complete, key=rank)
+    baseline = next((name for name, v in variants.items() if v["layout"] == baseline_layout), None)
+    recommendation: dict[str, Any] = {"variant": best, "ranked_by": "effective_prompt_tokens" if reported else "ttft", "baseline": baseline}
+    base = complete.get(baseline) if baseline is not None else None
+    if base is not None:
+        chosen = complete[best]
+        recommendation["effective_prompt_tokens_change"] = (
+            round(chosen["warm_effective_prompt_tokens"] / base["warm_effective_prompt_tokens"] - 1, 4)
+            if base["warm_effective_prompt_tokens"]
+            else None
+        )
+        base_ttft, chosen_ttft = base["warm_ttft_ms"]["p50"], chosen["warm_ttft_ms"]["p50"]
+        recommendation["ttft_p50_change"] = round(chosen_ttft / base_ttft - 1, 4) if base_ttft and chosen_ttft is not None else None
+    return recommendation
 
-            try:
-                body = json.loads(body_raw)
-            except Exception as exc:
-                return ProbeResult(
-                    success=False,
-                    model=model,
-                    prompt=prompt_name,
-                    elapsed_ms=elapsed_ms,
-                    http_status=status,
-                    error=f"Non-JSON response: {exc}",
-                    body_raw=body_raw,
-                )
 
-            if not (200 <= status < 300):
-                err = body.get("error", {}) if isinstance(body, dict) else {}
-                return ProbeResult(
-                    success=False,
-                    model=model,
-                    prompt=prompt_name,
-                    elapsed_ms=elapsed_ms,
-                    http_status=status,
-                    error=str(err.get("message") or f"HTTP {status}"),
-                    error_body=body_raw,
-                    body_raw=body_raw,
-                )
+def prompt_cache_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py prompt-cache",
+        description=(
+            "Compare chat prompt layouts and static-prefix lengths on provider prefix-cache hits, "
+            "TTFT and prompt-token cost. Requests stream so TTFT is measured, and run one at a time "
+            "so each one can reuse the cache entry left by the previous one"
+        ),
+    )
+    parser.add_argument("--api-key", default="", help="Airforce API key (not needed with --mock)")
+    parser.add_argument("--base-url", default="https://api.airforce")
+    parser.add_argument("--models", nargs="+", default=["deepseek-v3.2"])
+    parser.add_argument("--layouts", nargs="+", choices=PROMPT_LAYOUTS, default=list(PROMPT_LAYOUTS))
+    parser.add_argument(
+        "--prefix-pad-tokens",
+        type=int,
+        nargs="+",
+        default=[0, 1024],
+        help="Static padding added to the system prompt, one variant per value (providers often cache nothing below ~1024 tokens)",
+    )
+    parser.add_argument("--requests", type=int, default=6, help="Requests per model and variant; the first one is the cold request")
+    parser.add_argument("--batch-segments", type=int, default=4, help="Segments per request; every request gets a different window")
+    parser.add_argument(
+        "--cached-price", type=float, default=0.5, help="Price of a cached prompt token relative to an uncached one (provider specific)"
+    )
+    parser.add_argument(
+        "--salt",
+        default="",
+        help="Cache-isolation salt put at the start of every prompt (default: random per run; pass the recorded one to replay a cassette)",
+    )
+    parser.add_argument("--timeout-sec", type=int, default=180)
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--min-spacing", type=float, default=0.0)
+    parser.add_argument("--max-rate", type=float, default=10.0)
+    parser.add_argument("--max-retry-wait", type=float, default=120.0, help="Cap in seconds for provider Retry-After / rate-limit reset hints")
+    parser.add_argument("--chapter-url", default="", help="Chapter URL or saved HTML file; defaults to a built-in sample chapter")
+    parser.add_argument("--chapter-max-segments", type=int, default=24)
+    parser.add_argument("--chapter-max-chars", type=int, default=1200)
+    parser.add_argument("--source-lang", default="English")
+    parser.add_argument("--target-lang", default="Russian")
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    parser.add_argument("--mock", action="store_true", help="Run against an in-process StubAirforceServer with a simulated prefix cache")
+    parser.add_argument("--mock-latency-ms", type=int, default=80)
+    parser.add_argument("--mock-chunk-delay-ms", type=int, default=2)
+    parser.add_argument("--mock-prefill-ms-per-1k", type=float, default=150.0)
+    parser.add_argument("--mock-prefix-cache-block-tokens", type=int, default=128)
+    parser.add_argument("--mock-prefix-cache-min-tokens", type=int, default=1024)
+    add_cassette_arguments(parser)
+    args = parser.parse_args(argv)
 
-            choice = ((body.get("choices") or [None])[0]) if isinstance(body, dict) else None
-            message = choice.get("message", {}) if isinstance(choice, dict) else {}
+    cassette = open_cassette(args)
+    stub: StubAirforceServer | None = None
+    base_url = args.base_url
+    api_key = args.api_key
+    if cassette is not None and cassette.replaying:
+        api_key = api_key or "sk-replay-" + "0" * 24
+    elif args.mock:
+        stub = StubAirforceServer(
+            latency_ms=args.mock_latency_ms,
+            chunk_delay_ms=args.mock_chunk_delay_ms,
+            models=args.models,
+            prefill_ms_per_1k=args.mock_prefill_ms_per_1k,
+            cache_block_tokens=args.mock_prefix_cache_block_tokens,
+            cache_min_tokens=args.mock_prefix_cache_min_tokens,
+        ).start()
+        base_url = stub.base_url
+        api_key = api_key or "sk-mock-" + "0" * 24
 
-            message_content = text_from_value(message.get("content"))
-            choice_text = text_from_value(choice.get("text") if isinstance(choice, dict) else None)
-            output_text = text_from_value(choice.get("output_text") if isinstance(choice, dict) else None)
-            reasoning = text_from_value(message.get("reasoning_content")) or text_from_value(message.get("reasoning"))
-            tool_calls = text_from_value(message.get("tool_calls"))
-            usage = body.get("usage", {}) if isinstance(body, dict) else {}
+    ok, notes = run_preflight(
+        base_url=base_url,
+        api_key=api_key,
+        models=args.models,
+        timeout_sec=args.timeout_sec,
+        retries=args.retries,
+        min_spacing=args.min_spacing,
+        max_rate=args.max_rate,
+    )
+    if args.requests < 2:
+        ok, notes = False, notes + ["requests must be >= 2 (one cold request plus warm ones)"]
+    if cassette is not None and cassette.replaying and not args.salt:
+        ok, notes = False, notes + ["--salt of the recorded run is required to replay (every prompt embeds it)"]
+    if not ok:
+        print("FAILED preflight:")
+        for note in notes:
+            print(f"- {note}")
+        if stub is not None:
+            stub.stop()
+        return 2
 
-            return ProbeResult(
-                success=True,
-                model=model,
-                prompt=prompt_name,
-                elapsed_ms=elapsed_ms,
-                http_status=status,
-                finish_reason=str(choice.get("finish_reason", "") if isinstance(choice, dict) else ""),
-                prompt_tokens=usage.get("prompt_tokens"),
-                completion_tokens=usage.get("completion_tokens"),
-                total_tokens=usage.get("total_tokens"),
-                message_content_len=len(message_content),
-                choice_text_len=len(choice_text),
-                output_text_len=len(output_text),
-                reasoning_len=len(reasoning),
-                tool_calls_len=len(tool_calls),
-                body_raw=body_raw,
+    try:
+        if args.chapter_url.strip():
+            segments, _ = load_chapter_segments(
+                args.chapter_url.strip(),
+                timeout_sec=args.timeout_sec,
+                max_segments=args.chapter_max_segments,
+                max_chars=args.chapter_max_chars,
+                session=cassette.mount(requests.Session()) if cassette is not None else None,
             )
-        except Exception as exc:
-            elapsed_ms = int((time.time() - started) * 1000)
-            return ProbeResult(
-                success=False,
-                model=model,
-                prompt=prompt_name,
-                elapsed_ms=elapsed_ms,
-                error=str(exc),
+            if not segments:
+                print("FAILED: chapter parsed but no text segments extracted")
+                return 3
+        else:
+            segments = SAMPLE_CHAPTER_SEGMENTS[: args.chapter_max_segments]
+        batch_size = max(1, min(args.batch_segments, len(segments)))
+        # Sliding windows keep every request's input distinct for up to len(segments) requests.
+        batches = [[segments[(i + k) % len(segments)] for k in range(batch_size)] for i in range(args.requests)]
+        if args.requests > len(segments):
+            print(f"NOTE: {args.requests} requests over {len(segments)} segments repeat inputs; warm hit ratios will be inflated")
+
+        diagnoser = AirforceDiagnoser(
+            base_url=base_url,
+            api_key=api_key,
+            timeout_sec=args.timeout_sec,
+            retries=args.retries,
+            min_spacing=args.min_spacing,
+            max_rate=args.max_rate,
+            cassette=cassette,
+            max_retry_wait=args.max_retry_wait,
+        )
+        # A per-run salt keeps variants (and earlier runs) from warming each other's cache entries.
+        run_salt = args.salt or os.urandom(4).hex()
+        variants = [(layout, pad, layout if pad == 0 else f"{layout}+pad{pad}") for pad in args.prefix_pad_tokens for layout in args.layouts]
+        baseline_layout = "current" if "current" in args.layouts else args.layouts[0]
+        print("=== Airforce Prompt Cache Experiment ===")
+        print(
+            f"BaseUrl: {base_url}{' (mock)' if stub else ''} models={','.join(args.models)} "
+            f"variants={len(variants)} requests_per_variant={args.requests} batch_segments={batch_size} salt={run_salt}"
+        )
+        results: list[ProbeResult] = []
+        summary: dict[str, dict[str, dict[str, Any]]] = {}
+        recommendations: dict[str, list[dict[str, Any]]] = {}
+        for model in args.models:
+            summary[model] = {}
+            for layout, pad, variant in variants:
+                salt = f"cache-probe {run_salt} {model} {variant}"
+                static_prefix = shared_message_prefix(
+                    [
+                        build_layout_messages(layout, args.source_lang, args.target_lang, batches[0], pad, salt),
+                        build_layout_messages(layout, args.source_lang, args.target_lang, [], pad, salt),
+                    ]
+                )
+                variant_results = []
+                for batch in batches:
+                    r = diagnoser.probe_chat(
+                        model=model,
+                        prompt_name=f"prompt_cache:{variant}",
+                        messages=build_layout_messages(layout, args.source_lang, args.target_lang, batch, pad, salt),
+                        max_tokens=args.max_tokens,
+                        stream=True,
+                        source_lengths=[len(s) for s in batch],
+                    )
+                    variant_results.append(r)
+                results.extend(variant_results)
+                stats = summarize_layout_variant(
+                    variant_results, layout, pad, diagnoser.estimator.count(static_prefix, model), args.cached_price
+                )
+                summary[model][variant] = stats
+                print(
+                    f"model={model} variant={variant} ok={stats['succeeded']}/{stats['requests']} "
+                    f"static_prefix_tokens~{stats['static_prefix_tokens']} cold_ttft_ms={stats['cold_ttft_ms']} "
+                    f"warm_ttft_ms=p50:{stats['warm_ttft_ms']['p50']},p90:{stats['warm_ttft_ms']['p90']} "
+                    f"prompt_tokens={stats['warm_prompt_tokens']} cached={stats['warm_cached_prompt_tokens']} "
+                    f"hit_ratio={stats['warm_hit_ratio']} effective_prompt_tokens={stats['warm_effective_prompt_tokens']}"
+                    + ("" if stats["cache_reported"] else " cache_usage=unreported")
+                )
+            recommendations[model] = recommend_layout(summary[model], baseline_layout)
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    for model, model_recommendations in recommendations.items():
+        if not model_recommendations:
+            print(f"recommendation model={model}: no variant completed every request")
+        for recommendation in model_recommendations:
+            print(
+                f"recommendation model={model} pad={recommendation['prefix_pad_tokens']} variant={recommendation['variant']} "
+                f"ranked_by={recommendation['ranked_by']} vs {recommendation['baseline']}: "
+                f"effective_prompt_tokens {recommendation.get('effective_prompt_tokens_change')} "
+                f"ttft_p50 {recommendation.get('ttft_p50_change')}"
             )
+    print_limiter_summary(diagnoser.limiter)
+    print_cassette_summary(cassette)
+
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    json_path = REPORT_DIR / f"prompt-cache-{timestamp}.json"
+    payload = {
+        "generated_at": now_iso(),
+        "kind": "prompt_cache",
+        **report_origin(base_url, cassette),
+        "mock": bool(stub),
+        "cassette": cassette.stats() if cassette is not None else {"mode": "off"},
+        "models": args.models,
+        "config": {
+            "layouts": args.layouts,
+            "prefix_pad_tokens": args.prefix_pad_tokens,
+            "requests_per_variant": args.requests,
+            "batch_segments": batch_size,
+            "cached_price": args.cached_price,
+            "max_tokens": args.max_tokens,
+            "salt": run_salt,
+        },
+        "variants": summary,
+        "recommendations": recommendations,
+        "prompt_cache": summarize_prompt_cache(results),
+        "results": [{**asdict(r), "body_raw": "", "translations": None} for r in results],
+    }
+    json_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"JSON report: {json_path.resolve()}")
+    return 0
 
 
-def main() -> None:
+def run_diagnostics(argv: list[str]) -> None:
     parser = argparse.ArgumentParser(description="Airforce API diagnostics")
-    parser.add_argument("--api-key", required=True, help="Airforce API key")
+    parser.add_argument("--api-key", default="", help="Airforce API key (not needed with --cassette-mode replay)")
     parser.add_argument("--base-url", default="https://api.airforce")
     parser.add_argument("--models", nargs="+", default=["deepseek-v3.2", "deepseek-v3.2-thinking", "glm-5-fast"])
     parser.add_argument("--timeout-sec", type=int, default=180)
     parser.add_argument("--retries", type=int, default=4)
-    parser.add_argument("--min-spacing", type=float, default=1.2)
+    parser.add_argument("--min-spacing", type=float, default=1.2, help="Initial spacing between calls per model/endpoint")
+    parser.add_argument("--max-rate", type=float, default=10.0, help="Upper bound for the adaptive per-model request rate (req/s)")
+    parser.add_argument("--max-retry-wait", type=float, default=120.0, help="Cap in seconds for provider Retry-After / rate-limit reset hints")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of chat probes to run in parallel")
     parser.add_argument("--skip-models-probe", action="store_true", help="Do not call /v1/models to save rate-limit budget")
-    parser.add_argument("--chapter-url", default="", help="Optional chapter URL to build XML translation prompt from real chapter text")
+    parser.add_argument(
+        "--chapter-url",
+        default="",
+        help="Optional chapter URL (or saved chapter HTML file) to build XML translation prompt from real chapter text",
+    )
     parser.add_argument("--chapter-max-segments", type=int, default=24)
     parser.add_argument("--chapter-max-chars", type=int, default=1200)
     parser.add_argument("--source-lang", default="English")
     parser.add_argument("--target-lang", default="Russian")
     parser.add_argument("--max-tokens", type=int, default=4096)
-    args = parser.parse_args()
+    parser.add_argument("--stream", action="store_true", help="Use SSE streaming and record TTFT / chunk timing metrics")
+    parser.add_argument(
+        "--cache-mode",
+        choices=CACHE_MODES,
+        default="off",
+        help="Reuse chapter pages and non-streaming completions from the on-disk response cache",
+    )
+    parser.add_argument("--cache-dir", default=str(CACHE_DIR))
+    parser.add_argument("--cache-ttl-sec", type=float, default=86400.0)
+    parser.add_argument("--cache-max-mb", type=float, default=256.0)
+    add_translation_memory_arguments(parser)
+    add_cassette_arguments(parser)
+    parser.add_argument("--tokenizer", action="append", default=[], help="Exact tokenizer as PREFIX=tiktoken:ENCODING (repeatable)")
+    parser.add_argument("--length-ratio", type=float, default=1.15, help="Expected target/source character ratio for completion estimates")
+    args = parser.parse_args(argv)
 
-    report_dir = Path("build/reports/airforce-diagnostics")
+    report_dir = REPORT_DIR
     report_dir.mkdir(parents=True, exist_ok=True)
 
     print("=== Airforce Diagnostics ===")
     print(f"BaseUrl: {args.base_url}")
     print(f"Models: {', '.join(args.models)}")
     print(f"ReportDir: {report_dir.resolve()}")
+    cassette = open_cassette(args)
+    api_key = args.api_key
+    if cassette is not None and cassette.replaying:
+        api_key = api_key or "sk-replay-" + "0" * 24
 
     print("\n=== Preflight (no API calls) ===")
     ok, preflight_notes = run_preflight(
         base_url=args.base_url,
-        api_key=args.api_key,
+        api_key=api_key,
         models=args.models,
         timeout_sec=args.timeout_sec,
         retries=args.retries,
         min_spacing=args.min_spacing,
+        concurrency=args.concurrency,
+        max_rate=args.max_rate,
     )
     if not ok:
         print("FAILED preflight:")
@@ -401,12 +3974,27 @@ def main() -> None:
     for note in preflight_notes:
         print(f"- {note}")
 
+    cache = None
+    if args.cache_mode != "off":
+        cache = ResponseCache(
+            Path(args.cache_dir),
+            mode=args.cache_mode,
+            ttl_sec=args.cache_ttl_sec,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+        )
+        print(f"Cache: mode={args.cache_mode} dir={Path(args.cache_dir).resolve()}")
+
     diagnoser = AirforceDiagnoser(
         base_url=args.base_url,
-        api_key=args.api_key,
+        api_key=api_key,
         timeout_sec=args.timeout_sec,
         retries=args.retries,
         min_spacing=args.min_spacing,
+        max_rate=args.max_rate,
+        cache=cache,
+        estimator=build_token_estimator(args.tokenizer),
+        cassette=cassette,
+        max_retry_wait=args.max_retry_wait,
     )
 
     if args.skip_models_probe:
@@ -432,20 +4020,22 @@ def main() -> None:
     if args.chapter_url.strip():
         print("\n=== Chapter fetch ===")
         try:
-            chapter_segments, raw_html = fetch_chapter_segments(
-                chapter_url=args.chapter_url.strip(),
+            chapter_segments, html_bytes = load_chapter_segments(
+                args.chapter_url.strip(),
                 timeout_sec=args.timeout_sec,
                 max_segments=args.chapter_max_segments,
                 max_chars=args.chapter_max_chars,
+                cache=cache,
+                session=cassette.mount(requests.Session()) if cassette is not None else None,
             )
             chapter_fetch_info = {
                 "url": args.chapter_url.strip(),
                 "segments_count": len(chapter_segments),
-                "html_size": len(raw_html),
+                "html_size": html_bytes,
                 "sample_segments": chapter_segments[:3],
             }
             print(
-                f"OK chapter fetched, segments={len(chapter_segments)}, html_size={len(raw_html)}, "
+                f"OK chapter fetched, segments={len(chapter_segments)}, html_size={html_bytes}, "
                 f"sample_len={[len(s) for s in chapter_segments[:3]]}"
             )
             if not chapter_segments:
@@ -455,70 +4045,120 @@ def main() -> None:
             print(f"FAILED chapter fetch: {exc}")
             raise SystemExit(3)
 
+    tm: TranslationMemory | None = None
+    tm_plan: TmChapterPlan | None = None
+    if args.translation_memory and chapter_segments:
+        print("\n=== Translation memory ===")
+        tm = TranslationMemory(Path(args.tm_db), args.source_lang, args.target_lang, fuzzy_threshold=args.tm_fuzzy)
+        tm_plan = plan_tm_chapter(tm, chapter_segments)
+        print(
+            f"segments={len(chapter_segments)} exact={len(tm_plan.matches)} "
+            f"fuzzy_candidates={len(tm_plan.fuzzy)} repeats={len(tm_plan.repeats)} "
+            f"unseen={len(tm_plan.unseen)} hit_rate={tm_plan.hit_rate} memory_size={tm.size()}"
+        )
+        if not tm_plan.unseen:
+            print("All segments served from the translation memory; XML probes skipped")
+
     if chapter_segments:
-        tagged_input = to_tagged_input(chapter_segments)
+        xml_segments = tm_plan.unseen if tm_plan is not None else chapter_segments
         prompt_plain = None
-        prompt_xml = [
-            {"role": "system", "content": build_classic_system_prompt()},
-            {
-                "role": "user",
-                "content": build_airforce_user_prompt(
-                    source_lang=args.source_lang,
-                    target_lang=args.target_lang,
-                    tagged_input=tagged_input,
-                ),
-            },
-        ]
+        prompt_xml = build_xml_translate_messages(args.source_lang, args.target_lang, xml_segments) if xml_segments else None
     else:
+        xml_segments = DEFAULT_XML_SEGMENTS
         prompt_plain = [
             {"role": "user", "content": "Reply with exact text: OK"},
         ]
-        prompt_xml = [
-            {"role": "system", "content": build_classic_system_prompt()},
-            {
-                "role": "user",
-                "content": build_airforce_user_prompt(
-                    source_lang="English",
-                    target_lang="Russian",
-                    tagged_input="<s i='0'>Hello world.</s>\n<s i='1'>How are you?</s>",
-                ),
-            },
-        ]
+        prompt_xml = build_xml_translate_messages("English", "Russian", DEFAULT_XML_SEGMENTS)
 
-    results: list[ProbeResult] = []
+    xml_source_lengths = [len(s) for s in xml_segments]
+    jobs: list[ProbeJob] = []
     for model in args.models:
         if prompt_plain is not None:
-            print(f"\n=== Step 2 - model={model} prompt=plain ===")
-            r1 = diagnoser.probe_chat(model=model, prompt_name="plain", messages=prompt_plain, max_tokens=args.max_tokens)
-            results.append(r1)
-            print(
-                f"{'OK' if r1.success else 'FAILED'} status={r1.http_status} elapsed_ms={r1.elapsed_ms} "
-                f"finish_reason={r1.finish_reason} prompt_tokens={r1.prompt_tokens} "
-                f"completion_tokens={r1.completion_tokens} total_tokens={r1.total_tokens} "
-                f"lens=message:{r1.message_content_len},text:{r1.choice_text_len},output_text:{r1.output_text_len},"
-                f"reasoning:{r1.reasoning_len},tool_calls:{r1.tool_calls_len}"
+            jobs.append(ProbeJob(step="Step 2", model=model, prompt_name="plain", messages=prompt_plain))
+        if prompt_xml is None:
+            continue
+        xml_prompt_name = "xml_translate_chapter" if chapter_segments else "xml_translate"
+        jobs.append(
+            ProbeJob(
+                step="Step 3",
+                model=model,
+                prompt_name=xml_prompt_name,
+                messages=prompt_xml,
+                source_lengths=xml_source_lengths,
+                keep_translations=tm is not None,
             )
-            if not r1.success and r1.error:
-                print(f"error={r1.error}")
+        )
 
-        print(f"\n=== Step 3 - model={model} prompt=xml_translate ===")
-        xml_prompt_name = "xml_translate_chapter" if chapter_segments else "xml_translate"
-        r2 = diagnoser.probe_chat(
-            model=model,
-            prompt_name=xml_prompt_name,
-            messages=prompt_xml,
-            max_tokens=args.max_tokens,
+    print("\n=== Token plan (local estimate) ===")
+    xml_source_chars = len(to_tagged_input(xml_segments))
+    token_plan: dict[str, Any] = {}
+    for model in args.models if prompt_xml is not None else []:
+        prompt_estimate = diagnoser.estimator.count_messages(prompt_xml, model)
+        completion_estimate = diagnoser.estimator.predict_completion(xml_source_chars, model, args.length_ratio)
+        length_risk = completion_estimate > args.max_tokens
+        token_plan[model] = {
+            "prompt_tokens_estimate": prompt_estimate,
+            "completion_tokens_estimate": completion_estimate,
+            "length_risk": length_risk,
+            "calibrated": model in diagnoser.estimator.prompt_scale,
+        }
+        print(
+            f"model={model} xml prompt_tokens~{prompt_estimate} completion_tokens~{completion_estimate} "
+            f"max_tokens={args.max_tokens}{' WARNING: likely finish_reason=length' if length_risk else ''}"
+        )
+
+    print(f"\n=== Probes (concurrency={args.concurrency}, jobs={len(jobs)}) ===")
+    results, wall_ms = run_probe_jobs(
+        diagnoser,
+        jobs,
+        max_tokens=args.max_tokens,
+        concurrency=args.concurrency,
+        stream=args.stream,
+    )
+    for job, r in zip(jobs, results):
+        print(f"\n=== {job.step} - model={job.model} prompt={job.prompt_name} ===")
+        print(format_probe_line(r))
+        if not r.success and r.error:
+            print(f"error={r.error}")
+
+    summed_elapsed_ms = sum(r.elapsed_ms for r in results)
+    timing = {
+        "concurrency": args.concurrency,
+        "wall_ms": wall_ms,
+        "summed_elapsed_ms": summed_elapsed_ms,
+        "speedup": round(summed_elapsed_ms / wall_ms, 2) if wall_ms > 0 else None,
+    }
+    print(
+        f"\nwall_ms={timing['wall_ms']} summed_elapsed_ms={timing['summed_elapsed_ms']} "
+        f"speedup={timing['speedup']}"
+    )
+    print_xml_throughput(results)
+    print_phase_summary(results, diagnoser.connection_stats())
+    print_prompt_cache_summary(results)
+    print_limiter_summary(diagnoser.limiter)
+    tm_summary: dict[str, Any] | None = None
+    if tm is not None and tm_plan is not None:
+        stored = store_tm_translations(tm, tm_plan.unseen, results)
+        tm_summary = {
+            **summarize_tm_chapter(tm_plan, diagnoser.estimator, args.models[0], args.source_lang, args.target_lang, args.length_ratio),
+            "stored": stored,
+            "memory_size": tm.size(),
+            "lookups": tm.stats(),
+        }
+        tm.close()
+        print(
+            f"translation_memory hit_rate={tm_summary['hit_rate']} prompt_tokens_saved~{tm_summary['prompt_tokens_saved']} "
+            f"completion_tokens_saved~{tm_summary['completion_tokens_saved']} requests_saved={tm_summary['requests_saved']} "
+            f"stored={stored} memory_size={tm_summary['memory_size']} fuzzy_candidates={tm_summary['fuzzy_candidates']} "
+            f"fuzzy_potential_tokens~{tm_summary['fuzzy_potential_prompt_tokens'] + tm_summary['fuzzy_potential_completion_tokens']}"
         )
-        results.append(r2)
+    if cache is not None:
+        stats = cache.stats()
         print(
-            f"{'OK' if r2.success else 'FAILED'} status={r2.http_status} elapsed_ms={r2.elapsed_ms} "
-            f"finish_reason={r2.finish_reason} prompt_tokens={r2.prompt_tokens} "
-            f"completion_tokens={r2.completion_tokens} total_tokens={r2.total_tokens} "
-            f"lens=message:{r2.message_content_len},text:{r2.choice_text_len},output_text:{r2.output_text_len},"
-            f"reasoning:{r2.reasoning_len},tool_calls:{r2.tool_calls_len}"
+            f"cache hits={stats['hits']} misses={stats['misses']} stale={stats['stale']} "
+            f"revalidated={stats['revalidated']} writes={stats['writes']} evictions={stats['evictions']}"
         )
-        if not r2.success and r2.error:
-            print(f"error={r2.error}")
+    print_cassette_summary(cassette)
 
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     json_path = report_dir / f"diagnostics-{timestamp}.json"
@@ -526,10 +4166,21 @@ def main() -> None:
 
     payload = {
         "generated_at": now_iso(),
-        "base_url": args.base_url,
+        **report_origin(args.base_url, cassette),
         "models": args.models,
         "models_probe": models_probe,
         "chapter_fetch": chapter_fetch_info,
+        "timing": timing,
+        "token_plan": token_plan,
+        "translation_memory": tm_summary,
+        "xml_source_lengths": xml_source_lengths,
+        "xml_throughput": summarize_xml_throughput(results),
+        "phase_timing": summarize_phases(results),
+        "prompt_cache": summarize_prompt_cache(results),
+        "connection_pool": diagnoser.connection_stats(),
+        "rate_limiter": diagnoser.limiter.snapshot(),
+        "cache": cache.stats() if cache is not None else {"mode": "off"},
+        "cassette": cassette.stats() if cassette is not None else {"mode": "off"},
         "results": [asdict(r) for r in results],
     }
     json_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
@@ -539,6 +4190,8 @@ def main() -> None:
         f"generated_at={now_iso()}",
         f"base_url={args.base_url}",
         f"models={','.join(args.models)}",
+        f"concurrency={timing['concurrency']} wall_ms={timing['wall_ms']} "
+        f"summed_elapsed_ms={timing['summed_elapsed_ms']} speedup={timing['speedup']}",
         "",
     ]
     for r in results:
@@ -548,6 +4201,7 @@ def main() -> None:
                 f"finish_reason={r.finish_reason} usage={r.prompt_tokens}/{r.completion_tokens}/{r.total_tokens} "
                 f"lens=message:{r.message_content_len},text:{r.choice_text_len},output_text:{r.output_text_len},"
                 f"reasoning:{r.reasoning_len},tool_calls:{r.tool_calls_len}"
+                + (f" ttft_ms={r.ttft_ms} gap_p90_ms={r.chunk_gap_p90_ms} tokens_per_sec={r.completion_tokens_per_sec}" if r.stream else "")
             )
         else:
             lines.append(
@@ -560,5 +4214,668 @@ def main() -> None:
     print(f"Text summary: {txt_path.resolve()}")
 
 
+def serve_stub_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="airforce-debug-diagnose.py serve-stub", description="Run the offline Airforce API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=int, default=200, help="Delay before the first response byte")
+    parser.add_argument("--chunk-delay-ms", type=int, default=20, help="Delay between SSE chunks")
+    parser.add_argument("--chunk-chars", type=int, default=16)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth chat request with 429 (0 = never)")
+    parser.add_argument("--retry-after-sec", type=float, default=1.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of chat requests that get --slow-ms extra latency")
+    parser.add_argument("--slow-ms", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=0.0, help="Extra first-byte delay per 1000 uncached prompt tokens")
+    parser.add_argument(
+        "--prefix-cache-block-tokens", type=int, default=0, help="Simulate a provider prompt-prefix cache in blocks of N tokens (0 = off)"
+    )
+    parser.add_argument("--prefix-cache-min-tokens", type=int, default=1024, help="Shortest prefix the simulated cache reports")
+    args = parser.parse_args(argv)
+
+    stub = StubAirforceServer(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        chunk_delay_ms=args.chunk_delay_ms,
+        chunk_chars=args.chunk_chars,
+        rate_limit_every=args.rate_limit_every,
+        retry_after_sec=args.retry_after_sec,
+        slow_rate=args.slow_rate,
+        slow_ms=args.slow_ms,
+        seed=args.seed,
+        prefill_ms_per_1k=args.prefill_ms_per_1k,
+        cache_block_tokens=args.prefix_cache_block_tokens,
+        cache_min_tokens=args.prefix_cache_min_tokens,
+    )
+    print(f"Airforce stub listening on {stub.base_url} (Ctrl+C to stop)")
+    try:
+        stub.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.httpd.server_close()
+    return 0
+
+
+def collect_corpus(paths: list[str], suffixes: tuple[str, ...] = (".html", ".htm")) -> list[Path]:
+    files: list[Path] = []
+    for raw in paths:
+        path = Path(raw)
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() in suffixes))
+        elif path.exists():
+            files.append(path)
+    return files
+
+
+def expected_page_segments(path: Path, max_segments: int, max_chars: int) -> list[str] | None:
+    """Reviewed segments of a corpus page from its ``<page>.segments.json`` sidecar, cut and
+    de-duplicated the way the extractors do it; ``None`` if the page has no sidecar."""
+    sidecar = path.with_suffix(".segments.json")
+    if not sidecar.exists():
+        return None
+    segments: list[str] = []
+    for text in json.loads(sidecar.read_text(encoding="utf-8")):
+        text = text[:max_chars].strip()
+        if text and text not in segments:
+            segments.append(text)
+        if len(segments) >= max_segments:
+            break
+    return segments
+
+
+def bench_extract_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py bench-extract",
+        description=(
+            "Compare the streaming chapter extractor with the legacy regex extractor on saved pages. "
+            "Pages with a <page>.segments.json sidecar are also checked against its reviewed segments; "
+            "the exit code is 1 if the streaming extractor disagrees with one"
+        ),
+    )
+    parser.add_argument("corpus", nargs="*", default=[str(CHAPTER_FIXTURES_DIR)], help="Saved chapter pages or directories")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--max-segments", type=int, default=24)
+    parser.add_argument("--max-chars", type=int, default=1200)
+    args = parser.parse_args(argv)
+
+    files = collect_corpus(args.corpus)
+    if not files:
+        print("No chapter pages found")
+        return 2
+
+    def run_legacy(path: Path) -> list[str]:
+        return extract_segments_legacy(path.read_text(encoding="utf-8", errors="replace"), args.max_segments, args.max_chars)
+
+    def run_streaming(path: Path) -> list[str]:
+        return read_chapter_file_segments(path, args.max_segments, args.max_chars)[0]
+
+    totals = {"legacy": 0.0, "streaming": 0.0}
+    rows: list[dict[str, Any]] = []
+    mismatches = 0
+    for path in files:
+        row: dict[str, Any] = {"file": str(path), "bytes": path.stat().st_size}
+        outputs: dict[str, list[str]] = {}
+        for name, func in (("legacy", run_legacy), ("streaming", run_streaming)):
+            started = time.perf_counter()
+            for _ in range(max(1, args.repeat)):
+                outputs[name] = func(path)
+            elapsed_ms = (time.perf_counter() - started) * 1000 / max(1, args.repeat)
+            tracemalloc.start()
+            func(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            totals[name] += elapsed_ms
+            row[f"{name}_ms"] = round(elapsed_ms, 3)
+            row[f"{name}_peak_kb"] = round(peak / 1024, 1)
+            row[f"{name}_segments"] = len(outputs[name])
+        # The extractors are expected to differ on the fixtures (the legacy regex takes <pre> and
+        # <p> inside scripts for paragraphs); which one is right is decided by the sidecar.
+        row["identical"] = outputs["legacy"] == outputs["streaming"]
+        expected = expected_page_segments(path, args.max_segments, args.max_chars)
+        line = (
+            f"{path.name}: bytes={row['bytes']} "
+            f"legacy={row['legacy_ms']}ms/{row['legacy_peak_kb']}KiB/{row['legacy_segments']} seg "
+            f"streaming={row['streaming_ms']}ms/{row['streaming_peak_kb']}KiB/{row['streaming_segments']} seg "
+            f"identical={row['identical']}"
+        )
+        if expected is not None:
+            row["legacy_expected"] = outputs["legacy"] == expected
+            row["streaming_expected"] = outputs["streaming"] == expected
+            mismatches += not row["streaming_expected"]
+            line += f" expected=legacy:{row['legacy_expected']},streaming:{row['streaming_expected']}"
+        rows.append(row)
+        print(line)
+    print(f"total legacy_ms={totals['legacy']:.3f} streaming_ms={totals['streaming']:.3f}")
+    if mismatches:
+        print(f"FAILED: streaming extractor disagrees with the reviewed segments of {mismatches} page(s)")
+        return 1
+    return 0
+
+
+def read_chapter_list(paths: list[str], list_file: str) -> list[str]:
+    sources = [p for p in paths if p.strip()]
+    if list_file:
+        for line in Path(list_file).read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                sources.append(line)
+    return sources
+
+
+def plan_volume_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py plan-volume",
+        description="Segment a whole volume and estimate how many translation requests and tokens it costs",
+    )
+    parser.add_argument("chapters", nargs="*", help="Chapter URLs or saved chapter HTML files, in reading order")
+    parser.add_argument("--chapters-file", default="", help="File with one chapter URL or path per line")
+    parser.add_argument("--concurrency", type=int, default=4, help="Chapters extracted in parallel")
+    parser.add_argument("--timeout-sec", type=int, default=60)
+    parser.add_argument("--chapter-max-segments", type=int, default=100000)
+    parser.add_argument("--chapter-max-chars", type=int, default=1200)
+    parser.add_argument("--token-budgets", type=int, nargs="+", default=[1000, 2000, 4000, 8000], help="Prompt token budgets to compare")
+    parser.add_argument("--cross-chapter", action="store_true", help="Allow one request to span chapter boundaries")
+    parser.add_argument("--model", default="deepseek-v3.2", help="Model whose tokenizer / calibration is used for estimates")
+    parser.add_argument("--tokenizer", action="append", default=[], help="Exact tokenizer as PREFIX=tiktoken:ENCODING (repeatable)")
+    parser.add_argument("--length-ratio", type=float, default=1.15, help="Expected target/source character ratio")
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--requests-per-minute", type=float, default=0.0, help="Provider limit used to estimate wall time")
+    parser.add_argument("--source-lang", default="English")
+    parser.add_argument("--target-lang", default="Russian")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default="off")
+    parser.add_argument("--cache-dir", default=str(CACHE_DIR))
+    add_translation_memory_arguments(parser)
+    add_cassette_arguments(parser)
+    args = parser.parse_args(argv)
+
+    sources = read_chapter_list(args.chapters, args.chapters_file)
+    if not sources:
+        print("No chapters given")
+        return 2
+    cache = ResponseCache(Path(args.cache_dir), mode=args.cache_mode) if args.cache_mode != "off" else None
+    cassette = open_cassette(args)
+
+    def extract(source: str) -> tuple[list[str], int, str]:
+        try:
+            session = cassette.mount(requests.Session()) if cassette is not None else None
+            segments, size = load_chapter_segments(
+                source, args.timeout_sec, args.chapter_max_segments, args.chapter_max_chars, cache, session=session
+            )
+            return segments, size, ""
+        except Exception as exc:
+            return [], 0, str(exc)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        extracted = list(pool.map(extract, sources))
+    extract_ms = int((time.time() - started) * 1000)
+
+    chapters: list[list[str]] = []
+    chapter_info: list[dict[str, Any]] = []
+    for source, (segments, size, error) in zip(sources, extracted):
+        chapters.append(segments)
+        chapter_info.append({"source": source, "segments": len(segments), "chars": sum(len(s) for s in segments), "html_bytes": size, "error": error})
+        print(f"{'OK' if not error else 'FAILED'} {source} segments={len(segments)} chars={chapter_info[-1]['chars']}{' error=' + error if error else ''}")
+
+    estimator = build_token_estimator(args.tokenizer)
+    # With a translation memory, chapters are planned in reading order: known segments and
+    # repeats of segments already planned earlier in the volume are not sent again.
+    tm_chapters: list[list[str]] | None = None
+    tm_stats: list[dict[str, Any]] = []
+    if args.translation_memory:
+        tm = TranslationMemory(Path(args.tm_db), args.source_lang, args.target_lang, fuzzy_threshold=args.tm_fuzzy)
+        seen: dict[str, int] = {}
+        tm_chapters = []
+        for segments in chapters:
+            tm_plan = plan_tm_chapter(tm, segments, seen)
+            tm_chapters.append(tm_plan.unseen)
+            tm_stats.append(summarize_tm_chapter(tm_plan, estimator, args.model, args.source_lang, args.target_lang, args.length_ratio))
+        tm.close()
+
+    def pack(chapter_segments: list[list[str]], budget: int) -> list[PackedPrompt]:
+        return pack_segments(
+            chapter_segments,
+            budget,
+            args.source_lang,
+            args.target_lang,
+            cross_chapter=args.cross_chapter,
+            estimator=estimator,
+            model=args.model,
+            max_tokens=args.max_tokens,
+            length_ratio=args.length_ratio,
+        )
+
+    plans = []
+    tm_packed: dict[int, tuple[list[PackedPrompt], list[PackedPrompt]]] = {}
+    for budget in args.token_budgets:
+        packed = pack(chapters, budget)
+        plan = summarize_packing(packed, budget)
+        if tm_chapters is not None:
+            packed_tm = pack(tm_chapters, budget)
+            tm_plan_summary = summarize_packing(packed_tm, budget)
+            tm_packed[budget] = (packed, packed_tm)
+            plan["translation_memory"] = {
+                "requests": tm_plan_summary["requests"],
+                "requests_saved": plan["requests"] - tm_plan_summary["requests"],
+                "total_tokens_estimate": tm_plan_summary["total_tokens_estimate"],
+                "tokens_saved": plan["total_tokens_estimate"] - tm_plan_summary["total_tokens_estimate"],
+            }
+        if args.requests_per_minute > 0:
+            plan["estimated_minutes"] = round(plan["requests"] / args.requests_per_minute, 2)
+        plans.append(plan)
+
+    feasible = [p for p in plans if p["requests"] and not p["requests_over_max_tokens"]]
+    best = min(feasible, key=lambda p: (p["requests"], p["total_tokens_estimate"])) if feasible else None
+
+    print(f"\nchapters={len(chapters)} segments={sum(len(c) for c in chapters)} extract_ms={extract_ms}")
+    for plan in plans:
+        print(
+            f"budget={plan['token_budget']} requests={plan['requests']} prompt_tokens={plan['prompt_tokens']} "
+            f"completion_est={plan['completion_tokens_estimate']} overhead={plan['overhead_tokens']} "
+            f"fill={plan['mean_fill']} over_max_tokens={plan['requests_over_max_tokens']}"
+            + (f" minutes={plan['estimated_minutes']}" if "estimated_minutes" in plan else "")
+        )
+    if best is not None:
+        print(f"recommended token_budget={best['token_budget']} ({best['requests']} requests)")
+    else:
+        print("no budget fits --max-tokens; lower the budget or raise max tokens")
+
+    if tm_chapters is not None:
+        # Per-chapter request savings are counted at the recommended budget (first budget otherwise),
+        # attributing each packed request to the chapter it starts in.
+        budget = best["token_budget"] if best is not None else args.token_budgets[0]
+        packed, packed_tm = tm_packed[budget]
+        for index, stats in enumerate(tm_stats):
+            stats["requests"] = sum(1 for p in packed if p.chapters and p.chapters[0] == index)
+            stats["requests_with_tm"] = sum(1 for p in packed_tm if p.chapters and p.chapters[0] == index)
+            stats["requests_saved"] = stats["requests"] - stats["requests_with_tm"]
+            chapter_info[index]["translation_memory"] = stats
+        print(f"\ntranslation memory (token_budget={budget}):")
+        for source, stats in zip(sources, tm_stats):
+            print(
+                f"{source} hit_rate={stats['hit_rate']} exact={stats['exact_hits']} fuzzy_candidates={stats['fuzzy_candidates']} "
+                f"repeats={stats['repeats']} unseen={stats['unseen']} "
+                f"tokens_saved~{stats['prompt_tokens_saved'] + stats['completion_tokens_saved']} "
+                f"requests={stats['requests_with_tm']}/{stats['requests']}"
+            )
+        for plan in plans:
+            saved = plan["translation_memory"]
+            print(
+                f"budget={plan['token_budget']} requests_with_tm={saved['requests']} requests_saved={saved['requests_saved']} "
+                f"tokens_saved~{saved['tokens_saved']}"
+            )
+
+    REPORT_DIR.mkdir(parents=True, exist_ok=True)
+    json_path = REPORT_DIR / f"volume-plan-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    payload = {
+        "generated_at": now_iso(),
+        "kind": "volume_plan",
+        "config": {
+            "cross_chapter": args.cross_chapter,
+            "model": args.model,
+            "length_ratio": args.length_ratio,
+            "max_tokens": args.max_tokens,
+            "chapter_max_chars": args.chapter_max_chars,
+        },
+        "extract_ms": extract_ms,
+        "chapters": chapter_info,
+        "token_estimator": estimator.to_dict(),
+        "plans": plans,
+        "recommended_token_budget": best["token_budget"] if best else None,
+    }
+    json_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"JSON report: {json_path.resolve()}")
+    return 0 if all(not info["error"] for info in chapter_info) else 3
+
+
+def calibrate_tokens_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py calibrate-tokens",
+        description="Fit the local token estimator to provider usage recorded in earlier reports",
+    )
+    parser.add_argument("reports", nargs="*", help="Report JSON files (default: all diagnostics/bench reports)")
+    parser.add_argument("--tokenizer", action="append", default=[], help="Exact tokenizer as PREFIX=tiktoken:ENCODING (repeatable)")
+    parser.add_argument("--output", default=str(TOKEN_CALIBRATION_PATH))
+    args = parser.parse_args(argv)
+
+    paths = [Path(p) for p in args.reports] or sorted(REPORT_DIR.glob("diagnostics-*.json")) + sorted(REPORT_DIR.glob("bench-*.json"))
+    estimator = build_token_estimator(args.tokenizer, calibration_path=None)
+    count = estimator.calibrate_from_reports(paths)
+    if not estimator.samples:
+        print(f"No results with both prompt_tokens and prompt_tokens_estimate in {len(paths)} report(s)")
+        return 2
+    for model in sorted(set(estimator.prompt_scale) | set(estimator.output_chars_per_token)):
+        print(
+            f"model={model} samples={estimator.samples.get(model, 0)} prompt_scale={estimator.prompt_scale.get(model)} "
+            f"output_chars_per_token={estimator.output_chars_per_token.get(model)}"
+        )
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({"generated_at": now_iso(), "results_seen": count, **estimator.to_dict()}, indent=2), encoding="utf-8")
+    print(f"Calibration: {output.resolve()}")
+    return 0
+
+
+def validate_report_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py validate",
+        description="Re-validate XML translation output stored in saved diagnostics reports",
+    )
+    parser.add_argument("reports", nargs="*", help="Report JSON files (default: all diagnostics reports)")
+    args = parser.parse_args(argv)
+
+    paths = [Path(p) for p in args.reports] or sorted(REPORT_DIR.glob("diagnostics-*.json"))
+    checked = 0
+    incomplete = 0
+    for path in paths:
+        try:
+            report = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as exc:
+            print(f"SKIP {path}: {exc}")
+            continue
+        # Reports written before xml_source_lengths existed only used the built-in sample prompt.
+        source_lengths = report.get("xml_source_lengths")
+        if source_lengths is None and not report.get("chapter_fetch"):
+            source_lengths = [len(s) for s in DEFAULT_XML_SEGMENTS]
+        if source_lengths is None:
+            print(f"SKIP {path}: no xml_source_lengths recorded")
+            continue
+        for r in report.get("results") or []:
+            if not str(r.get("prompt", "")).startswith("xml_translate") or not r.get("success"):
+                continue
+            validation = r.get("xml_validation")
+            if r.get("body_raw"):
+                try:
+                    body = json.loads(r["body_raw"])
+                    choice = (body.get("choices") or [{}])[0]
+                    content = text_from_value((choice.get("message") or {}).get("content")) or text_from_value(choice.get("text"))
+                    validation = validate_xml_response(content, source_lengths)
+                except (ValueError, AttributeError, IndexError):
+                    validation = None
+            if validation is None:
+                continue
+            checked += 1
+            incomplete += int(not validation["complete"])
+            print(
+                f"{'OK' if validation['complete'] else 'INCOMPLETE'} {path.name} model={r.get('model')} "
+                f"valid={validation['valid_segments']}/{validation['expected_segments']} missing={validation['missing']} "
+                f"duplicated={validation['duplicated']} reordered={validation['reordered']} truncated={validation['truncated']} "
+                f"ratio_p50={validation['length_ratio']['p50']} segments_per_sec={rate_per_sec(validation['valid_segments'], int(r.get('elapsed_ms') or 0))}"
+            )
+    print(f"checked={checked} incomplete={incomplete}")
+    return 0 if checked else 2
+
+
+HISTORY_DB_PATH = REPORT_DIR / "history.sqlite"
+
+
+def is_offline_report(report: dict[str, Any]) -> bool:
+    """True for runs against the in-process stub or replayed from a cassette."""
+    cassette = report.get("cassette") or {}
+    return bool(report.get("mock") or report.get("replayed")) or cassette.get("mode") in ("replay", "replay-realtime")
+
+
+def mann_whitney_greater(recent: list[float], baseline: list[float]) -> float | None:
+    """One-sided Mann-Whitney U p-value for "recent is stochastically larger than baseline".
+
+    Normal approximation with tie and continuity correction; ``None`` when either side is too small.
+    """
+    n1, n2 = len(recent), len(baseline)
+    if n1 < 2 or n2 < 3:
+        return None
+    combined = sorted([(v, 0) for v in recent] + [(v, 1) for v in baseline])
+    n = n1 + n2
+    rank_sum = 0.0
+    tie_term = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        average_rank = (i + j) / 2 + 1
+        ties = j - i + 1
+        tie_term += ties**3 - ties
+        rank_sum += average_rank * sum(1 for k in range(i, j + 1) if combined[k][1] == 0)
+        i = j + 1
+    u = rank_sum - n1 * (n1 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return None
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+class HistoryStore:
+    """SQLite index over the JSON reports in ``build/reports/airforce-diagnostics``.
+
+    ``ingest`` only parses files it has not seen (by name, size and mtime), so the store can be
+    refreshed after every run. The ``.txt`` summaries duplicate the JSON and are not ingested, and
+    neither are offline runs (``--mock`` stubs and cassette replays), whose latencies say nothing
+    about the provider. The store is only an index over the reports, so a schema change drops it
+    and the next ``ingest`` rebuilds it.
+    """
+
+    REPORT_PATTERNS = ("diagnostics-*.json", "bench-*.json")
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db_path: Path) -> None:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(db_path))
+        self.skipped_offline = 0
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.conn.executescript("DROP TABLE IF EXISTS probes; DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS ingested;")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS ingested (file TEXT PRIMARY KEY, size INTEGER, mtime REAL);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file TEXT UNIQUE,
+                kind TEXT,
+                generated_at TEXT,
+                base_url TEXT
+            );
+            CREATE TABLE IF NOT EXISTS probes (
+                run_id INTEGER REFERENCES runs(id),
+                model TEXT,
+                prompt TEXT,
+                success INTEGER,
+                http_status INTEGER,
+                elapsed_ms INTEGER,
+                ttft_ms INTEGER,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                finish_reason TEXT,
+                cached INTEGER,
+                stream INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS probes_series ON probes (model, prompt, run_id);
+            CREATE INDEX IF NOT EXISTS runs_base_url ON runs (base_url);
+            """
+        )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def ingest(self, report_dir: Path) -> int:
+        known = {row[0]: (row[1], row[2]) for row in self.conn.execute("SELECT file, size, mtime FROM ingested")}
+        added = 0
+        for pattern in self.REPORT_PATTERNS:
+            for path in sorted(report_dir.glob(pattern)):
+                stat = path.stat()
+                if known.get(path.name) == (stat.st_size, stat.st_mtime):
+                    continue
+                try:
+                    report = json.loads(path.read_text(encoding="utf-8"))
+                except (OSError, ValueError):
+                    continue
+                with self.conn:
+                    self.conn.execute("DELETE FROM probes WHERE run_id IN (SELECT id FROM runs WHERE file = ?)", (path.name,))
+                    self.conn.execute("DELETE FROM runs WHERE file = ?", (path.name,))
+                    if is_offline_report(report):
+                        self.conn.execute("INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)", (path.name, stat.st_size, stat.st_mtime))
+                        self.skipped_offline += 1
+                        continue
+                    cursor = self.conn.execute(
+                        "INSERT INTO runs (file, kind, generated_at, base_url) VALUES (?, ?, ?, ?)",
+                        (path.name, report.get("kind") or "diagnostics", report.get("generated_at") or "", report.get("base_url") or ""),
+                    )
+                    self.conn.executemany(
+                        "INSERT INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                cursor.lastrowid,
+                                r.get("model"),
+                                r.get("prompt"),
+                                int(bool(r.get("success"))),
+                                r.get("http_status"),
+                                r.get("elapsed_ms"),
+                                r.get("ttft_ms"),
+                                r.get("prompt_tokens"),
+                                r.get("completion_tokens"),
+                                r.get("finish_reason") or "",
+                                int(bool(r.get("cached"))),
+                                int(bool(r.get("stream"))),
+                            )
+                            for r in report.get("results") or []
+                        ],
+                    )
+                    self.conn.execute("INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)", (path.name, stat.st_size, stat.st_mtime))
+                added += 1
+        return added
+
+    def series(self, kind: str = "") -> dict[tuple[str, str, str], list[dict[str, Any]]]:
+        """Per (base_url, model, prompt): one entry per run in chronological order, with the raw latencies."""
+        query = (
+            "SELECT r.id, r.generated_at, r.file, r.base_url, p.model, p.prompt, p.success, p.elapsed_ms, p.prompt_tokens, "
+            "p.completion_tokens, p.cached FROM probes p JOIN runs r ON r.id = p.run_id"
+        )
+        params: tuple[Any, ...] = ()
+        if kind:
+            query += " WHERE r.kind = ?"
+            params = (kind,)
+        query += " ORDER BY r.generated_at, r.id"
+        grouped: dict[tuple[str, str, str], dict[int, dict[str, Any]]] = {}
+        rows = self.conn.execute(query, params)
+        for run_id, generated_at, file, base_url, model, prompt, success, elapsed_ms, prompt_tokens, completion_tokens, cached in rows:
+            run = grouped.setdefault((base_url, model, prompt), {}).setdefault(
+                run_id,
+                {"generated_at": generated_at, "file": file, "probes": 0, "failures": 0, "latencies": [], "prompt_tokens": [], "completion_tokens": []},
+            )
+            run["probes"] += 1
+            if not success:
+                run["failures"] += 1
+                continue
+            if cached:
+                continue
+            run["latencies"].append(elapsed_ms)
+            if prompt_tokens is not None:
+                run["prompt_tokens"].append(prompt_tokens)
+            if completion_tokens is not None:
+                run["completion_tokens"].append(completion_tokens)
+        return {key: list(runs.values()) for key, runs in grouped.items()}
+
+
+def compare_series(
+    runs: list[dict[str, Any]],
+    recent_runs: int,
+    baseline_runs: int,
+    alpha: float,
+    min_increase: float,
+) -> dict[str, Any]:
+    recent = runs[-recent_runs:]
+    baseline = runs[-(recent_runs + baseline_runs) : -recent_runs] if len(runs) > recent_runs else []
+    recent_latencies = [v for run in recent for v in run["latencies"]]
+    baseline_latencies = [v for run in baseline for v in run["latencies"]]
+    recent_p50 = percentile(recent_latencies, 50)
+    baseline_p50 = percentile(baseline_latencies, 50)
+    p_value = mann_whitney_greater(recent_latencies, baseline_latencies)
+    ratio = round(recent_p50 / baseline_p50, 3) if recent_p50 is not None and baseline_p50 else None
+    return {
+        "recent_runs": len(recent),
+        "baseline_runs": len(baseline),
+        "recent_p50_ms": recent_p50,
+        "baseline_p50_ms": baseline_p50,
+        "p50_ratio": ratio,
+        "p_value": round(p_value, 5) if p_value is not None else None,
+        "regression": p_value is not None and p_value < alpha and ratio is not None and ratio >= 1 + min_increase,
+    }
+
+
+def compare_main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="airforce-debug-diagnose.py compare",
+        description="Ingest new reports into the history store and show per-model trends across runs",
+    )
+    parser.add_argument("--report-dir", default=str(REPORT_DIR))
+    parser.add_argument("--db", default=str(HISTORY_DB_PATH))
+    parser.add_argument("--kind", choices=["", "diagnostics", "bench"], default="", help="Only compare runs of this kind")
+    parser.add_argument("--runs", type=int, default=8, help="Runs shown per model/prompt trend")
+    parser.add_argument("--recent", type=int, default=3, help="Latest runs tested against the baseline")
+    parser.add_argument("--baseline", type=int, default=10, help="Earlier runs forming the baseline")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--min-increase", type=float, default=0.1, help="Smallest p50 increase (fraction) reported as regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit 4 when a latency regression is flagged")
+    args = parser.parse_args(argv)
+    if args.recent <= 0 or args.baseline <= 0:
+        parser.error("--recent and --baseline must be > 0")
+
+    store = HistoryStore(Path(args.db))
+    try:
+        added = store.ingest(Path(args.report_dir))
+        series = store.series(args.kind)
+        skipped = store.skipped_offline
+    finally:
+        store.close()
+    print(f"ingested_new_files={added} skipped_offline_files={skipped} series={len(series)}")
+
+    regressions: list[str] = []
+    for (base_url, model, prompt), runs in sorted(series.items()):
+        print(f"\nbase_url={base_url} model={model} prompt={prompt} runs={len(runs)}")
+        for run in runs[-args.runs :]:
+            prompt_tokens = run["prompt_tokens"]
+            completion_tokens = run["completion_tokens"]
+            print(
+                f"  {run['generated_at'][:19]} p50_ms={percentile(run['latencies'], 50)} p90_ms={percentile(run['latencies'], 90)} "
+                f"failure_rate={run['failures'] / run['probes']:.2f} "
+                f"prompt_tokens={round(sum(prompt_tokens) / len(prompt_tokens)) if prompt_tokens else None} "
+                f"completion_tokens={round(sum(completion_tokens) / len(completion_tokens)) if completion_tokens else None}"
+            )
+        verdict = compare_series(runs, args.recent, args.baseline, args.alpha, args.min_increase)
+        print(
+            f"  recent_p50={verdict['recent_p50_ms']} baseline_p50={verdict['baseline_p50_ms']} "
+            f"ratio={verdict['p50_ratio']} p={verdict['p_value']}{' REGRESSION' if verdict['regression'] else ''}"
+        )
+        if verdict["regression"]:
+            regressions.append(f"{model}/{prompt}@{base_url}")
+
+    if regressions:
+        print(f"\nlatency_regressions: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            return 4
+    return 0
+
+
+COMMANDS: dict[str, Callable[[list[str]], int]] = {
+    "bench": bench_main,
+    "bench-extract": bench_extract_main,
+    "calibrate-tokens": calibrate_tokens_main,
+    "compare": compare_main,
+    "plan-volume": plan_volume_main,
+    "prompt-cache": prompt_cache_main,
+    "serve-stub": serve_stub_main,
+    "validate": validate_report_main,
+}
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        raise SystemExit(COMMANDS[argv[0]](argv[1:]))
+    run_diagnostics(argv)
+
+
 if __name__ == "__main__":
     main()
@@ -4,33 +4,308 @@
 Usage:
   python tools/ci/report-release-warnings.py r8_minify_release_after_proguard.log
   python tools/ci/report-release-warnings.py r8_minify_release_after_proguard.log --enforce
+  python tools/ci/report-release-warnings.py build_release.log --config tools/ci/release-warnings.json --enforce
+  python tools/ci/report-release-warnings.py "build/logs/**/*.log" --jobs 4 --json build/reports/release-warnings.json
+  python tools/ci/report-release-warnings.py build_release.log --baseline warnings-baseline.txt --enforce-new
+  python tools/ci/report-release-warnings.py --benchmark
 """
 
 from __future__ import annotations
 
 import argparse
+import codecs
+import glob
+import hashlib
+import io
+import json
+import math
+import os
 import re
+import tempfile
+import time
+import tracemalloc
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any, BinaryIO, Callable
 
-ALLOWED_MAX = {
-    "kotlin_metadata": 0,
-    "field_rule": 1,
-    "context_receivers_warning": 0,
-    "aapt_non_positional_format": 0,
-    "missing_class": 0,
-}
+DEFAULT_CONFIG_PATH = Path(__file__).with_name("release-warnings.json")
+
+# Phrases of the original hard-coded categories, used by the legacy reader and the synthetic log.
+KOTLIN_METADATA_TEXT = "An error occurred when parsing kotlin metadata"
+FIELD_RULE_TEXT = "is used in a field rule"
+CONTEXT_RECEIVERS_TEXT = "Experimental context receivers are superseded by context parameters"
+AAPT_NON_POSITIONAL_TEXT = "Multiple substitutions specified in non-positional format of string resource"
+MISSING_CLASS_TEXT = "Missing class"
+
+MISSING_RE = re.compile(r"Missing class\s+([^\s]+)")
+AAPT_KEY_RE = re.compile(r"string/([A-Za-z0-9_]+)")
+
+# Absolute checkout prefixes differ between machines; keep paths from the module directory ("app/src/...").
+CHECKOUT_PATH_RE = re.compile(r"(?:file:/*)?(?:[A-Za-z]:)?[\\/](?:[^\s\\/:]+[\\/])*?(?=[^\s\\/:]+[\\/]src[\\/])")
+DIGITS_RE = re.compile(r"(?<![A-Za-z_$])\d+")
+SIGNATURE_MAX_CHARS = 300
+BASELINE_HEADER = "# report-release-warnings baseline v1"
+
+# Rewrites that let a rule pattern sit inside the combined trigger: named groups would clash
+# between rules and leading global flags are only legal at the very start of a pattern.
+NAMED_GROUP_RE = re.compile(r"(?<!\\)\(\?P<[A-Za-z_][A-Za-z0-9_]*>")
+GLOBAL_FLAGS_RE = re.compile(r"\(\?([aiLmsux]+)\)")
+# Back-references count groups of their own pattern and cannot be renumbered into the trigger.
+BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+READ_BYTES = 1 << 20
+DEFAULT_SHARD_MB = 64
+
+
+@dataclass
+class WarningRule:
+    """One warning category from release-warnings.json.
+
+    A line counts once per rule when ``pattern`` matches. Lines are optionally aggregated on
+    ``aggregate_group`` of ``pattern`` or on group 1 of ``aggregate_pattern``.
+    """
+
+    name: str
+    pattern: re.Pattern[str]
+    max: int | None = None
+    aggregate_group: int | None = None
+    aggregate_pattern: re.Pattern[str] | None = None
+    report: str = ""
+    report_top: int | None = None
+
+    @property
+    def aggregates(self) -> bool:
+        return self.aggregate_group is not None or self.aggregate_pattern is not None
+
+    def aggregate_key(self, line: str, match: re.Match[str]) -> str | None:
+        if self.aggregate_group is not None:
+            return match.group(self.aggregate_group)
+        if self.aggregate_pattern is not None:
+            key_match = self.aggregate_pattern.search(line)
+            return key_match.group(1) if key_match else None
+        return None
+
+
+class RuleSet:
+    """All rules compiled into one trigger regex, so the log is searched once however many rules exist."""
+
+    def __init__(self, rules: list[WarningRule], report_order: list[str] | None = None) -> None:
+        self.rules = rules
+        self.trigger = build_trigger(rules)
+        order = list(report_order or [])
+        order += [rule.name for rule in rules if rule.aggregates and rule.name not in order]
+        by_name = {rule.name: rule for rule in rules}
+        self.report_rules = [by_name[name] for name in order if name in by_name and by_name[name].aggregates]
+
+    @classmethod
+    def load(cls, config_path: Path) -> RuleSet:
+        config = json.loads(config_path.read_text(encoding="utf-8"))
+        rules: list[WarningRule] = []
+        seen: set[str] = set()
+        for entry in config.get("rules") or []:
+            name = entry.get("name")
+            if not name or not entry.get("pattern"):
+                raise ValueError(f"rule without name or pattern: {entry}")
+            if name in seen:
+                raise ValueError(f"duplicate rule name: {name}")
+            seen.add(name)
+            try:
+                pattern = re.compile(entry["pattern"])
+                aggregate_pattern = re.compile(entry["aggregate_pattern"]) if entry.get("aggregate_pattern") else None
+            except re.error as error:
+                raise ValueError(f"rule {name}: invalid pattern: {error}") from error
+            aggregate_group = entry.get("aggregate_group")
+            if aggregate_group is not None and not (is_int(aggregate_group) and 0 <= aggregate_group <= pattern.groups):
+                raise ValueError(f"rule {name}: aggregate_group {aggregate_group!r} is not a group of pattern")
+            for key in ("max", "report_top"):
+                if entry.get(key) is not None and not (is_int(entry[key]) and entry[key] >= 0):
+                    raise ValueError(f"rule {name}: {key} must be a non-negative integer or null, got {entry[key]!r}")
+            rules.append(
+                WarningRule(
+                    name=name,
+                    pattern=pattern,
+                    max=entry.get("max"),
+                    aggregate_group=aggregate_group,
+                    aggregate_pattern=aggregate_pattern,
+                    report=entry.get("report") or f"{name}_list",
+                    report_top=entry.get("report_top"),
+                )
+            )
+        if not rules:
+            raise ValueError(f"no rules defined in {config_path}")
+        try:
+            return cls(rules, config.get("report_order"))
+        except re.error as error:
+            raise ValueError(f"invalid combined rule pattern: {error}") from error
+
+
+def is_int(value: Any) -> bool:
+    # JSON true/false load as bool, which is an int subclass.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def trigger_alternative(pattern: re.Pattern[str]) -> str | None:
+    """``pattern`` rewritten as one alternative of the combined trigger, or None if it cannot be."""
+    source = pattern.pattern
+    if BACKREF_RE.search(source):
+        return None
+    source = NAMED_GROUP_RE.sub("(?:", source)
+    flags = GLOBAL_FLAGS_RE.match(source)
+    if flags:
+        # "(?i)warning" -> "(?i:warning)": same meaning, but scoped to this rule.
+        source = f"(?{flags.group(1)}:{source[flags.end():]})"
+    return f"(?:{source})"
+
+
+def build_trigger(rules: list[WarningRule]) -> re.Pattern[str]:
+    """One regex hitting every line on which some rule may match.
+
+    Rule patterns may carry capture groups; they are only used as alternatives here and re-run
+    individually on the (rare) lines that hit. MULTILINE gives ``^``/``$`` their per-line meaning.
+    If a pattern cannot be merged, the trigger hits every line and each rule is matched on its own.
+    """
+    alternatives = [trigger_alternative(rule.pattern) for rule in rules]
+    if None not in alternatives:
+        try:
+            return re.compile("|".join(alternatives), re.MULTILINE)
+        except re.error:
+            pass
+    return re.compile("^", re.MULTILINE)
+
+
+def normalize_signature(rule: WarningRule, line: str, key: str | None) -> str:
+    """Stable identity of a warning across builds: the aggregate key if the rule has one,
+    otherwise the line with checkout paths, numbers and whitespace runs normalized."""
+    if key is not None:
+        return key
+    text = CHECKOUT_PATH_RE.sub("", line)
+    text = DIGITS_RE.sub("#", text)
+    return " ".join(text.split())[:SIGNATURE_MAX_CHARS]
+
+
+def signature_hash(rule_name: str, signature: str) -> str:
+    return hashlib.blake2b(f"{rule_name}\0{signature}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+@dataclass
+class WarningScan:
+    counts: Counter = field(default_factory=Counter)
+    aggregates: dict[str, Counter] = field(default_factory=dict)
+    # hash -> (rule, signature); one entry per distinct warning, however often it repeats.
+    signatures: dict[str, tuple[str, str]] = field(default_factory=dict)
+
+    def add_line(self, line: str, rules: RuleSet) -> None:
+        for rule in rules.rules:
+            match = rule.pattern.search(line)
+            if not match:
+                continue
+            self.counts[rule.name] += 1
+            key = rule.aggregate_key(line, match) if rule.aggregates else None
+            if key is not None:
+                self.aggregates.setdefault(rule.name, Counter())[key] += 1
+            signature = normalize_signature(rule, line, key)
+            self.signatures.setdefault(signature_hash(rule.name, signature), (rule.name, signature))
+
+    def merge(self, other: WarningScan) -> None:
+        self.counts.update(other.counts)
+        for name, counter in other.aggregates.items():
+            self.aggregates.setdefault(name, Counter()).update(counter)
+        for digest, entry in other.signatures.items():
+            self.signatures.setdefault(digest, entry)
+
+    def summary(self, rules: RuleSet) -> dict[str, int]:
+        return {rule.name: self.counts[rule.name] for rule in rules.rules}
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument("log_file", help="Path to a Gradle/R8 log file")
+    parser.add_argument("log_files", nargs="*", help="Gradle/R8 log files or globs (e.g. 'build/logs/**/*.log')")
     parser.add_argument(
         "--enforce",
         action="store_true",
-        help="Exit non-zero if warning counts exceed expected maxima",
+        help="Exit non-zero if warning counts of any log exceed expected maxima",
+    )
+    parser.add_argument(
+        "--config",
+        default=str(DEFAULT_CONFIG_PATH),
+        help="JSON file with warning rules and budgets",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="Report warnings that are new or resolved compared with this baseline file",
+    )
+    parser.add_argument(
+        "--write-baseline",
+        metavar="PATH",
+        help="Store the warning signatures of this run as a baseline file",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--enforce-new",
+        action="store_true",
+        help="Exit non-zero if any warning signature is missing from --baseline",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Tail a growing log, printing periodic summaries; with --enforce/--enforce-new stop at the first breach",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between size checks in --follow mode",
+    )
+    parser.add_argument(
+        "--summary-every",
+        type=float,
+        default=30.0,
+        help="Seconds between summary lines in --follow mode",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0.0,
+        help="Stop following after the log has not grown for this many seconds (0 = until interrupted)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Worker processes used to scan logs and shards",
+    )
+    parser.add_argument(
+        "--shard-mb",
+        type=int,
+        default=DEFAULT_SHARD_MB,
+        help="Split logs larger than this into byte ranges scanned in parallel",
+    )
+    parser.add_argument(
+        "--json",
+        metavar="PATH",
+        help="Write a machine-readable report to PATH ('-' for stdout instead of the text report)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compare the streaming scanner with the whole-file reader on a synthetic UTF-16 log",
+    )
+    parser.add_argument(
+        "--benchmark-mb",
+        type=int,
+        default=64,
+        help="Approximate size of the synthetic benchmark log in MB",
+    )
+    args = parser.parse_args()
+    if not args.log_files and not args.benchmark:
+        parser.error("at least one log file is required unless --benchmark is given")
+    if args.enforce_new and not args.baseline:
+        parser.error("--enforce-new requires --baseline")
+    if args.follow and len(args.log_files) != 1:
+        parser.error("--follow takes exactly one log file")
+    return args
 
 
 def read_log_lines(log_path: Path) -> list[str]:
@@ -45,83 +320,601 @@ def read_log_lines(log_path: Path) -> list[str]:
         return raw.decode("cp1252", errors="ignore").splitlines()
 
 
+def scan_log_legacy(log_path: Path) -> WarningScan:
+    """Whole-file reader kept as the --benchmark baseline."""
+    lines = read_log_lines(log_path)
+    scan = WarningScan()
+    scan.counts["kotlin_metadata"] = sum(KOTLIN_METADATA_TEXT in line for line in lines)
+    scan.counts["field_rule"] = sum(FIELD_RULE_TEXT in line for line in lines)
+    scan.counts["context_receivers_warning"] = sum(CONTEXT_RECEIVERS_TEXT in line for line in lines)
+    scan.counts["aapt_non_positional_format"] = sum(AAPT_NON_POSITIONAL_TEXT in line for line in lines)
+    missing_classes = scan.aggregates.setdefault("missing_class", Counter())
+    for line in lines:
+        match = MISSING_RE.search(line)
+        if match:
+            missing_classes[match.group(1)] += 1
+    scan.counts["missing_class"] = sum(missing_classes.values())
+    aapt_keys = scan.aggregates.setdefault("aapt_non_positional_format", Counter())
+    for line in lines:
+        if AAPT_NON_POSITIONAL_TEXT in line:
+            match = AAPT_KEY_RE.search(line)
+            if match:
+                aapt_keys[match.group(1)] += 1
+    scan.aggregates = {name: counter for name, counter in scan.aggregates.items() if counter}
+    return scan
+
+
+@dataclass(frozen=True)
+class LogEncoding:
+    """How to decode a log: codec for the bytes after the BOM and the encoded newline used for sharding."""
+
+    codec: str
+    errors: str
+    bom: int = 0
+    newline: bytes = b"\n"
+    unit: int = 1
+
+
+@dataclass
+class FileScan:
+    path: Path
+    size: int
+    encoding: str
+    shards: int
+    scan: WarningScan
+
+
+def log_encodings(log_path: Path) -> list[LogEncoding]:
+    """Candidate encodings in the order the legacy reader tried them."""
+    with log_path.open("rb") as handle:
+        head = handle.read(3)
+    if head.startswith(b"\xff\xfe"):
+        return [LogEncoding("utf-16-le", "ignore", bom=2, newline=b"\n\x00", unit=2)]
+    if head.startswith(b"\xfe\xff"):
+        return [LogEncoding("utf-16-be", "ignore", bom=2, newline=b"\x00\n", unit=2)]
+    if head.startswith(b"\xef\xbb\xbf"):
+        return [LogEncoding("utf-8", "ignore", bom=3)]
+    return [LogEncoding("utf-8", "strict"), LogEncoding("cp1252", "ignore")]
+
+
+def next_line_start(handle: BinaryIO, offset: int, encoding: LogEncoding) -> int | None:
+    """Byte offset just past the first newline at or after ``offset``, aligned to the code unit."""
+    handle.seek(offset)
+    base = offset
+    buffer = b""
+    keep = len(encoding.newline) - 1
+    while True:
+        block = handle.read(READ_BYTES)
+        if not block:
+            return None
+        buffer += block
+        pos = 0
+        while True:
+            index = buffer.find(encoding.newline, pos)
+            if index < 0:
+                break
+            if (base + index - encoding.bom) % encoding.unit == 0:
+                return base + index + len(encoding.newline)
+            pos = index + 1
+        base += len(buffer) - keep
+        buffer = buffer[len(buffer) - keep :] if keep else b""
+
+
+def shard_ranges(log_path: Path, encoding: LogEncoding, shard_bytes: int) -> list[tuple[int, int]]:
+    """Split the log into byte ranges of roughly ``shard_bytes`` that start and end on line boundaries."""
+    size = log_path.stat().st_size
+    start = min(encoding.bom, size)
+    count = max(1, math.ceil((size - start) / shard_bytes)) if shard_bytes > 0 else 1
+    bounds = [start]
+    with log_path.open("rb") as handle:
+        for index in range(1, count):
+            target = start + (size - start) * index // count
+            target -= (target - start) % encoding.unit
+            if target <= bounds[-1]:
+                continue
+            line_start = next_line_start(handle, target, encoding)
+            if line_start is None or line_start >= size:
+                break
+            if line_start > bounds[-1]:
+                bounds.append(line_start)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a] or [(start, size)]
+
+
+def scan_range(log_path: Path, encoding: LogEncoding, start: int, end: int, rules: RuleSet) -> WarningScan | None:
+    """Scan ``[start, end)`` with incremental decoding; ``None`` if strict decoding fails."""
+    # translate=True turns \r\n and bare \r into \n, so chunks can be split on \n alone.
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding.codec)(encoding.errors), translate=True)
+    scan = WarningScan()
+    carry = ""
+    try:
+        with log_path.open("rb") as handle:
+            handle.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = handle.read(min(READ_BYTES, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                carry = feed_text(carry + decoder.decode(block), scan, rules)
+            text = carry + decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return None
+    if text:
+        scan_text(text, len(text), scan, rules)
+    return scan
+
+
+def feed_text(text: str, scan: WarningScan, rules: RuleSet) -> str:
+    """Scan the complete lines of ``text`` and return the unfinished tail."""
+    cut = text.rfind("\n") + 1
+    scan_text(text, cut, scan, rules)
+    return text[cut:]
+
+
+def scan_text(text: str, end: int, scan: WarningScan, rules: RuleSet) -> None:
+    """Classify every line in ``text[:end]`` on which at least one rule pattern matches."""
+    pos = 0
+    # search() clamps pos to end, so a zero-width hit at the very end must not be retried.
+    while pos <= end:
+        match = rules.trigger.search(text, pos, end)
+        if not match:
+            return
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        # Patterns with "\s" may hit across a line break: only the first line is classified,
+        # and the search resumes on the next one.
+        line_end = text.find("\n", match.start(), end)
+        if line_end < 0:
+            line_end = end
+        scan.add_line(text[line_start:line_end], rules)
+        pos = line_end + 1
+
+
+def scan_logs(log_paths: list[Path], rules: RuleSet, jobs: int, shard_bytes: int) -> list[FileScan]:
+    """Scan every log, sharding large ones by byte range, on a process pool when ``jobs > 1``.
+
+    Undecorated logs are tried as strict UTF-8 first; if any shard hits an invalid byte the
+    whole file is rescanned as cp1252, matching the whole-file reader.
+    """
+    candidates = {path: log_encodings(path) for path in log_paths}
+    attempt = {path: 0 for path in log_paths}
+    ranges = {path: shard_ranges(path, candidates[path][0], shard_bytes) for path in log_paths}
+    done: dict[Path, FileScan] = {}
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and sum(map(len, ranges.values())) > 1 else None
+    try:
+        pending = list(log_paths)
+        while pending:
+            tasks = []
+            for path in pending:
+                encoding = candidates[path][attempt[path]]
+                for start, end in ranges[path]:
+                    args = (path, encoding, start, end, rules)
+                    tasks.append((path, executor.submit(scan_range, *args) if executor else args))
+            shard_scans: dict[Path, list[WarningScan | None]] = {path: [] for path in pending}
+            for path, task in tasks:
+                shard_scans[path].append(task.result() if executor else scan_range(*task))
+            retry = []
+            for path, scans in shard_scans.items():
+                if any(scan is None for scan in scans) and attempt[path] + 1 < len(candidates[path]):
+                    attempt[path] += 1
+                    retry.append(path)
+                    continue
+                merged = WarningScan()
+                for scan in scans:
+                    if scan is None:
+                        raise UnicodeDecodeError(candidates[path][attempt[path]].codec, b"", 0, 1, f"cannot decode {path}")
+                    merged.merge(scan)
+                done[path] = FileScan(
+                    path=path,
+                    size=path.stat().st_size,
+                    encoding=candidates[path][attempt[path]].codec,
+                    shards=len(scans),
+                    scan=merged,
+                )
+            pending = retry
+    finally:
+        if executor:
+            executor.shutdown()
+    return [done[path] for path in log_paths]
+
+
+def scan_log(log_path: Path, rules: RuleSet) -> WarningScan:
+    """Single in-process pass over one log with incremental decoding and constant memory."""
+    return scan_logs([log_path], rules, jobs=1, shard_bytes=0)[0].scan
+
+
+class LogFollower:
+    """Tails a growing log, scanning each complete line once as it is written.
+
+    Bytes are decoded incrementally from the last offset; a partial trailing line is kept until
+    its newline arrives. A truncated file, or an invalid byte in a log read as strict UTF-8, restarts
+    the scan from the beginning (the latter with the next candidate encoding).
+    """
+
+    def __init__(self, log_path: Path, rules: RuleSet) -> None:
+        self.log_path = log_path
+        self.rules = rules
+        self.attempt = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.encoding: LogEncoding | None = None
+        self.decoder: io.IncrementalNewlineDecoder | None = None
+        self.offset = 0
+        self.carry = ""
+        self.scan = WarningScan()
+
+    def poll(self) -> bool:
+        """Scan whatever was appended since the last call; ``True`` if the file grew."""
+        try:
+            size = self.log_path.stat().st_size
+        except FileNotFoundError:
+            return False
+        if size < self.offset:
+            self.reset()
+        if self.encoding is None:
+            if size < 3:
+                return False
+            self.encoding = log_encodings(self.log_path)[self.attempt]
+            self.decoder = io.IncrementalNewlineDecoder(
+                codecs.getincrementaldecoder(self.encoding.codec)(self.encoding.errors), translate=True
+            )
+            self.offset = self.encoding.bom
+        if size == self.offset:
+            return False
+        try:
+            with self.log_path.open("rb") as handle:
+                handle.seek(self.offset)
+                while self.offset < size:
+                    block = handle.read(min(READ_BYTES, size - self.offset))
+                    if not block:
+                        break
+                    self.offset += len(block)
+                    self.carry = feed_text(self.carry + self.decoder.decode(block), self.scan, self.rules)
+        except UnicodeDecodeError:
+            if self.attempt + 1 >= len(log_encodings(self.log_path)):
+                raise
+            self.attempt += 1
+            self.reset()
+            return self.poll()
+        return True
+
+    def finish(self) -> FileScan:
+        if self.decoder is not None:
+            text = self.carry + self.decoder.decode(b"", final=True)
+            if text:
+                scan_text(text, len(text), self.scan, self.rules)
+            self.carry = ""
+        return FileScan(
+            path=self.log_path,
+            size=self.offset,
+            encoding=self.encoding.codec if self.encoding else "",
+            shards=1,
+            scan=self.scan,
+        )
+
+
+def follow_log(
+    log_path: Path,
+    rules: RuleSet,
+    interval: float,
+    summary_every: float,
+    idle_timeout: float,
+    enforce: bool,
+    baseline: dict[str, tuple[str, str]] | None,
+) -> tuple[FileScan, str]:
+    """Poll ``log_path`` until interrupted, idle for ``idle_timeout`` or (with enforcement) a breach.
+
+    Returns the scan so far and why following stopped.
+    """
+    follower = LogFollower(log_path, rules)
+    started = last_growth = last_summary = time.monotonic()
+    reason = "interrupted"
+    try:
+        while True:
+            grew = follower.poll()
+            now = time.monotonic()
+            if grew:
+                last_growth = now
+                if enforce and find_violations(follower.scan.summary(rules), rules):
+                    reason = "budget_exceeded"
+                    break
+                if baseline is not None and any(digest not in baseline for digest in follower.scan.signatures):
+                    reason = "new_warning"
+                    break
+            if now - last_summary >= summary_every:
+                counts = " ".join(f"{key}={value}" for key, value in follower.scan.summary(rules).items())
+                print(f"[follow t={now - started:.0f}s bytes={follower.offset}] {counts}", flush=True)
+                last_summary = now
+            if idle_timeout > 0 and now - last_growth >= idle_timeout:
+                reason = "idle_timeout"
+                break
+            if not grew:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return follower.finish(), reason
+
+
+def write_baseline(path: Path, signatures: dict[str, tuple[str, str]]) -> None:
+    """Store signatures as a sorted ``hash<TAB>rule<TAB>signature`` file, small enough to commit or cache."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w", encoding="utf-8", newline="\n") as handle:
+        handle.write(BASELINE_HEADER + "\n")
+        for digest in sorted(signatures):
+            rule_name, signature = signatures[digest]
+            handle.write(f"{digest}\t{rule_name}\t{signature}\n")
+
+
+def read_baseline(path: Path) -> dict[str, tuple[str, str]]:
+    signatures: dict[str, tuple[str, str]] = {}
+    with path.open(encoding="utf-8") as handle:
+        for line in handle:
+            if line.startswith("#") or not line.strip():
+                continue
+            digest, rule_name, signature = (line.rstrip("\n").split("\t", 2) + ["", ""])[:3]
+            signatures[digest] = (rule_name, signature)
+    return signatures
+
+
+def diff_signatures(
+    current: dict[str, tuple[str, str]],
+    baseline: dict[str, tuple[str, str]],
+) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    """(new, resolved) warnings, each sorted by rule and signature; set lookups keep this linear."""
+    new = sorted(entry for digest, entry in current.items() if digest not in baseline)
+    resolved = sorted(entry for digest, entry in baseline.items() if digest not in current)
+    return new, resolved
+
+
+def expand_log_args(patterns: list[str]) -> tuple[list[Path], list[str]]:
+    """Resolve paths and globs (``**`` allowed) into existing log files, preserving order."""
+    found: list[Path] = []
+    missing: list[str] = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [Path(match) for match in sorted(glob.glob(pattern, recursive=True)) if Path(match).is_file()]
+            if not matches:
+                missing.append(pattern)
+            found.extend(match for match in matches if match not in found)
+        elif Path(pattern).is_file():
+            if Path(pattern) not in found:
+                found.append(Path(pattern))
+        else:
+            missing.append(pattern)
+    return found, missing
+
+
+def write_synthetic_log(path: Path, target_mb: int) -> None:
+    filler = [
+        "> Task :app:minifyReleaseWithR8",
+        "R8: Info: Proguard configuration rule does not match anything: `-keep class androidx.** { *; }`",
+        "w: file:///src/main/java/eu/kanade/tachiyomi/ui/reader/ReaderViewModel.kt:412:9 'val' is deprecated.",
+    ]
+    warnings = [
+        f"R8: Warning: {KOTLIN_METADATA_TEXT} for class kotlinx.coroutines.Job",
+        f"R8: Warning: The field `eu.kanade.Data#value` {FIELD_RULE_TEXT}",
+        f"w: {CONTEXT_RECEIVERS_TEXT}.",
+        f"ERROR: values/strings.xml: {AAPT_NON_POSITIONAL_TEXT}. Did you mean to add formatted=\"false\"? string/chapter_progress",
+        f"ERROR: R8: {MISSING_CLASS_TEXT} org.slf4j.impl.StaticLoggerBinder (referenced from: void org.slf4j.LoggerFactory.bind())",
+    ]
+    block_lines = []
+    # One warning of each category per block, so every rule (including the aggregating
+    # missing_class) takes part in the results_match comparison.
+    step = 200 // len(warnings)
+    for index in range(200):
+        block_lines.append(filler[index % len(filler)])
+        if index % step == 0:
+            block_lines.append(warnings[index // step])
+    block = "\r\n".join(block_lines) + "\r\n"
+    target_chars = target_mb * (1 << 20) // 2
+    with path.open("w", encoding="utf-16", newline="") as handle:
+        written = 0
+        while written < target_chars:
+            handle.write(block)
+            written += len(block)
+
+
+def measure(label: str, func: Callable[[Path], WarningScan], log_path: Path) -> WarningScan:
+    tracemalloc.start()
+    started = time.perf_counter()
+    scan = func(log_path)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: elapsed_sec={elapsed:.2f} peak_mb={peak / (1 << 20):.1f}")
+    return scan
+
+
+def run_benchmark(target_mb: int, rules: RuleSet, jobs: int) -> int:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_path = Path(temp_dir) / "synthetic_release.log"
+        write_synthetic_log(log_path, target_mb)
+        print(f"log_file={log_path} size_mb={log_path.stat().st_size / (1 << 20):.1f}")
+        legacy = measure("legacy", scan_log_legacy, log_path)
+        streaming = measure("streaming", lambda path: scan_log(path, rules), log_path)
+        # tracemalloc only sees the parent process here; the peak excludes the workers.
+        shard_bytes = max(1, log_path.stat().st_size // max(1, jobs))
+        sharded = measure(
+            f"sharded(jobs={jobs})",
+            lambda path: scan_logs([path], rules, jobs, shard_bytes)[0].scan,
+            log_path,
+        )
+    same = all(
+        legacy.summary(rules) == other.summary(rules) and legacy.aggregates == other.aggregates
+        for other in (streaming, sharded)
+    )
+    print(f"results_match={str(same).lower()}")
+    return 0 if same else 1
+
+
+def find_violations(counts: dict[str, int], rules: RuleSet) -> list[tuple[str, int, int]]:
+    violations: list[tuple[str, int, int]] = []
+    for rule in rules.rules:
+        actual = counts[rule.name]
+        if rule.max is not None and actual > rule.max:
+            violations.append((rule.name, actual, rule.max))
+    return violations
+
+
+def print_aggregates(scan: WarningScan, rules: RuleSet) -> None:
+    for rule in rules.report_rules:
+        aggregate = scan.aggregates.get(rule.name)
+        if not aggregate:
+            continue
+        print(f"\n{rule.report}:")
+        for key, count in aggregate.most_common(rule.report_top):
+            print(f"  {count} {key}")
+
+
+def print_baseline_diff(baseline_diff: dict[str, Any], limit: int = 50) -> None:
+    if baseline_diff.get("missing"):
+        print(f"\nbaseline_missing={baseline_diff['path']}")
+        return
+    for label in ("new", "resolved"):
+        entries = baseline_diff[label]
+        print(f"\n{label}_warnings={len(entries)}")
+        for entry in entries[:limit]:
+            print(f"  {entry['rule']}: {entry['signature']}")
+        if len(entries) > limit:
+            print(f"  ... {len(entries) - limit} more")
+
+
+def build_json_report(
+    results: list[FileScan],
+    total: WarningScan,
+    rules: RuleSet,
+    violations: list[dict[str, Any]],
+    config_path: Path,
+    baseline: dict[str, Any] | None,
+) -> dict[str, Any]:
+    return {
+        "config": str(config_path),
+        "budgets": {rule.name: rule.max for rule in rules.rules},
+        "totals": {
+            "counts": total.summary(rules),
+            "aggregates": {name: dict(counter.most_common()) for name, counter in total.aggregates.items()},
+        },
+        "files": [
+            {
+                "path": str(result.path),
+                "bytes": result.size,
+                "encoding": result.encoding,
+                "shards": result.shards,
+                "counts": result.scan.summary(rules),
+                "aggregates": {name: dict(counter.most_common()) for name, counter in result.scan.aggregates.items()},
+            }
+            for result in results
+        ],
+        "violations": violations,
+        "baseline": baseline,
+    }
+
+
 def main() -> int:
     args = parse_args()
 
-    log_path = Path(args.log_file)
-    if not log_path.exists():
-        print(f"Log file not found: {log_path}")
+    config_path = Path(args.config)
+    try:
+        rules = RuleSet.load(config_path)
+    except (OSError, ValueError) as error:
+        print(f"Invalid warning config {config_path}: {error}")
         return 2
 
-    lines = read_log_lines(log_path)
+    if args.benchmark:
+        return run_benchmark(args.benchmark_mb, rules, max(1, args.jobs))
 
-    metadata_count = sum(
-        "An error occurred when parsing kotlin metadata" in line for line in lines
-    )
-    field_rule_count = sum("is used in a field rule" in line for line in lines)
-    context_receivers_count = sum(
-        "Experimental context receivers are superseded by context parameters" in line
-        for line in lines
-    )
-    aapt_non_positional_count = sum(
-        "Multiple substitutions specified in non-positional format of string resource"
-        in line
-        for line in lines
-    )
+    baseline_path = Path(args.baseline) if args.baseline else None
+    baseline = read_baseline(baseline_path) if baseline_path and baseline_path.exists() else None
+    if args.enforce_new and baseline is None:
+        # A mistyped path must not silently turn the new-warning gate off.
+        print(f"Baseline file not found: {baseline_path} (required by --enforce-new)")
+        return 2
 
-    missing_re = re.compile(r"Missing class\s+([^\s]+)")
-    missing_classes: list[str] = []
-    for line in lines:
-        match = missing_re.search(line)
-        if match:
-            missing_classes.append(match.group(1))
+    if args.follow:
+        # The log may not exist yet when the build starts; LogFollower waits for it.
+        result, reason = follow_log(
+            Path(args.log_files[0]),
+            rules,
+            args.poll_interval,
+            args.summary_every,
+            args.idle_timeout,
+            args.enforce,
+            baseline if args.enforce_new else None,
+        )
+        print(f"follow_stopped={reason}")
+        results = [result]
+    else:
+        log_paths, missing = expand_log_args(args.log_files)
+        if missing:
+            for pattern in missing:
+                print(f"Log file not found: {pattern}")
+            return 2
+        results = scan_logs(log_paths, rules, max(1, args.jobs), args.shard_mb * (1 << 20))
 
-    aapt_key_re = re.compile(r"string/([A-Za-z0-9_]+)")
-    aapt_keys = Counter()
-    for line in lines:
-        if (
-            "Multiple substitutions specified in non-positional format of string resource"
-            in line
-        ):
-            match = aapt_key_re.search(line)
-            if match:
-                aapt_keys[match.group(1)] += 1
+    total = WarningScan()
+    for result in results:
+        total.merge(result.scan)
 
-    counts = {
-        "kotlin_metadata": metadata_count,
-        "field_rule": field_rule_count,
-        "context_receivers_warning": context_receivers_count,
-        "aapt_non_positional_format": aapt_non_positional_count,
-        "missing_class": len(missing_classes),
-    }
+    # Budgets apply to each log: every variant's build has to stay within them on its own.
+    violations = [
+        {"log_file": str(result.path), "rule": key, "actual": actual, "allowed_max": allowed_max}
+        for result in results
+        for key, actual, allowed_max in find_violations(result.scan.summary(rules), rules)
+    ]
 
-    print(f"log_file={log_path}")
-    for key, value in counts.items():
-        print(f"{key}={value}")
+    baseline_diff: dict[str, Any] | None = None
+    if baseline_path:
+        if baseline is not None:
+            new, resolved = diff_signatures(total.signatures, baseline)
+            baseline_diff = {
+                "path": str(baseline_path),
+                "new": [{"rule": rule_name, "signature": signature} for rule_name, signature in new],
+                "resolved": [{"rule": rule_name, "signature": signature} for rule_name, signature in resolved],
+            }
+        else:
+            baseline_diff = {"path": str(baseline_path), "missing": True, "new": [], "resolved": []}
+    if args.write_baseline:
+        write_baseline(Path(args.write_baseline), total.signatures)
 
-    if missing_classes:
-        print("\nmissing_class_list:")
-        for clazz, count in Counter(missing_classes).most_common():
-            print(f"  {count} {clazz}")
+    if args.json:
+        report = build_json_report(results, total, rules, violations, config_path, baseline_diff)
+        if args.json == "-":
+            print(json.dumps(report, indent=2, ensure_ascii=False))
+        else:
+            Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
 
-    if aapt_keys:
-        print("\naapt_top_keys:")
-        for key, count in aapt_keys.most_common(20):
-            print(f"  {count} {key}")
+    if args.json != "-":
+        if len(results) == 1:
+            print(f"log_file={results[0].path}")
+        else:
+            print(f"log_files={len(results)}")
+        for key, value in total.summary(rules).items():
+            print(f"{key}={value}")
+
+        print_aggregates(total, rules)
+
+        if len(results) > 1:
+            print("\nper_file:")
+            for result in results:
+                counts = " ".join(f"{key}={value}" for key, value in result.scan.summary(rules).items())
+                print(f"  {result.path}: {counts}")
+
+        if baseline_diff is not None:
+            print_baseline_diff(baseline_diff)
 
-    if args.enforce:
-        violations: list[tuple[str, int, int]] = []
-        for key, allowed_max in ALLOWED_MAX.items():
-            actual = counts[key]
-            if actual > allowed_max:
-                violations.append((key, actual, allowed_max))
-        if violations:
+    exit_code = 0
+    if args.enforce_new and baseline_diff and baseline_diff["new"]:
+        exit_code = 3
+    if args.enforce and violations:
+        if args.json != "-":
             print("\nwarning_regressions:")
-            for key, actual, allowed_max in violations:
-                print(f"  {key}: actual={actual}, allowed_max={allowed_max}")
-            return 3
+            for violation in violations:
+                suffix = f" ({violation['log_file']})" if len(results) > 1 else ""
+                print(f"  {violation['rule']}: actual={violation['actual']}, allowed_max={violation['allowed_max']}{suffix}")
+        exit_code = 3
 
-    return 0
+    return exit_code
 
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+"""Offline tests for airforce-debug-diagnose.py, run against its in-process StubAirforceServer."""
+
+import importlib.util
+import json
+import sys
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+SCRIPT = Path(__file__).with_name("airforce-debug-diagnose.py")
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("airforce_debug_diagnose", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+diag = load_script()
+
+API_KEY = "sk-test-" + "0" * 24
+# Fields that come from parsing the response; timings differ between the run and its replay.
+PARSED_FIELDS = (
+    "success",
+    "http_status",
+    "finish_reason",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "message_content_len",
+    "chunk_count",
+    "xml_validation",
+    "error",
+)
+
+
+def make_diagnoser(base_url, **kwargs):
+    return diag.AirforceDiagnoser(base_url=base_url, api_key=API_KEY, timeout_sec=10, retries=2, min_spacing=0, **kwargs)
+
+
+def run_chapter_probes(diagnoser, session, chapter_url):
+    segments, _ = diag.load_chapter_segments(chapter_url, timeout_sec=10, max_segments=6, max_chars=2000, session=session)
+    messages = diag.build_xml_translate_messages("English", "Russian", segments)
+    source_lengths = [len(s) for s in segments]
+    results = [
+        diagnoser.probe_chat("deepseek-v3.2", "xml_translate_chapter", messages, max_tokens=512, stream=stream, source_lengths=source_lengths)
+        for stream in (False, True)
+    ]
+    return segments, results
+
+
+def test_sse_events_join_data_lines_and_skip_comments():
+    lines = [b": keep-alive", b"data: {\"a\":", b"data: 1}\r", b"", b"event: ping", b"", b"data:[DONE]"]
+    assert list(diag.iter_sse_data(lines)) == ['{"a":\n1}', "[DONE]"]
+
+
+def test_stream_probe_extracts_ttft_and_usage():
+    messages = [{"role": "user", "content": "<s i='1'>The rain had not stopped for three days.</s>"}]
+    with diag.StubAirforceServer(latency_ms=50, chunk_delay_ms=20, chunk_chars=8) as stub:
+        result = make_diagnoser(stub.base_url).probe_chat("deepseek-v3.2", "plain", messages, max_tokens=64, stream=True)
+        reply = stub.reply_for({"messages": messages})
+
+    chunks = -(-len(reply) // 8)
+    assert result.success and result.stream and result.finish_reason == "stop"
+    assert result.message_content_len == len(reply)
+    assert result.chunk_count == chunks
+    assert (result.prompt_tokens, result.completion_tokens) == (len(messages[0]["content"]) // 4, chunks)
+    assert result.total_tokens == result.prompt_tokens + result.completion_tokens
+    # The first chunk follows the stub latency; the rest are paced by the chunk delay.
+    assert 50 <= result.ttft_ms < result.elapsed_ms
+    assert result.elapsed_ms - result.ttft_ms >= 20 * (chunks - 1)
+
+
+def test_rate_limited_probe_waits_for_retry_after():
+    messages = [{"role": "user", "content": "Hi"}]
+    with diag.StubAirforceServer(rate_limit_every=2, retry_after_sec=0.3) as stub:
+        diagnoser = make_diagnoser(stub.base_url)
+        first = diagnoser.probe_chat("deepseek-v3.2", "plain", messages, max_tokens=16)
+        started = time.monotonic()
+        second = diagnoser.probe_chat("deepseek-v3.2", "plain", messages, max_tokens=16)
+        waited = time.monotonic() - started
+
+    assert first.success and first.rate_limited == 0
+    assert second.success and (second.rate_limited, second.attempts) == (1, 2)
+    assert second.retry_wait_ms >= 300 and waited >= 0.3
+
+
+@pytest.mark.parametrize(
+    "value, seconds",
+    [("2", 2.0), ("1.5s", 1.5), ("250ms", 0.25), ("6m0s", 360.0), (None, None), ("soon", None)],
+)
+def test_parse_duration_seconds(value, seconds):
+    assert diag.parse_duration_seconds(value) == seconds
+
+
+def test_reset_timestamps_are_read_as_time_until_reset():
+    assert 25 <= diag.parse_duration_seconds(str(int(time.time()) + 30)) <= 30
+    assert 25 <= diag.parse_duration_seconds(str(int((time.time() + 30) * 1000))) <= 30
+
+
+def test_cassette_replay_matches_recorded_run(tmp_path):
+    path = tmp_path / "run.jsonl.gz"
+    with diag.StubAirforceServer(chunk_chars=8) as stub:
+        base_url = stub.base_url
+        recorder = diag.HttpCassette(path, "record")
+        recorded_segments, recorded = run_chapter_probes(
+            make_diagnoser(base_url, cassette=recorder), recorder.mount(requests.Session()), f"{base_url}/chapter"
+        )
+    assert recorder.stats()["recorded"] == 3
+
+    # The stub is gone: every request below must come from the cassette.
+    player = diag.HttpCassette(path, "replay")
+    replayed_segments, replayed = run_chapter_probes(
+        make_diagnoser(base_url, cassette=player), player.mount(requests.Session()), f"{base_url}/chapter"
+    )
+
+    assert replayed_segments == recorded_segments == diag.SAMPLE_CHAPTER_SEGMENTS[:6]
+    for before, after in zip(recorded, replayed):
+        assert before.success and before.xml_validation["complete"]
+        assert {f: getattr(after, f) for f in PARSED_FIELDS} == {f: getattr(before, f) for f in PARSED_FIELDS}
+    stats = player.stats()
+    assert (stats["replayed"], stats["misses"]) == (3, 0)
+    assert diag.report_origin("https://api.airforce", player) == {"base_url": base_url, "replayed": True}
+
+
+def test_cassette_miss_fails_without_network(tmp_path):
+    path = tmp_path / "empty.jsonl"
+    diag.HttpCassette(path, "record")
+    player = diag.HttpCassette(path, "replay")
+    result = make_diagnoser("http://127.0.0.1:9", cassette=player).probe_chat(
+        "deepseek-v3.2", "plain", [{"role": "user", "content": "Hi"}], max_tokens=16
+    )
+    assert not result.success
+    assert result.attempts == 1
+    assert player.stats()["misses"] == 1
+
+
+@pytest.mark.parametrize(
+    "report, offline",
+    [
+        ({"mock": True}, True),
+        ({"replayed": True}, True),
+        ({"cassette": {"mode": "replay-realtime"}}, True),
+        ({"mock": False, "cassette": {"mode": "record"}}, False),
+    ],
+)
+def test_offline_reports_are_detected(report, offline):
+    assert diag.is_offline_report(report) is offline
+
+
+def test_chapter_cache_hit_decodes_with_stored_encoding(tmp_path):
+    cache = diag.ResponseCache(tmp_path / "cache", "readwrite")
+    with diag.StubAirforceServer() as stub:
+        chapter_url = f"{stub.base_url}/chapter"
+        fetched, _ = diag.fetch_chapter_segments(chapter_url, timeout_sec=10, max_segments=3, max_chars=2000, cache=cache)
+    meta, _, fresh = cache.get(diag.ResponseCache.key("GET", chapter_url))
+    assert fresh and meta["encoding"].lower() == "utf-8"
+    assert fetched == diag.SAMPLE_CHAPTER_SEGMENTS[:3]
+
+    # A cp1251 page must come back from the cache exactly as the network path decoded it.
+    text = "Lin Feng (Линь Фэн) pulled his cloak tighter and stared at the lantern."
+    other_url = "http://127.0.0.1:9/cp1251-chapter"
+    cache.put(
+        diag.ResponseCache.key("GET", other_url),
+        {"kind": "chapter", "url": other_url, "status": 200, "encoding": "windows-1251"},
+        f"<html><body><p>{text}</p></body></html>".encode("cp1251"),
+    )
+    cached, _ = diag.fetch_chapter_segments(other_url, timeout_sec=10, max_segments=3, max_chars=2000, cache=cache)
+    assert cached == [text]
+
+
+def layout_stats(layout, pad, effective, ttft):
+    return {
+        "layout": layout,
+        "prefix_pad_tokens": pad,
+        "requests": 3,
+        "succeeded": 3,
+        "cache_reported": True,
+        "warm_ttft_ms": {"p50": ttft, "p90": ttft},
+        "warm_effective_prompt_tokens": effective,
+    }
+
+
+def test_layouts_are_ranked_within_each_padding_level():
+    variants = {
+        "current": layout_stats("current", 0, 436.0, 150.0),
+        "static-system": layout_stats("static-system", 0, 440.0, 150.0),
+        "current+pad1024": layout_stats("current", 1024, 900.0, 110.0),
+        "static-system+pad1024": layout_stats("static-system", 1024, 850.0, 108.0),
+    }
+    recommendations = diag.recommend_layout(variants, "current")
+    assert [(r["prefix_pad_tokens"], r["variant"], r["baseline"]) for r in recommendations] == [
+        (0, "current", "current"),
+        (1024, "static-system+pad1024", "current+pad1024"),
+    ]
+
+
+def test_hedged_probe_reports_end_to_end_time_on_a_copy():
+    with diag.StubAirforceServer(slow_rate=1.0, slow_ms=400, chunk_chars=8, seed=1) as stub:
+        prober = diag.HedgedProber(
+            make_diagnoser(stub.base_url),
+            ["deepseek-v3.2", "glm-5-fast", "glm-5-fast"],
+            diag.ModelLatencyTracker(),
+            initial_delay_ms=100,
+            max_hedges=2,
+        )
+        job = diag.ProbeJob("bench", "deepseek-v3.2", "plain", [{"role": "user", "content": "<s i='1'>Hello there</s>"}])
+        try:
+            chosen = prober.probe(job, max_tokens=64, stream=True)
+        finally:
+            prober.close()
+
+    assert prober.models == ["deepseek-v3.2", "glm-5-fast"]
+    assert chosen.success and chosen.hedge["fired"] and chosen.hedge["models"] == prober.models
+    # Both requests (the cancelled loser included) keep their own latency; only the copy is end to end.
+    assert len(prober.requests) == 2 and all(chosen is not r for r in prober.requests)
+    winner = next(r for r in prober.requests if r.model == chosen.model and r.success)
+    assert winner.elapsed_ms <= chosen.elapsed_ms
+
+
+def test_mock_bench_recovers_from_rate_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(diag, "REPORT_DIR", tmp_path)
+    argv = ["--mock", "--models", "deepseek-v3.2", "--requests", "6", "--concurrency", "2", "--stream"]
+    assert diag.bench_main(argv + ["--mock-latency-ms", "5", "--mock-rate-limit-every", "3", "--mock-retry-after-sec", "0.05"]) == 0
+
+    (report_path,) = tmp_path.glob("bench-*.json")
+    report = json.loads(report_path.read_text(encoding="utf-8"))
+    stats = report["summary"]["deepseek-v3.2"]
+    assert report["mock"] and diag.is_offline_report(report)
+    assert stats["succeeded"] == stats["requests"] == 6
+    assert stats["rate_limited"] > 0 and stats["retries"] == stats["rate_limited"]
+    assert stats["ttft_ms"]["p50"] is not None
+
+
+@pytest.mark.parametrize("page", ["blog-layout.html", "reader-layout.html"])
+def test_chapter_fixtures_extract_reviewed_segments(page):
+    path = diag.CHAPTER_FIXTURES_DIR / page
+    expected = diag.expected_page_segments(path, max_segments=100000, max_chars=1200)
+    segments, bytes_read = diag.read_chapter_file_segments(path, max_segments=100000, max_chars=1200)
+    assert segments == expected and bytes_read == path.stat().st_size
+    # What the fixtures plant for the legacy regex: a <pre> note and a <p> inside a script string.
+    legacy = diag.extract_segments_legacy(path.read_text(encoding="utf-8"), max_segments=100000, max_chars=1200)
+    planted = [s for s in legacy if s.startswith("TL note:") or s.startswith("Support the translator")]
+    assert len(planted) == 1 and not any(s.startswith(planted[0][:20]) for s in segments)
+
+
+def test_bench_extract_checks_fixture_sidecars(capsys):
+    assert diag.bench_extract_main(["--repeat", "1"]) == 0
+    assert capsys.readouterr().out.count("expected=legacy:False,streaming:True") == 2
+
+
+def test_response_cache_evicts_least_recently_used_within_budget(tmp_path):
+    cache = diag.ResponseCache(tmp_path, "readwrite")
+    keys = [diag.ResponseCache.key("GET", f"/page/{i}") for i in range(6)]
+    for key in keys[:4]:
+        cache.put(key, {"kind": "chapter"}, b"x" * 1000)
+    entry_bytes = sum(p.stat().st_size for p in tmp_path.glob("*/*") if p.stem == keys[0])
+
+    # A second instance starts from a scan of the existing entries. The slack absorbs the few
+    # bytes "stored_at" varies by, and is far less than one entry.
+    cache = diag.ResponseCache(tmp_path, "readwrite", max_bytes=4 * entry_bytes + 40)
+    assert cache.get_text(keys[0]) is not None
+    cache.put(keys[4], {"kind": "chapter"}, b"x" * 1000)
+    cache.put(keys[5], {"kind": "chapter"}, b"x" * 1000)
+
+    kept = {key for key in keys if cache.get(key) is not None}
+    assert kept == {keys[0], keys[3], keys[4], keys[5]}
+    assert cache.stats()["evictions"] == 2
+
+
+def test_response_cache_body_removed_after_get_is_a_miss(tmp_path, monkeypatch):
+    cache = diag.ResponseCache(tmp_path, "readwrite")
+    key = diag.ResponseCache.key("GET", "/page")
+    cache.put(key, {"kind": "chapter"}, "body")
+    get = cache.get
+
+    def get_then_evict(k):
+        entry = get(k)
+        entry[1].unlink()
+        return entry
+
+    monkeypatch.setattr(cache, "get", get_then_evict)
+    assert cache.get_text(key) is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (0, 1)